@@ -6,17 +6,39 @@ a list of artifacts and a remote repository URL.
 import logging
 import os
 import re
+import threading
 import urlparse
 from multiprocessing import Queue
 from multiprocessing import Lock
 from multiprocessing.pool import ThreadPool
 
 import maven_repo_util
+from download_scheduler import DownloadScheduler
+from host_limiter import AdaptiveHostLimiter
+from progress_reporter import ProgressReporter
+from throughput_stats import ThroughputStats
 from maven_artifact import MavenArtifact
 
 
-def downloadArtifacts(remoteRepoUrl, localRepoDir, artifact, checksumMode, mkdirLock, filesetLock, fileset, errors):
-    """Download artifact from a remote repository."""
+class DownloadEngine:
+    threadpool = 'threadpool'
+    queue = 'queue'
+
+
+class DownloadOrder:
+    listed = 'list'
+    size = 'size'
+
+
+# lock shared by all downloads, so they can run for several repositories at once
+_mkdirLock = Lock()
+
+# scheduler host of copies from file:// repositories
+LOCAL_HOST = 'file://'
+
+
+def downloadArtifacts(remoteRepoUrl, localRepoDir, artifact, checksumMode, mkdirLock, errors, journal=None):
+    """Download artifact from a remote repository. Successfully fetched file is recorded in the journal if given."""
     logging.debug("Starting download of %s", str(artifact))
 
     artifactLocalDir = os.path.join(localRepoDir, artifact.getDirPath())
@@ -33,19 +55,74 @@ def downloadArtifacts(remoteRepoUrl, localRepoDir, artifact, checksumMode, mkdir
         # Download main artifact
         artifactUrl = remoteRepoUrl + artifact.getArtifactFilepath()
         artifactLocalPath = os.path.join(localRepoDir, artifact.getArtifactFilepath())
-        maven_repo_util.fetchFile(artifactUrl, artifactLocalPath, checksumMode, True, True, filesetLock, fileset)
+        maven_repo_util.fetchFile(artifactUrl, artifactLocalPath, checksumMode, True, True)
+        if journal is not None:
+            journal.markDone(artifact.getArtifactFilepath(), artifactLocalPath)
+        _reportFileDone(True)
     except BaseException as ex:
         logging.error("Error while downloading artifact %s: %s", artifact, str(ex))
         errors.put(ex)
+        _reportFileDone(False)
+
+
+def copyArtifact(remoteRepoPath, localRepoDir, artifact, checksumMode, mkdirLock=None, errors=None, journal=None):
+    """
+    Copy artifact from a repository on the local file system along with pom and source jar. When it runs in multiple
+    threads, the lock has to be passed as for downloadArtifacts and errors are put into the errors queue. An artifact
+    missing in the repository is not an error, but it is not reported as done.
+    """
+    try:
+        # Copy main artifact
+        artifactPath = os.path.join(remoteRepoPath, artifact.getArtifactFilepath())
+        artifactLocalPath = os.path.join(localRepoDir, artifact.getArtifactFilepath())
+        fetched = os.path.exists(artifactLocalPath)
+        if os.path.exists(artifactPath) and not fetched:
+            if mkdirLock is not None:
+                artifactLocalDir = os.path.dirname(artifactLocalPath)
+                mkdirLock.acquire()
+                try:
+                    if not os.path.exists(artifactLocalDir):
+                        os.makedirs(artifactLocalDir)
+                finally:
+                    mkdirLock.release()
+            fetched = maven_repo_util.fetchFile(artifactPath, artifactLocalPath, checksumMode)
+            if fetched and journal is not None:
+                journal.markDone(artifact.getArtifactFilepath(), artifactLocalPath)
+        elif not fetched:
+            logging.warning("Source file not found: %s", artifactPath)
+        _reportFileDone(fetched)
+    except BaseException as ex:
+        _reportFileDone(False)
+        if errors is None:
+            raise
+        logging.error("Error while copying artifact %s: %s", artifact, str(ex))
+        errors.put(ex)
+
 
+def _getProgressStats(limiter=None):
+    stats = {"activeConnections": maven_repo_util.getConnectionPool().getStats()["active"],
+             "retries": maven_repo_util.getRetryPolicy().retried}
+    if limiter is not None:
+        stats["hostLimits"] = dict((host, hostStats["limit"]) for (host, hostStats) in limiter.getStats().items())
+    return stats
 
-def copyArtifact(remoteRepoPath, localRepoDir, artifact, checksumMode):
-    """Copy artifact from a repository on the local file system along with pom and source jar"""
-    # Copy main artifact
-    artifactPath = os.path.join(remoteRepoPath, artifact.getArtifactFilepath())
-    artifactLocalPath = os.path.join(localRepoDir, artifact.getArtifactFilepath())
-    if os.path.exists(artifactPath) and not os.path.exists(artifactLocalPath):
-        maven_repo_util.fetchFile(artifactPath, artifactLocalPath, checksumMode)
+
+def _saveThroughput(throughputFile, hostRates):
+    if not hostRates:
+        return
+    throughputStats = ThroughputStats(throughputFile)
+    for (host, rate) in hostRates.items():
+        throughputStats.update(host, rate)
+    try:
+        throughputStats.save()
+    except (IOError, OSError) as err:
+        logging.warning("Unable to save throughput statistics: %s", str(err))
+
+
+def _reportFileDone(success):
+    reporter = maven_repo_util.getProgressReporter()
+    if reporter is not None:
+        reporter.fileDone(success)
 
 
 def depListToArtifactList(depList):
@@ -62,32 +139,67 @@ def depListToArtifactList(depList):
     return artifactList
 
 
-def fetchArtifactList(remoteRepoUrl, localRepoDir, artifactList, checksumMode, threadnum):
+def fetchArtifactList(remoteRepoUrl, localRepoDir, artifactList, checksumMode, threadnum,
+                      engine=DownloadEngine.threadpool, scheduler=None, errors=None, journal=None, copyThreads=None,
+                      order=DownloadOrder.listed):
+    """
+    Create a Maven repository based on a remote repository url and a list of artifacts. When a shared scheduler
+    is given, the downloads are only submitted to it and the caller has to wait for the scheduler to finish. Errors
+    are then put into the given errors queue. Artifacts recorded as finished in the given journal are skipped and
+    newly fetched ones are recorded there. Snapshot versions of a resumed journal are not resolved again. Artifacts from a file:// repository are copied by copyThreads threads
+    (defaults to threadnum). With the size order the biggest files are started first.
+
+    :returns: number of errors which occurred, when no scheduler is given
+    """
     remoteRepoUrl = remoteRepoUrl.replace('indy://', 'http://').replace('indys://', 'https://')
-    """Create a Maven repository based on a remote repository url and a list of artifacts"""
     logging.info('Retrieving artifacts from repository: %s', remoteRepoUrl)
-    if not os.path.exists(localRepoDir):
-        os.makedirs(localRepoDir)
+    _mkdirLock.acquire()
+    try:
+        if not os.path.exists(localRepoDir):
+            os.makedirs(localRepoDir)
+    finally:
+        _mkdirLock.release()
     parsedUrl = urlparse.urlparse(remoteRepoUrl)
     protocol = parsedUrl[0]
-    repoPath = parsedUrl[2]
 
     if protocol == 'http' or protocol == 'https':
-        # Create thread pool
-        pool = ThreadPool(threadnum)
+        (task, source, host, poolSize) = (downloadArtifacts, remoteRepoUrl, parsedUrl[1], threadnum)
+    elif protocol == 'file':
+        repoPath = remoteRepoUrl.replace('file://', '')
+        (task, source, host, poolSize) = (copyArtifact, repoPath, LOCAL_HOST, copyThreads or threadnum)
+    else:
+        logging.error('Unknown protocol: %s', protocol)
+        return 1
+
+    if journal is None or not journal.resumed:
+        # resolve all snapshot versions at once before the downloads start, a resumed build keeps the recorded ones,
+        # so the files recorded as finished are the same
+        maven_repo_util.updateSnapshotVersionSuffixes(artifactList, remoteRepoUrl, poolSize)
+        maven_repo_util.addListedFiles(remoteRepoUrl, artifactList)
+
+    if scheduler is None:
+        # Create thread pool or the bounded download queue
+        if engine == DownloadEngine.queue:
+            pool = DownloadScheduler(poolSize)
+        else:
+            pool = ThreadPool(poolSize)
         errors = Queue()
-        mkdirLock = Lock()
-        filesetLock = Lock()
-        fileset = set([])
-
-        for artifact in artifactList:
-            if artifact.isSnapshot():
-                maven_repo_util.updateSnapshotVersionSuffix(artifact, remoteRepoUrl)
-            pool.apply_async(
-                downloadArtifacts,
-                [remoteRepoUrl, localRepoDir, artifact, checksumMode, mkdirLock, filesetLock, fileset, errors]
-            )
 
+    if order == DownloadOrder.size:
+        artifactList = _sortBySize(remoteRepoUrl, localRepoDir, artifactList, poolSize)
+
+    for artifact in artifactList:
+        if journal is not None and journal.isDone(artifact.getArtifactFilepath()):
+            if maven_repo_util.getProgressReporter() is not None:
+                maven_repo_util.getProgressReporter().fileSkipped()
+            continue
+        args = [source, localRepoDir, artifact, checksumMode, _mkdirLock, errors, journal]
+        if scheduler is None:
+            pool.apply_async(task, args)
+        else:
+            scheduler.apply_async(task, args, host)
+
+    if scheduler is None:
         # Close pool and wait till all workers are finished
         pool.close()
         pool.join()
@@ -96,21 +208,167 @@ def fetchArtifactList(remoteRepoUrl, localRepoDir, artifactList, checksumMode, t
         if not errors.empty():
             logging.error("During fetching files from repository %s %i error(s) occurred.", remoteRepoUrl,
                           errors.qsize())
+        return errors.qsize()
+
+
+def _feedArtifactList(remoteRepoUrl, outputDir, artifactList, checksumMode, threadnum, engine, scheduler, errors,
+                      journal, copyThreads, order):
+    """
+    Submit artifacts of a repository to the shared scheduler in a feeder thread. A repository, which could not be
+    submitted at all, is counted in the errors queue, so the build does not end as successful.
+    """
+    try:
+        if fetchArtifactList(remoteRepoUrl, outputDir, artifactList, checksumMode, threadnum, engine, scheduler,
+                             errors, journal, copyThreads, order):
+            errors.put(ValueError("Unable to fetch artifacts from repository %s" % remoteRepoUrl))
+    except BaseException as ex:
+        logging.error("Error while submitting artifacts from repository %s: %s", remoteRepoUrl, str(ex))
+        errors.put(ex)
+
+
+def resolveSnapshotVersions(urlToMAList, threadnum):
+    """
+    Resolves snapshot version suffixes of artifacts of all repositories before their files are sized or recorded.
+    GAVs of each repository are resolved in parallel by threadnum threads, artifacts of unsupported protocols are left
+    as they are.
+
+    :param urlToMAList: artifact list in the form {repoUrl: [MavenArtifact]}
+    :param threadnum: number of threads resolving the GAVs of a repository
+    """
+    for (repoUrl, artifacts) in urlToMAList.items():
+        url = repoUrl.replace('indy://', 'http://').replace('indys://', 'https://')
+        if maven_repo_util.urlProtocol(url) in ('http', 'https', 'file'):
+            maven_repo_util.updateSnapshotVersionSuffixes(artifacts, url, threadnum)
 
-    elif protocol == 'file':
-        repoPath = remoteRepoUrl.replace('file://', '')
-        for artifact in artifactList:
-            if artifact.isSnapshot():
-                maven_repo_util.updateSnapshotVersionSuffix(artifact, remoteRepoUrl)
-            copyArtifact(repoPath, localRepoDir, artifact, checksumMode)
-    else:
-        logging.error('Unknown protocol: %s', protocol)
 
+def _sortBySize(remoteRepoUrl, localRepoDir, artifactList, threadnum):
+    """
+    Sorts artifacts from the biggest to the smallest file, so the long downloads do not start last and the small ones
+    fill the free threads at the end. Sizes are requested only for files missing in the local repository, the others
+    and files with unknown size go last.
+    """
+    remoteRepoUrl = maven_repo_util.slashAtTheEnd(remoteRepoUrl)
+    missingArtifacts = [artifact for artifact in artifactList
+                        if not os.path.exists(os.path.join(localRepoDir, artifact.getArtifactFilepath()))]
+    logging.info('Collecting sizes of %d files in repository %s', len(missingArtifacts), remoteRepoUrl)
+    sizes = maven_repo_util.getFileSizes([remoteRepoUrl + artifact.getArtifactFilepath()
+                                          for artifact in missingArtifacts], threadnum)
+    artifactSizes = dict(zip(missingArtifacts, sizes))
+    return sorted(artifactList, key=lambda artifact: artifactSizes.get(artifact) or 0, reverse=True)
 
-def fetchArtifactLists(urlToMAList, outputDir, checksumMode, threadnum):
+
+def fetchArtifactLists(urlToMAList, outputDir, checksumMode, threadnum, engine=DownloadEngine.threadpool,
+                       maxThreads=None, journal=None, maxHostThreads=None, copyThreads=None,
+                       progressInterval=None, statusFile=None, prometheusFile=None, order=DownloadOrder.listed,
+                       throughputFile=None):
     """
-    Fetch lists of artifacts each list from its repository.
+    Fetch lists of artifacts each list from its repository. With the queue engine all repositories are fetched at
+    once through a single scheduler, which runs at most threadnum downloads per server and at most maxThreads
+    downloads in total, so a slow server does not hold back the others. If maxHostThreads is given, the number
+    of downloads per server starts at threadnum and adapts to the responses of the server up to maxHostThreads.
+    Artifacts from file:// repositories are copied by copyThreads threads (defaults to threadnum) in parallel.
+    If progressInterval is given, the progress is logged each progressInterval seconds and written to statusFile
+    and prometheusFile if they are given. If throughputFile is given, download rates of the servers are stored there
+    for estimates of next builds.
+    If a journal is given, the plan and each finished file are recorded in it, so an interrupted build can be resumed.
+    With the size order the biggest files of each repository are started first.
+
+    :returns: number of errors which occurred while fetching the files
     """
-    for repoUrl in urlToMAList.keys():
-        artifacts = urlToMAList[repoUrl]
-        fetchArtifactList(repoUrl, outputDir, artifacts, checksumMode, threadnum)
+    if journal is not None and journal.plan is None:
+        # the plan records the resolved snapshot versions
+        resolveSnapshotVersions(urlToMAList, threadnum)
+        journal.writePlan(urlToMAList)
+
+    limiter = None
+    if engine == DownloadEngine.queue and maxHostThreads:
+        limiter = AdaptiveHostLimiter(threadnum, maxHostThreads)
+
+    reporter = None
+    if progressInterval or throughputFile:
+        # the reporter measures the download rates even if the progress is not reported
+        totalFiles = sum(len(artifacts) for artifacts in urlToMAList.values())
+        reporter = ProgressReporter(totalFiles, progressInterval, statusFile, prometheusFile,
+                                    lambda: _getProgressStats(limiter))
+        maven_repo_util.setProgressReporter(reporter)
+        if progressInterval:
+            reporter.start()
+
+    if engine == DownloadEngine.queue:
+        copyThreads = copyThreads or threadnum
+        localRepos = [repoUrl for repoUrl in urlToMAList.keys() if repoUrl.startswith('file://')]
+        hosts = set(urlparse.urlparse(repoUrl)[1] for repoUrl in urlToMAList.keys() if repoUrl not in localRepos)
+        if limiter is not None:
+            maven_repo_util.getConnectionPool().addListener(limiter.responseReceived)
+        maxThreads = maxThreads or max((maxHostThreads or threadnum) * len(hosts) + (copyThreads if localRepos else 0),
+                                       1)
+        scheduler = DownloadScheduler(maxThreads, threadnum, limiter=limiter,
+                                      breaker=maven_repo_util.getRetryPolicy().breaker)
+        scheduler.setHostLimit(LOCAL_HOST, copyThreads)
+        maven_repo_util.configureChecksumDownloads(scheduler.workers)
+        maven_repo_util.configureRangeDownloads(scheduler.workers, maxHostThreads or threadnum)
+        errors = Queue()
+
+        # submit artifacts of each repository in a separate thread, so a full queue of one server does not block
+        # submitting to the others
+        feeders = []
+        for repoUrl in urlToMAList.keys():
+            feeder = threading.Thread(target=_feedArtifactList, name="Feeder-%d" % (len(feeders) + 1),
+                                      args=[repoUrl, outputDir, urlToMAList[repoUrl], checksumMode, threadnum,
+                                            engine, scheduler, errors, journal, copyThreads, order])
+            feeder.start()
+            feeders.append(feeder)
+        for feeder in feeders:
+            feeder.join()
+
+        scheduler.close()
+        scheduler.join()
+
+        if limiter is not None:
+            maven_repo_util.getConnectionPool().removeListener(limiter.responseReceived)
+            for (host, stats) in sorted(limiter.getStats().items()):
+                logging.info("Concurrent downloads from %s: final %d, peak %d, decreased %d times", host,
+                             stats["limit"], stats["peak"], stats["decreases"])
+
+        errorCount = errors.qsize()
+        if errorCount:
+            logging.error("During fetching files %i error(s) occurred.", errorCount)
+    else:
+        maven_repo_util.configureChecksumDownloads(threadnum)
+        maven_repo_util.configureRangeDownloads(threadnum, threadnum)
+        errorCount = 0
+        for repoUrl in urlToMAList.keys():
+            artifacts = urlToMAList[repoUrl]
+            errorCount += fetchArtifactList(repoUrl, outputDir, artifacts, checksumMode, threadnum, engine,
+                                            journal=journal, copyThreads=copyThreads, order=order)
+
+    if journal is not None:
+        journal.close()
+
+    if reporter is not None:
+        if progressInterval:
+            reporter.stop()
+        maven_repo_util.setProgressReporter(None)
+        if throughputFile:
+            _saveThroughput(throughputFile, reporter.getHostRates())
+
+    poolStats = maven_repo_util.getConnectionPool().getStats()
+    logging.info("HTTP connections opened: %d, reused: %d", poolStats["new"], poolStats["reused"])
+    retryPolicy = maven_repo_util.getRetryPolicy()
+    logging.info("HTTP requests: %d, retried: %d, circuit breaker trips: %d", retryPolicy.requests,
+                 retryPolicy.retried, retryPolicy.breaker.trips)
+    diskSpaceGuard = maven_repo_util.getDiskSpaceGuard()
+    if diskSpaceGuard is not None and diskSpaceGuard.waited:
+        logging.warning("Downloads waiting for free space in %s: %d", diskSpaceGuard.path, diskSpaceGuard.waited)
+    writeBehind = maven_repo_util.getWriteBehind()
+    if writeBehind is not None:
+        logging.info("Downloads waited for disk writes %d times", writeBehind.waits)
+    store = maven_repo_util.getArtifactStore()
+    if store is not None:
+        logging.info("Artifact store hits: %d, misses: %d", store.hits, store.misses)
+    httpCache = maven_repo_util.getHttpCache()
+    if httpCache is not None:
+        logging.info("Revalidated files not modified: %d, downloaded again: %d", httpCache.notModified,
+                     httpCache.modified)
+        httpCache.save()
+    return errorCount
@@ -12,6 +12,7 @@ from subprocess import Popen
 from subprocess import PIPE
 import requests
 
+import hedged_lookup
 import maven_repo_util
 from maven_artifact import MavenArtifact
 import time
@@ -45,7 +46,7 @@ class ArtifactListBuilder:
                                  "zip:scm-sources", "zip:source-release"])
 
     IGNORED_REPOSITORY_FILES = set(["maven-metadata.xml", "maven-metadata.xml.md5", "maven-metadata.xml.sha1",
-                                    "maven-metadata.xml.sha256"])
+                                    "maven-metadata.xml.sha256", "maven-metadata.xml.sha512"])
 
     MAX_THREADS_DICT = {"mead-tag": 2, "dependency-list": 1, "dependency-graph": 6, "repository": 2}
 
@@ -304,7 +305,18 @@ class ArtifactListBuilder:
             pomFilename = 'poms/' + artifact.getPomFilename()
             successPomUrl = None
             fetched = False
-            for repoUrl in repoUrls:
+            candidateUrls = repoUrls
+            tracker = maven_repo_util.getLatencyTracker()
+            if tracker is not None and len(repoUrls) > 1:
+                # find the pom in the fastest mirror and download it from there first, the other mirrors are tried
+                # only when the download fails, if no mirror answered the HEAD request, all are tried in order, because
+                # some mirrors reject HEAD or answer it by a redirect
+                winningUrl = hedged_lookup.findFirst(
+                    repoUrls, lambda url: maven_repo_util.urlExists(maven_repo_util.slashAtTheEnd(url)
+                                                                    + artifact.getPomFilepath()), tracker)
+                if winningUrl:
+                    candidateUrls = [winningUrl] + [repoUrl for repoUrl in repoUrls if repoUrl != winningUrl]
+            for repoUrl in candidateUrls:
                 pomUrl = maven_repo_util.slashAtTheEnd(repoUrl) + artifact.getPomFilepath()
                 fetched = maven_repo_util.fetchFile(pomUrl, pomFilename)
                 if fetched:
@@ -646,8 +658,9 @@ class ArtifactListBuilder:
 
         # ^./(groupId)/(artifactId)/(version)/(filename)$
         regexGAVF = re.compile(r'\./(.+)/([^/]+)/([^/]+)/([^/]+\.[^/.]+)$')
-        gavExtClass = {}  # { (g,a,v): {ext: set([class])} }
-        suffixes = {}     # { (g,a,v): suffix }
+        gavExtClass = {}   # { (g,a,v): {ext: set([class])} }
+        suffixes = {}      # { (g,a,v): suffix }
+        gavFilenames = {}  # { (g,a,v): [filename] }
         for line in out.split('\n'):
             if (line):
                 line = "./" + prefix + line[2:]
@@ -667,13 +680,15 @@ class ArtifactListBuilder:
 
                     gavExtClass.setdefault(gav, {})
                     self._updateExtensionsAndClassifiers(gavExtClass[gav], extsAndClass, classifiersFilter.get(gav))
+                    gavFilenames.setdefault(gav, []).append(filename)
 
                     if suffix is not None and (gav not in suffixes or suffixes[gav] < suffix):
                         suffixes[gav] = suffix
 
         artifacts = {}
         for gav in gavExtClass:
-            self._addArtifact(artifacts, gav[0], gav[1], gav[2], gavExtClass[gav], suffixes.get(gav), repoUrl)
+            self._addArtifact(artifacts, gav[0], gav[1], gav[2], gavExtClass[gav], suffixes.get(gav), repoUrl,
+                              self._getListedFiles(gavFilenames[gav]))
         return artifacts
 
     def _listIndyRepository(self, repoUrl, classifiersFilter, prefix=""):
@@ -697,8 +712,9 @@ class ArtifactListBuilder:
 
         # ^/(groupId)/(artifactId)/(version)/(filename)$
         regexGAVF = re.compile(r'/(.+)/([^/]+)/([^/]+)/([^/]+\.[^/.]+)$')
-        gavExtClass = {}  # { (g,a,v): {ext: set([class])} }
-        suffixes = {}     # { (g,a,v): suffix }
+        gavExtClass = {}   # { (g,a,v): {ext: set([class])} }
+        suffixes = {}      # { (g,a,v): suffix }
+        gavFilenames = {}  # { (g,a,v): [filename] }
 
         listings = out.get('listingUrls')
         # logging.debug(listings)
@@ -733,13 +749,15 @@ class ArtifactListBuilder:
 
                     gavExtClass.setdefault(gav, {})
                     self._updateExtensionsAndClassifiers(gavExtClass[gav], extsAndClass, classifiersFilter.get(gav))
+                    gavFilenames.setdefault(gav, []).append(filename)
 
                     if suffix is not None and (gav not in suffixes or suffixes[gav] < suffix):
                         suffixes[gav] = suffix
 
         artifacts = {}
         for gav in gavExtClass:
-            self._addArtifact(artifacts, gav[0], gav[1], gav[2], gavExtClass[gav], suffixes.get(gav), repoUrl)
+            self._addArtifact(artifacts, gav[0], gav[1], gav[2], gavExtClass[gav], suffixes.get(gav), repoUrl,
+                              self._getListedFiles(gavFilenames[gav]))
         return artifacts
 
     def _listLocalRepository(self, directoryPath, prefix=""):
@@ -773,7 +791,16 @@ class ArtifactListBuilder:
                     (extsAndClass, suffix) = self._getExtensionsAndClassifiers(artifactId, version, filteredFilenames)
 
                     url = "file://" + directoryPath
-                    self._addArtifact(artifacts, groupId, artifactId, version, extsAndClass, suffix, url)
+                    sizes = {}
+                    for filename in filteredFilenames:
+                        try:
+                            sizes[filename] = os.path.getsize(os.path.join(dirname, filename))
+                        except OSError as err:
+                            # e.g. a broken symlink or a file removed while listing, its size stays unknown
+                            logging.debug("Unable to get size of %s: %s", os.path.join(dirname, filename), str(err))
+                            sizes[filename] = None
+                    self._addArtifact(artifacts, groupId, artifactId, version, extsAndClass, suffix, url,
+                                      self._getListedFiles(filteredFilenames, sizes))
 
         return artifacts
 
@@ -782,7 +809,7 @@ class ArtifactListBuilder:
         av = self._getArtifactVersionREString(artifactId, version)
         # artifactId-(version)-(classifier).(extension)
         #                          (classifier)   (   extension   )
-        checksumRegEx = re.compile(av + ".+\.(md5|sha1|sha256|asc)$")
+        checksumRegEx = re.compile(av + ".+\.(md5|sha1|sha256|sha512|asc)$")
         ceRegEx1 = re.compile(av + "(?:-(.+))?\.(tar\.[^.]+)$")
         ceRegEx2 = re.compile(av + "(?:-(.+))?\.([^.]+)$")
 
@@ -813,7 +840,26 @@ class ArtifactListBuilder:
                         suffix = realVersion
         return (extensions, suffix)
 
-    def _addArtifact(self, artifacts, groupId, artifactId, version, extsAndClass, suffix, url):
+    def _getListedFiles(self, filenames, sizes=None):
+        """
+        Pairs files found by a listing of a GAV directory with their checksum files.
+
+        :param filenames: names of the listed files
+        :param sizes: dictionary with sizes of the files if the listing provides them
+        :returns: dictionary { filename: (size or None, set([checksum type])) } without the checksum files
+        """
+        checksumTypes = {}
+        for filename in filenames:
+            (baseFilename, ext) = os.path.splitext(filename)
+            if ext[1:] in maven_repo_util.CHECKSUM_LENGTHS:
+                checksumTypes.setdefault(baseFilename, set()).add(ext[1:])
+        listedFiles = {}
+        for filename in filenames:
+            if os.path.splitext(filename)[1][1:] not in maven_repo_util.CHECKSUM_LENGTHS:
+                listedFiles[filename] = ((sizes or {}).get(filename), checksumTypes.get(filename, set()))
+        return listedFiles
+
+    def _addArtifact(self, artifacts, groupId, artifactId, version, extsAndClass, suffix, url, listedFiles=None):
         pomMain = True
         # The pom is main only if no other main artifact is available
         if len(extsAndClass) > 1 and self._containsMainArtifact(extsAndClass) and "pom" in extsAndClass:
@@ -834,9 +880,9 @@ class ArtifactListBuilder:
         if suffix is not None:
             mavenArtifact.snapshotVersionSuffix = suffix
         if mavenArtifact in artifacts:
-            artifacts[mavenArtifact].merge(ArtifactSpec(url, artTypes))
+            artifacts[mavenArtifact].merge(ArtifactSpec(url, artTypes, listedFiles))
         else:
-            artifacts[mavenArtifact] = ArtifactSpec(url, artTypes)
+            artifacts[mavenArtifact] = ArtifactSpec(url, artTypes, listedFiles)
 
     def _containsMainArtifact(self, extsAndClass):
         """
@@ -904,8 +950,20 @@ class ArtifactListBuilder:
         """
         def findArtifact(gav, urls, artifacts):
             artifact = MavenArtifact.createFromGAV(gav)
+            gavExists = maven_repo_util.gavExists
+            tracker = maven_repo_util.getLatencyTracker()
+            if tracker is not None and len(urls) > 1:
+                # race the mirrors for the GAV directory, the slower metadata lookup is done one by one below
+                url = hedged_lookup.findFirst(
+                    urls, lambda url: maven_repo_util.urlExists(maven_repo_util.slashAtTheEnd(url)
+                                                                + artifact.getDirPath()), tracker)
+                if url:
+                    artifacts[artifact] = ArtifactSpec(url, [ArtifactType(artifact.artifactType, True, set(['']))])
+                    return
+                # the GAV directories were checked in all mirrors by the race
+                gavExists = maven_repo_util.gavExistsInMetadata
             for url in urls:
-                if maven_repo_util.gavExists(url, artifact):
+                if gavExists(url, artifact):
                     #Critical section?
                     artifacts[artifact] = ArtifactSpec(url, [ArtifactType(artifact.artifactType, True, set(['']))])
                     return
@@ -980,7 +1038,7 @@ class ArtifactListBuilder:
                         artType = ArtifactType(ext, main, classifiers)
                         artTypes[ext] = artType
                 if extContainsMain:
-                    artSpecToAdd = ArtifactSpec(artSpec.url, artTypes)
+                    artSpecToAdd = ArtifactSpec(artSpec.url, artTypes, artSpec.listedFiles)
                     includedArtifacts[artifact] = artSpecToAdd
         else:
             regExps = maven_repo_util.getRegExpsFromStrings(gavPatterns)
@@ -1020,17 +1078,21 @@ class ArtifactListBuilder:
 class ArtifactSpec():
     """
     Specification of artifact location and contents. The artTypes is a dictionary with type as a key and an
-    ArtifactType instance as a value. It is automatically created if the provided value is a list.
+    ArtifactType instance as a value. It is automatically created if the provided value is a list. When the artifact
+    was found by a repository listing, listedFiles contain files of its directory with their sizes and checksum types.
     """
 
-    def __init__(self, url, artTypes):
+    def __init__(self, url, artTypes, listedFiles=None):
         """
         Constructor.
 
         :param url: repository URL in which the artifact was found
         :param artTypes: dict or list of ArtifactType instances
+        :param listedFiles: dictionary { filename: (size or None, set([checksum type])) } or None if the artifact
+                            was not listed
         """
         self.url = url
+        self.listedFiles = listedFiles
         if type(artTypes) is dict:
             self.artTypes = artTypes
         else:
@@ -1050,6 +1112,10 @@ class ArtifactSpec():
 
         self.artTypes.update(other.artTypes)
         self.paths.extend(other.paths)
+        if other.listedFiles is not None:
+            if self.listedFiles is None:
+                self.listedFiles = {}
+            self.listedFiles.update(other.listedFiles)
 
     def add_path(self, path):
         """
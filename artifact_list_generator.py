@@ -30,6 +30,15 @@ def main():
         default=5,
         help='Number of download threads per server when downloading artifacts. Default is 5, max is 20.'
     )
+    cliOptParser.add_option(
+        '--hedge',
+        type="int",
+        default=None,
+        metavar='PERCENTILE',
+        help='Enables hedged lookups in sources with several repository URLs. When a repository does not answer '
+             'within the given percentile of its latencies, e.g. 95, the lookup is sent to the next repository '
+             'as well and the first one which finds the artifact wins. Lookups are done one by one by default.'
+    )
     cliOptParser.add_option(
         '-x', '--excludedtypes',
         default='zip:ear:war:tar:gz:tar.gz:bz2:tar.bz2:7z:tar.7z',
@@ -79,6 +88,7 @@ def main():
 
     # Set the log level
     maven_repo_util.setLogLevel(options.loglevel, options.logfile)
+    maven_repo_util.configureHedging(options.hedge)
 
     artifactList = _generateArtifactList(options, args)
 
@@ -111,6 +121,7 @@ def generateArtifactList(options, args):
                         else:
                             gatcv = "%s:%s:%s" % (ga, artType, version)
                         artifact = MavenArtifact.createFromGAV(gatcv)
+                        artifact.listedFiles = artSpec.listedFiles
                         urlToMAList.setdefault(url, []).append(artifact)
     return urlToMAList
 
@@ -0,0 +1,212 @@
+"""artifact_store.py: Local content-addressable store of downloaded files shared by builds running on one host"""
+
+import errno
+import fcntl
+import logging
+import os
+import tempfile
+import time
+from multiprocessing import Lock
+
+from file_util import LinkMode
+import file_util
+
+
+class ArtifactStore:
+    """
+    Store of downloaded files keyed by their SHA1 checksum. Files found in the store are placed into an output
+    repository as reflinks or copies instead of being downloaded again. By default they are never hardlinked in either
+    direction, so the store does not share inodes with output repositories and evicted files really free space. Files
+    are added atomically, so several builds can use the same store at once. When the store grows over its size limit,
+    the least recently used files are evicted. Usage time of a file is kept in modification time of its marker file.
+
+    In the hardlink mode files are hardlinked into and out of the store when they cannot be cloned. Output repositories
+    then share inodes, permissions and timestamps with the store, so their files must be treated as read-only, because
+    modifying one of them corrupts the stored file for all builds. Evicting a file still linked from an output
+    repository frees no space.
+    """
+
+    # suffix of empty marker files keeping the last usage time of stored files
+    USED_SUFFIX = ".used"
+
+    # ways of placing files into and out of the store
+    PLACE_MODES = (LinkMode.reflink, LinkMode.sendfile, LinkMode.copy)
+
+    # ways of placing files in the hardlink mode
+    HARDLINK_PLACE_MODES = (LinkMode.reflink, LinkMode.hardlink, LinkMode.sendfile, LinkMode.copy)
+
+    # when the store is over its limit, files are evicted until it is under this fraction of the limit
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, rootDir, maxSize=None, linkMode=LinkMode.reflink):
+        """
+        Constructor.
+
+        :param rootDir: directory of the store, it is created if it does not exist
+        :param maxSize: maximal size of the store in bytes, None for no limit
+        :param linkMode: LinkMode.reflink to never share inodes with output repositories or LinkMode.hardlink
+                         to hardlink files into and out of the store
+        """
+        self.rootDir = rootDir
+        self.maxSize = maxSize
+        if linkMode == LinkMode.hardlink:
+            self.placeModes = self.HARDLINK_PLACE_MODES
+        else:
+            self.placeModes = self.PLACE_MODES
+        self.hits = 0
+        self.misses = 0
+        self._objectsDir = os.path.join(rootDir, "objects")
+        self._tmpDir = os.path.join(rootDir, "tmp")
+        self._lockPath = os.path.join(rootDir, "store.lock")
+        self._lock = Lock()
+        self._size = None
+        for directory in (self._objectsDir, self._tmpDir):
+            try:
+                os.makedirs(directory)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+    def getPath(self, sha1):
+        """Returns path of the file with given SHA1 checksum in the store."""
+        return os.path.join(self._objectsDir, sha1[:2], sha1)
+
+    def materialize(self, sha1, targetPath):
+        """
+        Places the file with the given SHA1 checksum at target path if it is present in the store.
+
+        :param sha1: SHA1 checksum of the requested file
+        :param targetPath: path where the file should be placed, it must not exist
+        :returns: True if the file was found in the store and placed, False otherwise
+        """
+        storePath = self.getPath(sha1)
+        try:
+            mode = file_util.placeFile(storePath, targetPath, self.placeModes)
+            self._markUsed(storePath)
+        except (IOError, OSError) as err:
+            if err.errno != errno.ENOENT:
+                logging.warning("Unable to take %s from artifact store: %s", sha1, str(err))
+            self._count(False)
+            return False
+        logging.debug("Artifact store hit for %s, placed %s as %s", sha1, targetPath, mode)
+        self._count(True)
+        return True
+
+    def add(self, filePath, sha1):
+        """
+        Adds a copy of the given verified file into the store unless a file with the same checksum is already there.
+
+        :param filePath: path of the file
+        :param sha1: SHA1 checksum of the file
+        """
+        storePath = self.getPath(sha1)
+        if os.path.exists(storePath):
+            return
+        try:
+            (fd, tmpPath) = tempfile.mkstemp(dir=self._tmpDir)
+            os.close(fd)
+            os.remove(tmpPath)
+            file_util.placeFile(filePath, tmpPath, self.placeModes)
+            directory = os.path.dirname(storePath)
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError as err:
+                    if err.errno != errno.EEXIST:
+                        raise
+            os.rename(tmpPath, storePath)
+            self._markUsed(storePath)
+        except (IOError, OSError) as err:
+            logging.warning("Unable to add %s to artifact store: %s", filePath, str(err))
+            return
+
+        self._lock.acquire()
+        try:
+            if self._size is not None:
+                self._size += os.path.getsize(storePath)
+            overLimit = self.maxSize is not None and (self._size is None or self._size > self.maxSize)
+        finally:
+            self._lock.release()
+        if overLimit:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used files until the store is under its size limit. Eviction is guarded by a file
+        lock, so only one build evicts at a time.
+        """
+        with open(self._lockPath, 'a') as lockFile:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+            try:
+                files = []
+                size = 0
+                for (dirname, _, filenames) in os.walk(self._objectsDir):
+                    for filename in filenames:
+                        if filename.endswith(self.USED_SUFFIX):
+                            continue
+                        path = os.path.join(dirname, filename)
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        try:
+                            usageTime = os.path.getmtime(path + self.USED_SUFFIX)
+                        except OSError:
+                            usageTime = stat.st_mtime
+                        files.append((usageTime, stat.st_size, path))
+                        size += stat.st_size
+
+                if self.maxSize is not None and size > self.maxSize:
+                    target = self.maxSize * self.EVICTION_TARGET
+                    evicted = 0
+                    for (_, fileSize, path) in sorted(files):
+                        if size <= target:
+                            break
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            continue
+                        try:
+                            os.remove(path + self.USED_SUFFIX)
+                        except OSError:
+                            pass
+                        size -= fileSize
+                        evicted += 1
+                    logging.info("Evicted %d files from artifact store %s, current size is %d bytes", evicted,
+                                 self.rootDir, size)
+                self._removeStaleTmpFiles()
+            finally:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+        self._lock.acquire()
+        try:
+            self._size = size
+        finally:
+            self._lock.release()
+
+    def _markUsed(self, storePath):
+        """Sets usage time of the stored file to now."""
+        with open(storePath + self.USED_SUFFIX, 'a'):
+            pass
+        os.utime(storePath + self.USED_SUFFIX, None)
+
+    def _removeStaleTmpFiles(self, maxAge=24 * 3600):
+        """Removes temporary files left by builds, which were killed while adding a file."""
+        now = time.time()
+        for filename in os.listdir(self._tmpDir):
+            path = os.path.join(self._tmpDir, filename)
+            try:
+                if now - os.path.getmtime(path) > maxAge:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def _count(self, hit):
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
@@ -0,0 +1,89 @@
+"""bandwidth_limiter.py: Token-bucket limits of download rate per server and in total"""
+
+import time
+from multiprocessing import Lock
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at a constant rate of bytes per second. Consuming more bytes than available puts the bucket
+    into debt and the caller sleeps until the debt would be repaid, so concurrent callers share the rate fairly
+    and none of them sleeps while holding the lock.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Constructor.
+
+        :param rate: number of bytes per second
+        :param burst: maximal number of bytes which can be consumed at once after a period of inactivity, defaults
+                      to the rate, i.e. one second worth of data
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self._tokens = self.burst
+        self._lastRefill = time.time()
+        self._lock = Lock()
+
+    def reserve(self, amount):
+        """
+        Takes the given number of bytes from the bucket.
+
+        :returns: number of seconds the caller has to wait before using the bytes
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._lastRefill) * self.rate)
+            self._lastRefill = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+        finally:
+            self._lock.release()
+
+
+class BandwidthLimiter:
+    """
+    Limits the rate of downloaded data per server and in total. Each host gets its own token bucket, all of them
+    share the global one. The limits apply to bytes, not to requests, so many small files can be downloaded at once
+    while the total throughput stays under the limit.
+    """
+
+    def __init__(self, globalRate=None, hostRate=None):
+        """
+        Constructor.
+
+        :param globalRate: maximal number of bytes per second downloaded from all servers, None for no limit
+        :param hostRate: maximal number of bytes per second downloaded from a single server, None for no limit
+        """
+        self.globalRate = globalRate
+        self.hostRate = hostRate
+        self._globalBucket = TokenBucket(globalRate) if globalRate else None
+        self._hostBuckets = {}
+        self._lock = Lock()
+
+    def consume(self, host, amount):
+        """
+        Waits until the given number of bytes downloaded from the host fits into the limits.
+
+        :param host: host (with port) the data were downloaded from
+        :param amount: number of bytes
+        """
+        delay = 0
+        if self._globalBucket is not None:
+            delay = self._globalBucket.reserve(amount)
+        if self.hostRate:
+            delay = max(delay, self._getHostBucket(host).reserve(amount))
+        if delay > 0:
+            time.sleep(delay)
+
+    def _getHostBucket(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self._hostBuckets:
+                self._hostBuckets[host] = TokenBucket(self.hostRate)
+            return self._hostBuckets[host]
+        finally:
+            self._lock.release()
@@ -0,0 +1,97 @@
+"""build_planner.py: Sizing of a build before anything is downloaded"""
+
+import logging
+import os
+import urlparse
+
+import artifact_downloader
+import maven_repo_util
+from artifact_downloader import LOCAL_HOST
+
+
+def planBuild(urlToMAList, outputDir, threadnum, throughputStats=None):
+    """
+    Collects sizes of all files of a build without downloading them. Snapshot versions are resolved first, so sizes
+    of the actual snapshot files are collected. Sizes found by repository listings are used, sizes of other remote
+    files are requested by HEAD requests sent by threadnum threads per repository through the shared connection pool
+    and sizes of files in file:// repositories are read from the file system. Files already present in the output
+    directory are not fetched again, so they are only counted.
+
+    :param urlToMAList: artifact list in the form {repoUrl: [MavenArtifact]}
+    :param outputDir: the output repository directory
+    :param threadnum: number of threads requesting sizes from a repository
+    :param throughputStats: ThroughputStats with rates measured by previous builds or None
+    :returns: dictionary { host: {"files": ..., "present": ..., "unknown": ..., "bytes": ..., "rate": ...,
+              "duration": ...} }, where unknown is the number of files whose size could not be found out and rate
+              and duration are None if no rate of the host was measured yet
+    """
+    # the files of snapshot artifacts are known only after their versions are resolved
+    artifact_downloader.resolveSnapshotVersions(urlToMAList, threadnum)
+
+    plan = {}
+    for repoUrl in urlToMAList.keys():
+        artifacts = urlToMAList[repoUrl]
+        url = repoUrl.replace('indy://', 'http://').replace('indys://', 'https://')
+        if maven_repo_util.urlProtocol(url) == 'file':
+            host = LOCAL_HOST
+        else:
+            host = urlparse.urlparse(url)[1]
+        logging.info('Collecting sizes of %d files in repository: %s', len(artifacts), url)
+        maven_repo_util.addListedFiles(url, artifacts)
+
+        missingArtifacts = [artifact for artifact in artifacts
+                            if not os.path.exists(os.path.join(outputDir, artifact.getArtifactFilepath()))]
+        sizes = maven_repo_util.getFileSizes([maven_repo_util.slashAtTheEnd(url) + artifact.getArtifactFilepath()
+                                              for artifact in missingArtifacts], threadnum)
+
+        hostPlan = plan.setdefault(host, {"files": 0, "present": 0, "unknown": 0, "bytes": 0})
+        hostPlan["files"] += len(missingArtifacts)
+        hostPlan["present"] += len(artifacts) - len(missingArtifacts)
+        for size in sizes:
+            if size is None:
+                hostPlan["unknown"] += 1
+            else:
+                hostPlan["bytes"] += size
+
+    for (host, hostPlan) in plan.items():
+        rate = throughputStats.getRate(host) if throughputStats is not None else None
+        hostPlan["rate"] = rate
+        hostPlan["duration"] = hostPlan["bytes"] / rate if rate else None
+    return plan
+
+
+def logPlan(plan, parallelHosts):
+    """
+    Logs the plan of a build with totals and an estimated duration.
+
+    :param plan: plan returned by planBuild
+    :param parallelHosts: True if the servers are downloaded from at the same time (queue engine), False if one
+                          after another
+    """
+    totalFiles = sum(hostPlan["files"] for hostPlan in plan.values())
+    totalBytes = sum(hostPlan["bytes"] for hostPlan in plan.values())
+    logging.info("Build plan: %d files to fetch (%d already present), %.1f MB in total", totalFiles,
+                 sum(hostPlan["present"] for hostPlan in plan.values()), totalBytes / 1000000.0)
+
+    durations = []
+    unmeasured = []
+    for (host, hostPlan) in sorted(plan.items()):
+        if hostPlan["duration"] is not None:
+            estimate = "%.2f MB/s, about %d s" % (hostPlan["rate"] / 1000000.0, hostPlan["duration"])
+            durations.append(hostPlan["duration"])
+        elif host == LOCAL_HOST:
+            estimate = "copied locally"
+        else:
+            estimate = "throughput not measured yet"
+            unmeasured.append(host)
+        logging.info("  %s: %d files, %.1f MB, %d of unknown size, %s", host, hostPlan["files"],
+                     hostPlan["bytes"] / 1000000.0, hostPlan["unknown"], estimate)
+
+    if durations:
+        duration = max(durations) if parallelHosts else sum(durations)
+        logging.info("Estimated download time: %d s%s", duration,
+                     " plus downloads from %s" % ", ".join(unmeasured) if unmeasured else "")
+    else:
+        logging.info("Download time cannot be estimated, no throughput of the servers was measured by previous "
+                     "builds yet.")
+
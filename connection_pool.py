@@ -0,0 +1,284 @@
+"""connection_pool.py: Pool of persistent HTTP connections shared by all download threads"""
+
+import httplib
+import logging
+import socket
+import time
+import urllib
+import urlparse
+from multiprocessing import Lock
+
+
+class ConnectionPool:
+    """
+    Pool of keep-alive HTTP(S) connections grouped by scheme and host. A connection is borrowed for a single request
+    and it is returned back to the pool once the response body is completely read, so the next request to the same
+    host (artifact, its checksums, next artifact...) does not need a new TCP and TLS handshake. The pool is thread-safe
+    and it is meant to be shared by all download threads.
+    """
+
+    USER_AGENT = "Python-Maven Repository Builder"
+
+    REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+    MAX_REDIRECTS = 10
+
+    def __init__(self, maxSize=5, idleTimeout=30, timeout=None):
+        """
+        Constructor.
+
+        :param maxSize: maximal number of idle connections kept open per host
+        :param idleTimeout: number of seconds after which an idle connection is closed instead of being reused
+        :param timeout: socket timeout in seconds, None to use the global default
+        """
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self.timeout = timeout
+        self.newConnections = 0
+        self.reusedConnections = 0
+        self.activeConnections = 0
+        self._idle = {}  # { (scheme, netloc): [(connection, lastUsedTime)] }
+        self._listeners = []
+        self._lock = Lock()
+
+    def request(self, method, url, headers=None, followRedirects=True):
+        """
+        Sends a request using a pooled connection and returns the response. The response has to be read completely
+        or closed, otherwise its connection is not released.
+
+        :param method: HTTP method
+        :param url: requested URL (http or https)
+        :param headers: dictionary with additional request headers
+        :param followRedirects: if True, redirects are followed automatically
+        :returns: PooledResponse instance
+        """
+        # listeners are notified with the requested host also for the redirected requests, so limits and latencies
+        # of a repository are kept under the host used to schedule its downloads
+        host = urlparse.urlsplit(url).netloc
+        redirects = 0
+        while True:
+            response = self._request(method, url, headers, host)
+            location = response.getheader("Location")
+            if not followRedirects or response.status not in self.REDIRECT_CODES or not location:
+                return response
+
+            response.close()
+            redirects += 1
+            if redirects > self.MAX_REDIRECTS:
+                raise httplib.HTTPException("Too many redirects while requesting %s" % url)
+            url = urlparse.urljoin(url, location)
+            if response.status == 303:
+                method = "GET"
+            logging.debug("Following redirect to %s", url)
+
+    def addListener(self, listener):
+        """
+        Registers a function called after each request with the requested host (before any redirects), the response
+        status (None when no response was received) and the number of seconds until the response headers arrived.
+        """
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Unregisters a function registered by addListener."""
+        self._listeners.remove(listener)
+
+    def getStats(self):
+        """
+        Returns counters of connections opened by the pool.
+
+        :returns: dictionary with numbers of "new" and "reused" connections, of "active" connections borrowed from
+                  the pool and of "idle" connections kept in the pool
+        """
+        self._lock.acquire()
+        try:
+            idle = sum(len(connections) for connections in self._idle.values())
+            return {"new": self.newConnections, "reused": self.reusedConnections, "active": self.activeConnections,
+                    "idle": idle}
+        finally:
+            self._lock.release()
+
+    def closeAll(self):
+        """Closes all idle connections in the pool."""
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+        for connections in idle.values():
+            for (connection, _) in connections:
+                connection.close()
+
+    def _request(self, method, url, headers, host):
+        parsedUrl = urlparse.urlsplit(url)
+        key = (parsedUrl.scheme, parsedUrl.netloc)
+        (connection, reused) = self._acquire(key)
+        if parsedUrl.scheme == "http" and self._getProxy(parsedUrl.scheme, parsedUrl.netloc):
+            # plain http requests through a proxy use the absolute url
+            path = urlparse.urlunsplit((parsedUrl.scheme, parsedUrl.netloc, parsedUrl.path or "/", parsedUrl.query, ""))
+        else:
+            path = urlparse.urlunsplit(("", "", parsedUrl.path or "/", parsedUrl.query, ""))
+
+        requestHeaders = {"User-Agent": self.USER_AGENT}
+        if headers:
+            requestHeaders.update(headers)
+
+        while True:
+            start = time.time()
+            try:
+                connection.request(method, path, headers=requestHeaders)
+                response = connection.getresponse()
+                self._notify(host, response.status, time.time() - start)
+                return PooledResponse(self, key, connection, response, url, method)
+            except (httplib.HTTPException, socket.error):
+                self._discard(connection)
+                if not reused:
+                    self._notify(host, None, time.time() - start)
+                    raise
+                # the server has probably closed the idle connection in the meantime, try a new one
+                logging.debug("Reused connection to %s failed, opening a new one", parsedUrl.netloc)
+                (connection, reused) = self._acquire(key)
+
+    def _notify(self, host, status, latency):
+        for listener in self._listeners:
+            listener(host, status, latency)
+
+    def _acquire(self, key):
+        """Takes an idle connection for the given host from the pool or creates a new one."""
+        self._lock.acquire()
+        try:
+            connections = self._idle.get(key, [])
+            now = time.time()
+            while connections:
+                (connection, lastUsed) = connections.pop()
+                if now - lastUsed <= self.idleTimeout:
+                    self.reusedConnections += 1
+                    self.activeConnections += 1
+                    return (connection, True)
+                connection.close()
+            self.newConnections += 1
+            self.activeConnections += 1
+        finally:
+            self._lock.release()
+        try:
+            return (self._createConnection(key), False)
+        except BaseException:
+            self._lock.acquire()
+            try:
+                self.activeConnections -= 1
+            finally:
+                self._lock.release()
+            raise
+
+    def _release(self, key, connection):
+        """Returns a connection with no pending response back to the pool."""
+        self._lock.acquire()
+        try:
+            self.activeConnections -= 1
+            connections = self._idle.setdefault(key, [])
+            if len(connections) < self.maxSize:
+                connections.append((connection, time.time()))
+                return
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def _discard(self, connection):
+        """Closes a borrowed connection, which cannot be reused."""
+        self._lock.acquire()
+        try:
+            self.activeConnections -= 1
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def _createConnection(self, key):
+        (scheme, netloc) = key
+        proxy = self._getProxy(scheme, netloc)
+        if scheme == "https":
+            if proxy:
+                connection = httplib.HTTPSConnection(proxy, timeout=self.timeout)
+                (host, port) = urllib.splitport(netloc)
+                connection.set_tunnel(host, int(port) if port else None)
+            else:
+                connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        elif scheme == "http":
+            if proxy:
+                connection = httplib.HTTPConnection(proxy, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+        else:
+            raise ValueError("Unsupported protocol %s" % scheme)
+        logging.debug("Opening new %s connection to %s", scheme.upper(), netloc)
+        return connection
+
+    def _getProxy(self, scheme, netloc):
+        """Returns host:port of a proxy configured in environment for the given scheme and host or None."""
+        proxyUrl = urllib.getproxies().get(scheme)
+        if not proxyUrl or urllib.proxy_bypass(urllib.splitport(netloc)[0]):
+            return None
+        return urlparse.urlsplit(proxyUrl).netloc or proxyUrl
+
+
+class PooledResponse:
+    """
+    HTTP response read from a pooled connection. It provides the file-like interface of responses returned by
+    urllib2.urlopen. The connection is released to the pool when the body is read to the end or the response is closed.
+    """
+
+    def __init__(self, pool, key, connection, response, url, method):
+        self._pool = pool
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._released = False
+        self.url = url
+        self.code = response.status
+        self.status = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        if method == "HEAD":
+            self._finish()
+
+    def read(self, amt=None):
+        if self._released:
+            return ""
+        data = self._response.read(amt)
+        if not data or self._response.isclosed():
+            self._finish()
+        return data
+
+    def info(self):
+        return self._response.msg
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        """
+        Closes the response. Unread body of a small response is read to keep the connection usable, otherwise the
+        connection is closed.
+        """
+        if self._released:
+            return
+        length = self._response.length
+        if length is not None and length <= 64 * 1024:
+            try:
+                self._response.read()
+            except (httplib.HTTPException, socket.error):
+                pass
+        self._finish()
+
+    def _finish(self):
+        self._released = True
+        if not self._response.isclosed() and self._response.length == 0:
+            # responses without body (HEAD, 304...) are closed only after they are read
+            self._response.read()
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool._release(self._key, self._connection)
+        else:
+            self._response.close()
+            self._pool._discard(self._connection)
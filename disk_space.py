@@ -0,0 +1,132 @@
+"""disk_space.py: Admission of downloads by free space of the output file system"""
+
+import errno
+import logging
+import os
+import threading
+
+
+class DiskSpaceGuard:
+    """
+    Admits a download only when free space of the file system with the output directory covers its size plus
+    a headroom. Sizes of running downloads are reserved until their files are preallocated or the downloads finish,
+    so parallel downloads cannot overcommit the space together. When the space runs low, downloads wait for
+    the running ones to finish (or for the space to be freed by someone else); when nothing is running and the space
+    still does not suffice, the download fails before writing anything.
+    """
+
+    # number of seconds between checks of the free space while downloads wait for it
+    CHECK_INTERVAL = 5.0
+
+    def __init__(self, path, headroom=0):
+        """
+        Constructor.
+
+        :param path: path in the guarded file system, it does not need to exist yet
+        :param headroom: number of bytes which have to stay free
+        """
+        self.path = path
+        self.headroom = headroom
+        self.waited = 0
+        self._reserved = 0
+        self._running = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+    def getFreeSpace(self):
+        """Returns number of bytes available to unprivileged users in the guarded file system."""
+        path = os.path.abspath(self.path)
+        while not os.path.exists(path):
+            path = os.path.dirname(path)
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+
+    def reserve(self, size):
+        """
+        Waits until there is enough free space for a file of the given size and reserves it. Each successful call has
+        to be followed by release of the returned reservation.
+
+        :param size: size of the file in bytes, 0 if it is not known
+        :returns: Reservation of the space
+        :raises: IOError with errno ENOSPC when there is not enough space and no other download is running
+        """
+        waiting = False
+        self._condition.acquire()
+        try:
+            while True:
+                available = self.getFreeSpace() - self._reserved - self.headroom
+                if available >= size:
+                    self._reserved += size
+                    self._running += 1
+                    return Reservation(self, size)
+                if not self._running:
+                    raise IOError(errno.ENOSPC, "Not enough free space for %d bytes in %s, %d bytes available above "
+                                  "the headroom" % (size, self.path, max(available, 0)))
+                if not waiting:
+                    if not self._waiting:
+                        logging.warning("Free space in %s is running low, pausing downloads until %d running ones "
+                                        "finish", self.path, self._running)
+                    waiting = True
+                    self.waited += 1
+                    self._waiting += 1
+                self._condition.wait(self.CHECK_INTERVAL)
+        finally:
+            if waiting:
+                self._waiting -= 1
+            self._condition.release()
+
+    def _extend(self, reservation, size):
+        self._condition.acquire()
+        try:
+            if self.getFreeSpace() - self._reserved - self.headroom < size:
+                return False
+            self._reserved += size
+            reservation.size += size
+            return True
+        finally:
+            self._condition.release()
+
+    def _unreserve(self, size, finished):
+        self._condition.acquire()
+        try:
+            self._reserved -= size
+            if finished:
+                self._running -= 1
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+
+class Reservation:
+    """
+    Space reserved for a download by DiskSpaceGuard. Bytes allocated on disk are already missing in the free space,
+    so they are given back to the guard right away instead of being counted twice until the download finishes.
+    """
+
+    def __init__(self, guard, size):
+        self._guard = guard
+        self.size = size
+        self._released = False
+
+    def extend(self, size):
+        """
+        Reserves more bytes for a download bigger than expected if they are free right now. It never waits, so it can
+        be called while a connection is open.
+
+        :returns: True if the bytes were reserved, False if there is not enough free space
+        """
+        return self._guard._extend(self, size)
+
+    def allocated(self, size):
+        """Gives back the given number of reserved bytes, which were allocated in the file system."""
+        size = min(size, self.size)
+        self.size -= size
+        self._guard._unreserve(size, False)
+
+    def release(self):
+        """Releases the rest of the space when the download finished. Next calls do nothing."""
+        if self._released:
+            return
+        self._released = True
+        self._guard._unreserve(self.size, True)
+        self.size = 0
@@ -0,0 +1,158 @@
+"""download_journal.py: Crash-safe journal of a build allowing to resume interrupted downloads"""
+
+import json
+import logging
+import os
+import time
+from multiprocessing import Lock
+
+from maven_artifact import MavenArtifact
+
+
+class DownloadJournal:
+    """
+    Append-only journal of a build. The first record contains the plan, i.e. the artifact list with repository URLs,
+    each following record contains a path of a file, which was fetched and verified. Records are kept in memory and
+    written at most once per SYNC_INTERVAL seconds after the recorded files (and their directories) are synced to
+    disk, so after a crash the journal never refers to a file which was not written completely. A torn last record
+    is ignored when the journal is loaded.
+    """
+
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, filename, plan=None, done=None):
+        """
+        Constructor. Use DownloadJournal.load to read an existing journal.
+
+        :param filename: path of the journal file
+        :param plan: loaded artifact list in the form {repoUrl: [MavenArtifact]}, None for a new journal
+        :param done: set of recorded relative paths of finished files
+        """
+        self.filename = filename
+        self.plan = plan
+        # the plan of a resumed build is fetched as it was recorded
+        self.resumed = plan is not None
+        self.done = done or set()
+        self._lock = Lock()
+        self._pendingFiles = []
+        self._pendingRecords = []
+        self._lastSync = time.time()
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._file = open(filename, 'a' if plan is not None else 'w')
+        if plan is not None and self._file.tell() > 0:
+            # terminate a torn last record, so it does not swallow the next one
+            with open(filename, 'r') as journalFile:
+                journalFile.seek(-1, os.SEEK_END)
+                if journalFile.read(1) != "\n":
+                    self._file.write("\n")
+
+    @staticmethod
+    def load(filename):
+        """
+        Loads the journal from the given file.
+
+        :param filename: path of the journal file
+        :returns: DownloadJournal instance ready to be appended to or None if there is no journal with a plan
+        """
+        if not os.path.exists(filename):
+            return None
+        plan = None
+        done = set()
+        with open(filename, 'r') as journalFile:
+            for line in journalFile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.debug("Skipping incomplete journal record: %s", line.strip())
+                    continue
+                if "plan" in record:
+                    plan = {}
+                    for (repoUrl, artifacts) in record["plan"].iteritems():
+                        plan[repoUrl] = []
+                        for (gatcv, suffix) in artifacts:
+                            artifact = MavenArtifact.createFromGAV(gatcv)
+                            if suffix:
+                                artifact.snapshotVersionSuffix = suffix
+                            plan[repoUrl].append(artifact)
+                elif "done" in record:
+                    done.add(record["done"])
+        if plan is None:
+            return None
+        logging.info("Loaded journal %s with %d finished files", filename, len(done))
+        return DownloadJournal(filename, plan, done)
+
+    def writePlan(self, urlToMAList):
+        """
+        Records the artifact list to fetch.
+
+        :param urlToMAList: dictionary with repository URL as key and list of MavenArtifact instances as value
+        """
+        plan = {}
+        for (repoUrl, artifacts) in urlToMAList.iteritems():
+            plan[repoUrl] = [(artifact.getGATCV(), artifact.snapshotVersionSuffix) for artifact in artifacts]
+        self._lock.acquire()
+        try:
+            self.plan = urlToMAList
+            self._file.write(json.dumps({"plan": plan}) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        finally:
+            self._lock.release()
+
+    def isDone(self, relativePath):
+        """Checks if the file with given path relative to the output directory was recorded as finished."""
+        return relativePath in self.done
+
+    def markDone(self, relativePath, localPath):
+        """
+        Records a fetched and verified file.
+
+        :param relativePath: path of the file relative to the output directory
+        :param localPath: actual path of the file, it is synced to disk before the record is written
+        """
+        self._lock.acquire()
+        try:
+            self.done.add(relativePath)
+            self._pendingFiles.append(localPath)
+            self._pendingRecords.append(json.dumps({"done": relativePath}) + "\n")
+            if time.time() - self._lastSync >= self.SYNC_INTERVAL:
+                self._sync()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Syncs all records to disk and closes the journal."""
+        self._lock.acquire()
+        try:
+            if not self._file.closed:
+                self._sync()
+                self._file.close()
+        finally:
+            self._lock.release()
+
+    def remove(self):
+        """Closes and removes the journal after the build finished successfully."""
+        self.close()
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def _sync(self):
+        """Syncs recorded files to disk, then writes their records and syncs the journal. Must be called locked."""
+        directories = set(os.path.dirname(os.path.abspath(path)) for path in self._pendingFiles)
+        for path in self._pendingFiles + sorted(directories):
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as err:
+                logging.debug("Unable to sync %s: %s", path, str(err))
+        self._pendingFiles = []
+        self._file.write("".join(self._pendingRecords))
+        self._pendingRecords = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lastSync = time.time()
@@ -0,0 +1,208 @@
+"""download_scheduler.py: Bounded work queues running download tasks from many servers in lightweight threads"""
+
+import logging
+import threading
+from collections import deque
+
+
+class DownloadScheduler:
+    """
+    Runs download tasks in a fixed set of worker threads. It has the same interface as ThreadPool (apply_async, close,
+    join), but the submitting thread blocks when the queue is full, so the memory stays bounded no matter how many
+    artifacts are submitted, and the workers use small stacks, so hundreds of requests waiting on the network can be
+    in flight at once.
+
+    Tasks can be submitted with a host they download from. Each host has its own queue and a limit of tasks running
+    at once and the workers take tasks from the hosts in round-robin order, so one slow server does not block
+    the others, while the total number of running tasks is limited by the number of workers. The per-host limit is
+    either fixed or given by a limiter adapting it to the responses of the host. Hosts paused by a circuit breaker
+    are skipped until the breaker lets requests through again.
+    """
+
+    MAX_WORKERS = 500
+
+    WORKER_STACK_SIZE = 512 * 1024
+
+    # seconds after which waiting workers check again whether a paused host was resumed
+    PAUSE_CHECK_INTERVAL = 1.0
+
+    def __init__(self, workers, hostWorkers=None, queueSize=None, limiter=None, breaker=None):
+        """
+        Constructor.
+
+        :param workers: number of worker threads, i.e. maximal number of tasks running at once
+        :param hostWorkers: maximal number of tasks for a single host running at once, defaults to the number of
+                            workers
+        :param queueSize: maximal number of tasks waiting for a free worker per host, defaults to twice the number
+                          of workers
+        :param limiter: object with method getLimit(host) returning current limit of the host, it overrides
+                        hostWorkers; if it has method addListener(listener), the scheduler registers there to be
+                        notified when a limit grows
+        :param breaker: object with method isOpen(host) returning True while the host is paused
+        """
+        self.workers = min(workers, self.MAX_WORKERS)
+        self.hostWorkers = hostWorkers or self.workers
+        self.queueSize = queueSize or self.workers * 2
+        self.limiter = limiter
+        self.breaker = breaker
+        self._hostLimits = {}  # { host: fixed limit overriding hostWorkers and the limiter }
+        self._lock = threading.Lock()
+        self._taskReady = threading.Condition(self._lock)
+        self._spaceReady = threading.Condition(self._lock)
+        self._queues = {}   # { host: deque([(func, args)]) }
+        self._running = {}  # { host: number of running tasks }
+        self._hosts = []    # hosts in round-robin order
+        self._nextHost = 0
+        self._threads = []
+        self._closed = False
+        if limiter is not None and hasattr(limiter, "addListener"):
+            limiter.addListener(self.hostLimitIncreased)
+
+    def apply_async(self, func, args=(), host=None):
+        """
+        Submits a task. It blocks while the queue of waiting tasks for the host is full.
+
+        :param func: function to call
+        :param args: list of arguments of the function
+        :param host: host the task downloads from
+        """
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise ValueError("Scheduler is closed")
+            if not self._threads:
+                self._startWorkers()
+            if host not in self._queues:
+                self._queues[host] = deque()
+                self._running[host] = 0
+                self._hosts.append(host)
+            while len(self._queues[host]) >= self.queueSize:
+                self._spaceReady.wait()
+            self._queues[host].append((func, args))
+            self._taskReady.notify()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Prevents any more tasks from being submitted. Workers exit once all submitted tasks are done."""
+        self._lock.acquire()
+        try:
+            self._closed = True
+            self._taskReady.notify_all()
+        finally:
+            self._lock.release()
+
+    def join(self):
+        """Waits for the worker threads to finish. The close method must be called before."""
+        for thread in self._threads:
+            thread.join()
+
+    def setHostLimit(self, host, limit):
+        """Sets a fixed maximal number of tasks for the given host running at once."""
+        self._lock.acquire()
+        try:
+            self._hostLimits[host] = limit
+            self._taskReady.notify_all()
+        finally:
+            self._lock.release()
+
+    def hostLimitIncreased(self, host, limit):
+        """Wakes up the waiting workers after the limit of the given host grew, so they start its waiting tasks."""
+        self._lock.acquire()
+        try:
+            self._taskReady.notify_all()
+        finally:
+            self._lock.release()
+
+    def getHostLimit(self, host):
+        """Returns maximal number of tasks for the given host running at once."""
+        if host in self._hostLimits:
+            return min(self._hostLimits[host], self.workers)
+        if self.limiter is not None:
+            return min(self.limiter.getLimit(host), self.workers)
+        return self.hostWorkers
+
+    def _startWorkers(self):
+        oldStackSize = threading.stack_size(self.WORKER_STACK_SIZE)
+        try:
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name="Downloader-%d" % (i + 1))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        finally:
+            threading.stack_size(oldStackSize)
+
+    def _findRunnableHost(self):
+        """
+        Finds next host in round-robin order which has a waiting task and a free slot. Must be called locked.
+
+        :returns: index of the host in the list of hosts or None if there is no such host (the host itself can be None)
+        """
+        for i in range(len(self._hosts)):
+            index = (self._nextHost + i) % len(self._hosts)
+            host = self._hosts[index]
+            if self._isHostRunnable(host):
+                self._nextHost = index + 1
+                return index
+        return None
+
+    def _hasRunnableHost(self):
+        """Checks if any host has a waiting task and a free slot. Must be called locked."""
+        for host in self._hosts:
+            if self._isHostRunnable(host):
+                return True
+        return False
+
+    def _isHostRunnable(self, host):
+        return (bool(self._queues[host]) and self._running[host] < self.getHostLimit(host)
+                and not self._isHostPaused(host))
+
+    def _isHostPaused(self, host):
+        return self.breaker is not None and self.breaker.isOpen(host)
+
+    def _takeTask(self):
+        """Waits for a runnable task and takes it. Returns None when the scheduler is closed and all tasks are taken."""
+        self._lock.acquire()
+        try:
+            while True:
+                index = self._findRunnableHost()
+                if index is not None:
+                    host = self._hosts[index]
+                    (func, args) = self._queues[host].popleft()
+                    self._running[host] += 1
+                    self._spaceReady.notify_all()
+                    if self._hasRunnableHost():
+                        # a limit may have grown while the workers were waiting, wake up another one
+                        self._taskReady.notify()
+                    return (host, func, args)
+                if self._closed and not any(self._queues.values()):
+                    self._taskReady.notify_all()
+                    return None
+                if any(self._queues[host] and self._isHostPaused(host) for host in self._hosts):
+                    self._taskReady.wait(self.PAUSE_CHECK_INTERVAL)
+                else:
+                    self._taskReady.wait()
+        finally:
+            self._lock.release()
+
+    def _taskDone(self, host):
+        self._lock.acquire()
+        try:
+            self._running[host] -= 1
+            self._taskReady.notify()
+        finally:
+            self._lock.release()
+
+    def _work(self):
+        while True:
+            task = self._takeTask()
+            if task is None:
+                break
+            (host, func, args) = task
+            try:
+                func(*args)
+            except BaseException as ex:
+                logging.exception("Unexpected error in download task: %s", str(ex))
+            finally:
+                self._taskDone(host)
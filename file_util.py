@@ -0,0 +1,141 @@
+"""file_util.py: Helpers for placing files on the local file system without copying their data where possible"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import os
+import shutil
+
+
+# ioctl request cloning a whole file on file systems supporting reflinks (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# maximal number of bytes transferred by a single sendfile call on Linux
+SENDFILE_MAX_CHUNK = 0x7ffff000
+
+# fallocate mode allocating disk space without changing the file size
+FALLOC_FL_KEEP_SIZE = 0x01
+
+_libc = None
+
+
+class LinkMode:
+    reflink = 'reflink'
+    hardlink = 'hardlink'
+    sendfile = 'sendfile'
+    copy = 'copy'
+
+
+def reflinkFile(source, target):
+    """
+    Creates target as a copy-on-write clone of source. Data are shared until one of the files is modified.
+
+    :raises: IOError or OSError when the file system does not support reflinks or the files are not on the same one
+    """
+    with open(source, 'rb') as sourceFile:
+        with open(target, 'wb') as targetFile:
+            try:
+                fcntl.ioctl(targetFile.fileno(), FICLONE, sourceFile.fileno())
+            except (IOError, OSError):
+                targetFile.close()
+                os.remove(target)
+                raise
+
+
+def sendfileCopy(source, target):
+    """
+    Copies source to target by the sendfile system call, so the data are copied by the kernel without passing through
+    user space buffers.
+
+    :raises: OSError with errno ENOSYS when sendfile is not available
+    """
+    sendfile = _getSendfile()
+    with open(source, 'rb') as sourceFile:
+        with open(target, 'wb') as targetFile:
+            remaining = os.fstat(sourceFile.fileno()).st_size
+            while remaining > 0:
+                sent = sendfile(targetFile.fileno(), sourceFile.fileno(), None, min(remaining, SENDFILE_MAX_CHUNK))
+                if sent < 0:
+                    err = ctypes.get_errno()
+                    targetFile.close()
+                    os.remove(target)
+                    raise OSError(err, os.strerror(err))
+                if sent == 0:
+                    break
+                remaining -= sent
+
+
+def preallocate(fileobj, size):
+    """
+    Allocates disk space for the given number of bytes of an open file without changing its size, so the file system
+    can place the file in as few extents as possible. Nothing is done where fallocate is not supported.
+
+    :param fileobj: file object opened for writing
+    :param size: expected size of the file in bytes
+    :returns: True if the space was allocated, False if fallocate is not supported
+    :raises: IOError with errno ENOSPC when there is not enough space for the file
+    """
+    fallocate = _getLibcFunction("fallocate64", [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong],
+                                 ctypes.c_int)
+    if fallocate is None:
+        return False
+    if fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        err = ctypes.get_errno()
+        if err in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            return False
+        raise IOError(err, os.strerror(err), fileobj.name)
+    return True
+
+
+def _getSendfile():
+    sendfile = _getLibcFunction("sendfile", [ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t],
+                                ctypes.c_ssize_t)
+    if sendfile is None:
+        raise OSError(errno.ENOSYS, "sendfile is not available")
+    return sendfile
+
+
+def _getLibcFunction(name, argtypes, restype):
+    """Returns the function of the C library with the given prototype or None if it is not available."""
+    global _libc
+    if _libc is None:
+        libcName = ctypes.util.find_library("c")
+        _libc = ctypes.CDLL(libcName, use_errno=True) if libcName else False
+    if not _libc or not hasattr(_libc, name):
+        return None
+    function = getattr(_libc, name)
+    function.argtypes = argtypes
+    function.restype = restype
+    return function
+
+
+def placeFile(source, target, modes=(LinkMode.reflink, LinkMode.hardlink, LinkMode.copy)):
+    """
+    Places a file with the same contents as source at target path, which must not exist. The modes are tried
+    in the given order until one succeeds.
+
+    :param source: path of the source file
+    :param target: path of the created file
+    :param modes: sequence of LinkMode values to try
+    :returns: the mode which was used
+    """
+    lastError = None
+    for mode in modes:
+        try:
+            if mode == LinkMode.reflink:
+                reflinkFile(source, target)
+            elif mode == LinkMode.hardlink:
+                os.link(source, target)
+            elif mode == LinkMode.sendfile:
+                sendfileCopy(source, target)
+            else:
+                shutil.copyfile(source, target)
+            return mode
+        except (IOError, OSError) as err:
+            if err.errno == errno.ENOENT:
+                raise
+            logging.debug("Unable to %s %s to %s: %s", mode, source, target, str(err))
+            lastError = err
+    raise lastError
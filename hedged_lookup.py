@@ -0,0 +1,108 @@
+"""hedged_lookup.py: Hedged lookups of a file in several mirrors of a repository"""
+
+import logging
+import threading
+import urlparse
+from collections import deque
+from Queue import Empty
+from Queue import Queue
+
+
+class LatencyTracker:
+    """
+    Keeps latencies of recent requests per host and computes the delay after which a lookup is hedged, i.e. a given
+    percentile of the latencies of the host. It is meant to be registered as a listener of the connection pool.
+    """
+
+    # number of recent latencies kept per host
+    SAMPLES = 200
+
+    # minimal number of latencies needed to compute the percentile, otherwise the default delay is used
+    MIN_SAMPLES = 10
+
+    def __init__(self, percentile=95, defaultDelay=1.0):
+        """
+        Constructor.
+
+        :param percentile: percentile of latencies used as the hedging delay
+        :param defaultDelay: hedging delay in seconds used for hosts with not enough latencies recorded
+        """
+        self.percentile = percentile
+        self.defaultDelay = defaultDelay
+        self._latencies = {}  # { host: deque([latency]) }
+        self._lock = threading.Lock()
+
+    def responseReceived(self, host, status, latency):
+        if status is None:
+            return
+        self._lock.acquire()
+        try:
+            self._latencies.setdefault(host, deque(maxlen=self.SAMPLES)).append(latency)
+        finally:
+            self._lock.release()
+
+    def getDelay(self, host):
+        """Returns number of seconds to wait for a response from the host before hedging the request."""
+        self._lock.acquire()
+        try:
+            latencies = sorted(self._latencies.get(host, ()))
+        finally:
+            self._lock.release()
+        if len(latencies) < self.MIN_SAMPLES:
+            return self.defaultDelay
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100.0))
+        return latencies[index]
+
+
+def findFirst(urls, check, tracker):
+    """
+    Finds a URL for which the check succeeds. The check of the first URL is started right away and each next URL
+    is checked when the previous one failed or did not finish within the hedging delay of its host. The first
+    successful check wins, slower checks still running are left to finish in the background.
+
+    :param urls: list of URLs in the order of preference
+    :param check: function taking URL and returning True on success
+    :param tracker: LatencyTracker providing the hedging delays
+    :returns: the winning URL or None if the check failed for all of them
+    """
+    results = Queue()
+
+    def runCheck(url):
+        try:
+            result = check(url)
+        except BaseException as ex:
+            logging.debug("Lookup in %s failed: %s", url, str(ex))
+            result = False
+        results.put((url, result))
+
+    started = 0
+    pending = 0
+    while started < len(urls) or pending:
+        if not pending:
+            delay = 0
+        elif started < len(urls):
+            delay = tracker.getDelay(urlparse.urlsplit(urls[started - 1])[1])
+        else:
+            delay = None
+        if delay == 0:
+            result = None
+        else:
+            try:
+                result = results.get(timeout=delay)
+            except Empty:
+                logging.debug("No answer from %s within %.3f s, hedging with %s", urls[started - 1], delay,
+                              urls[started])
+                result = None
+
+        if result is None:
+            thread = threading.Thread(target=runCheck, args=[urls[started]], name="Hedge-%d" % started)
+            thread.daemon = True
+            thread.start()
+            started += 1
+            pending += 1
+        else:
+            pending -= 1
+            (url, found) = result
+            if found:
+                return url
+    return None
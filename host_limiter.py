@@ -0,0 +1,119 @@
+"""host_limiter.py: Adaptive limits of concurrent downloads per server"""
+
+import logging
+import time
+from multiprocessing import Lock
+
+
+class AdaptiveHostLimiter:
+    """
+    Limits of concurrent requests per host adjusted by the AIMD (additive increase, multiplicative decrease) rule.
+    Every healthy response increases the limit of its host by 1/limit, i.e. roughly by one after each round of
+    requests, as long as the response latency stays close to the best latency seen for the host. A server error,
+    a 429 response, a timeout or a connection failure halves the limit. The limit is decreased at most once per
+    latency window, so a burst of failures of requests sent at once counts as a single congestion signal.
+    """
+
+    # status codes which mean the server is overloaded or throttling us
+    BACKOFF_CODES = (429, 500, 502, 503, 504)
+
+    # response is healthy if its latency is at most this multiple of the best latency seen (plus LATENCY_SLACK)
+    LATENCY_TOLERANCE = 2.0
+
+    # seconds added to the tolerated latency, so jitter of very fast servers is not taken for congestion
+    LATENCY_SLACK = 0.05
+
+    DECREASE_FACTOR = 0.5
+
+    MIN_DECREASE_INTERVAL = 1.0
+
+    def __init__(self, initial, maximum, minimum=1):
+        """
+        Constructor.
+
+        :param initial: limit of a host which was not seen yet
+        :param maximum: limit is never increased over this value
+        :param minimum: limit is never decreased under this value
+        """
+        self.initial = initial
+        self.maximum = maximum
+        self.minimum = minimum
+        self._lock = Lock()
+        self._hosts = {}  # { host: {"limit", "peak", "bestLatency", "lastDecrease", "decreases"} }
+        self._listeners = []
+
+    def getLimit(self, host):
+        """Returns current maximal number of concurrent requests to the given host."""
+        self._lock.acquire()
+        try:
+            return int(self._getHost(host)["limit"])
+        finally:
+            self._lock.release()
+
+    def responseReceived(self, host, status, latency):
+        """
+        Adjusts the limit of a host according to the result of a request. It is meant to be registered as a listener
+        of the connection pool.
+
+        :param host: host (with port) the request was sent to
+        :param status: HTTP status of the response, None if no response was received
+        :param latency: seconds between sending the request and receiving the response headers
+        """
+        self._lock.acquire()
+        try:
+            state = self._getHost(host)
+            oldLimit = int(state["limit"])
+            if status is None or status in self.BACKOFF_CODES:
+                now = time.time()
+                window = max(self.MIN_DECREASE_INTERVAL, state["bestLatency"] or 0)
+                if now - state["lastDecrease"] >= window:
+                    state["limit"] = max(self.minimum, state["limit"] * self.DECREASE_FACTOR)
+                    state["lastDecrease"] = now
+                    state["decreases"] += 1
+            else:
+                if state["bestLatency"] is None or latency < state["bestLatency"]:
+                    state["bestLatency"] = latency
+                if latency <= state["bestLatency"] * self.LATENCY_TOLERANCE + self.LATENCY_SLACK:
+                    state["limit"] = min(self.maximum, state["limit"] + 1.0 / state["limit"])
+                    state["peak"] = max(state["peak"], int(state["limit"]))
+            newLimit = int(state["limit"])
+        finally:
+            self._lock.release()
+
+        if newLimit < oldLimit:
+            logging.info("Decreasing concurrent downloads from %s to %d (status %s)", host, newLimit, status)
+        elif newLimit > oldLimit:
+            logging.debug("Increasing concurrent downloads from %s to %d", host, newLimit)
+            for listener in self._listeners:
+                listener(host, newLimit)
+
+    def addListener(self, listener):
+        """Registers a function called with the host and its new limit whenever the limit of a host grows."""
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Unregisters a function registered by addListener."""
+        self._listeners.remove(listener)
+
+    def getStats(self):
+        """
+        Returns state of the limits.
+
+        :returns: dictionary with host as key and dictionary with current "limit", "peak" limit and number of
+                  "decreases" as value
+        """
+        self._lock.acquire()
+        try:
+            stats = {}
+            for (host, state) in self._hosts.items():
+                stats[host] = {"limit": int(state["limit"]), "peak": state["peak"], "decreases": state["decreases"]}
+            return stats
+        finally:
+            self._lock.release()
+
+    def _getHost(self, host):
+        """Returns state of the host, which is created if the host was not seen yet. Must be called locked."""
+        if host not in self._hosts:
+            self._hosts[host] = {"limit": float(self.initial), "peak": self.initial, "bestLatency": None,
+                                 "lastDecrease": 0, "decreases": 0}
+        return self._hosts[host]
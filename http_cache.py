@@ -0,0 +1,103 @@
+"""http_cache.py: Persistent HTTP cache validators of downloaded files used for incremental rebuilds"""
+
+import email.utils
+import json
+import logging
+import os
+from multiprocessing import Lock
+
+
+class HttpCache:
+    """
+    Store of ETag and Last-Modified values of downloaded files. They are used to revalidate files which are already
+    present in the output repository by conditional requests, so a file is downloaded again only if it changed
+    on the server. The validators are loaded from and saved to a json file.
+    """
+
+    def __init__(self, filename):
+        """
+        Constructor.
+
+        :param filename: path of the json file with validators, it does not need to exist
+        """
+        self.filename = filename
+        self.notModified = 0
+        self.modified = 0
+        self._lock = Lock()
+        self._validators = {}  # { url: {"etag": ..., "last-modified": ...} }
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as cacheFile:
+                    self._validators = json.load(cacheFile)
+            except ValueError as err:
+                logging.warning("Unable to read HTTP cache validators from %s: %s", filename, str(err))
+
+    def getConditionalHeaders(self, url, filePath):
+        """
+        Returns headers of a conditional request for the given url, which was downloaded to the given path before.
+        If there are no validators stored for the url, modification time of the local file is used.
+
+        :param url: the requested url
+        :param filePath: path of the previously downloaded file
+        :returns: dictionary with request headers
+        """
+        self._lock.acquire()
+        try:
+            validators = self._validators.get(url, {})
+        finally:
+            self._lock.release()
+
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last-modified"):
+            headers["If-Modified-Since"] = validators["last-modified"]
+        if not headers:
+            headers["If-Modified-Since"] = email.utils.formatdate(os.path.getmtime(filePath), usegmt=True)
+        return headers
+
+    def update(self, url, httpResponse, changed=False):
+        """
+        Stores validators from a response with the downloaded file.
+
+        :param url: the requested url
+        :param httpResponse: response with status 200
+        :param changed: True if the file replaced its older local version
+        """
+        validators = {}
+        if httpResponse.getheader("ETag"):
+            validators["etag"] = httpResponse.getheader("ETag")
+        if httpResponse.getheader("Last-Modified"):
+            validators["last-modified"] = httpResponse.getheader("Last-Modified")
+        self._lock.acquire()
+        try:
+            if validators:
+                self._validators[url] = validators
+            else:
+                self._validators.pop(url, None)
+            if changed:
+                self.modified += 1
+        finally:
+            self._lock.release()
+
+    def markNotModified(self, url):
+        """Counts a file, which was revalidated and not downloaded again."""
+        self._lock.acquire()
+        try:
+            self.notModified += 1
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """Saves the validators to the json file. The file is replaced atomically."""
+        self._lock.acquire()
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            tmpFilename = self.filename + ".tmp"
+            with open(tmpFilename, "w") as cacheFile:
+                json.dump(self._validators, cacheFile)
+            os.rename(tmpFilename, self.filename)
+        finally:
+            self._lock.release()
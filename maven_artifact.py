@@ -13,6 +13,12 @@ class MavenArtifact:
     """
     snapshotVersionSuffix = None
 
+    """
+    Files found in the directory of the artifact by a repository listing in the form
+    { filename: (size or None, set([checksum type])) } or None if the artifact was not listed.
+    """
+    listedFiles = None
+
     gav_cache = dict()
 
     def __init__(self, groupId, artifactId, artifactType, version, classifier=''):
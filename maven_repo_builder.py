@@ -7,35 +7,89 @@ a list of artifacts and a remote repository URL.
 
 import hashlib
 import logging
+import multiprocessing
 import optparse
 import os
+import sys
+from multiprocessing.pool import ThreadPool
 
 import artifact_downloader
 import artifact_list_generator
+import build_planner
 import maven_repo_util
+from artifact_downloader import DownloadEngine
+from artifact_downloader import DownloadOrder
+from download_journal import DownloadJournal
+from download_scheduler import DownloadScheduler
+from file_util import LinkMode
 from maven_repo_util import ChecksumMode
+from maven_repo_util import MaterializeMode
+from throughput_stats import ThroughputStats
 
+# size of blocks of files read to generate checksums
+CHECKSUM_BUFFER_SIZE = 1024 * 1024
 
-def generateChecksums(localRepoDir):
-    """Generate checksums for all maven artifacts in a repository"""
+# number of checked files between progress messages of checksum generation
+CHECKSUM_PROGRESS_INTERVAL = 10000
+
+
+def generateChecksums(localRepoDir, threadnum=None):
+    """
+    Generate checksums for all maven artifacts in a repository. The repository is walked by the task handler thread
+    of a thread pool while its workers hash the files found so far. Each file is read once for all missing types.
+
+    :param localRepoDir: the repository directory
+    :param threadnum: number of hashing threads, defaults to the number of CPUs
+    """
+    pool = ThreadPool(threadnum or multiprocessing.cpu_count())
+    try:
+        generated = 0
+        for (index, generatedFile) in enumerate(pool.imap_unordered(generateChecksumFiles,
+                                                                    _walkFiles(localRepoDir), 16)):
+            if generatedFile:
+                generated += 1
+            if (index + 1) % CHECKSUM_PROGRESS_INTERVAL == 0:
+                logging.info('Checked %d files, generated missing checksums of %d', index + 1, generated)
+        logging.info('Generated missing checksums of %d files', generated)
+    finally:
+        # all tasks are done unless a file failed, then the rest is not worth waiting for
+        pool.terminate()
+
+
+def _walkFiles(localRepoDir):
     for root, dirs, files in os.walk(localRepoDir):
         for filename in files:
-            generateChecksumFiles(os.path.join(root, filename))
+            yield os.path.join(root, filename)
 
 
 def generateChecksumFiles(filepath):
-    """Generate md5 and sha1 checksums for a maven repository artifact"""
-    if os.path.splitext(filepath)[1] in ('.md5', '.sha1'):
-        return
+    """
+    Generate checksums of the configured types (md5 and sha1 by default) for a maven repository artifact
+
+    :returns: True if a checksum file was written, False otherwise
+    """
+    if os.path.splitext(filepath)[1][1:] in maven_repo_util.CHECKSUM_LENGTHS:
+        return False
     if not os.path.isfile(filepath):
-        return
-    for ext, sum_constr in (('.md5', hashlib.md5()), ('.sha1', hashlib.sha1())):
-        sumfile = filepath + ext
-        if os.path.exists(sumfile):
-            continue
-        checksum = maven_repo_util.getChecksum(filepath, sum_constr)
-        with open(sumfile, 'w') as sumobj:
-            sumobj.write(checksum)
+        return False
+    checksumTypes = [checksumType for checksumType in maven_repo_util.getChecksumTypes()
+                     if not os.path.exists(filepath + '.' + checksumType)]
+    if not checksumTypes:
+        return False
+    logging.debug('Generate %s checksums for: %s', ", ".join(checksumTypes).upper(), filepath)
+    digests = [hashlib.new(checksumType) for checksumType in checksumTypes]
+    with open(filepath, 'rb') as fobj:
+        while True:
+            # hashlib releases the GIL for big buffers, so the threads hash on all CPUs
+            content = fobj.read(CHECKSUM_BUFFER_SIZE)
+            if not content:
+                break
+            for digest in digests:
+                digest.update(content)
+    for (checksumType, digest) in zip(checksumTypes, digests):
+        with open(filepath + '.' + checksumType, 'w') as sumobj:
+            sumobj.write(digest.hexdigest())
+    return True
 
 
 def main():
@@ -81,11 +135,282 @@ def main():
              'download - download the checksums if available, if not, generate them                              '
              'check - check if downloaded and generated checksums are equal'
     )
+    cliOptParser.add_option(
+        '--checksumtypes',
+        default=','.join(maven_repo_util.CHECKSUM_TYPES),
+        help='Comma-separated list of checksum types generated, downloaded and checked for each file. Supported types '
+             'are md5, sha1, sha256 and sha512. Default is md5,sha1.'
+    )
     cliOptParser.add_option(
         '-t', '--threadnum',
         type="int",
         default=5,
-        help='Number of download threads per server when downloading artifacts. Default is 5, max is 20.'
+        help='Number of download threads per server when downloading artifacts. Default is 5, max is 20 '
+             '(%d with the queue engine).' % DownloadScheduler.MAX_WORKERS
+    )
+    cliOptParser.add_option(
+        '-e', '--engine',
+        default=DownloadEngine.threadpool,
+        choices=(DownloadEngine.threadpool, DownloadEngine.queue),
+        help='Download engine to use. Possible choices are:                                                      '
+             'threadpool - all artifacts of a repository are submitted to a pool of threads (default)           '
+             'queue - artifacts from all repositories are fed to download threads through bounded queues '
+             'per server, which keeps the memory bounded, allows hundreds of parallel downloads and lets servers '
+             'be downloaded from at the same time'
+    )
+    cliOptParser.add_option(
+        '--order',
+        default=DownloadOrder.listed,
+        choices=(DownloadOrder.listed, DownloadOrder.size),
+        help='Order in which artifacts of a repository are downloaded. Possible choices are:                          '
+             'list - in the order of the artifact list (default)                                                 '
+             'size - the biggest files first, so a long download does not run alone at the end of the build while '
+             'the small files fill the remaining threads. Sizes are requested by HEAD requests before downloading.'
+    )
+    cliOptParser.add_option(
+        '--maxthreads',
+        type="int",
+        default=None,
+        help='Maximal number of download threads in total when the queue engine is used. Defaults to the number of '
+             'threads per server multiplied by the number of servers, max is %d.' % DownloadScheduler.MAX_WORKERS
+    )
+    cliOptParser.add_option(
+        '--copythreads',
+        type="int",
+        default=None,
+        help='Number of threads copying artifacts from file:// repositories. Defaults to the number of download '
+             'threads per server, max is 20 (%d with the queue engine).' % DownloadScheduler.MAX_WORKERS
+    )
+    cliOptParser.add_option(
+        '--checksumthreads',
+        type="int",
+        default=None,
+        help='Number of threads generating missing checksums after the download. Defaults to the number of CPUs.'
+    )
+    cliOptParser.add_option(
+        '--maxhostthreads',
+        type="int",
+        default=None,
+        help='Enables adaptive number of download threads per server when the queue engine is used. The number '
+             'starts at threadnum, grows while the server responds quickly and drops on server errors, throttling '
+             'and timeouts, but it never exceeds this value.'
+    )
+    cliOptParser.add_option(
+        '--poolsize',
+        type="int",
+        default=None,
+        help='Maximal number of idle HTTP connections kept open for reuse per server. Defaults to twice the number '
+             'of download threads per server, which covers the downloads and their checksum files, or three times '
+             'with --splitthreshold, which covers further ranges of big files too.'
+    )
+    cliOptParser.add_option(
+        '--idletimeout',
+        type="int",
+        default=30,
+        help='Number of seconds after which an idle HTTP connection is not reused any more. Default is 30.'
+    )
+    cliOptParser.add_option(
+        '--timeout',
+        type="int",
+        default=60,
+        help='Number of seconds without any data after which a download is considered interrupted and it is '
+             'resumed. Default is 60.'
+    )
+    cliOptParser.add_option(
+        '--maxrate',
+        type="int",
+        default=None,
+        help='Maximal download rate from all servers in total in KiB per second. Not limited by default.'
+    )
+    cliOptParser.add_option(
+        '--maxhostrate',
+        type="int",
+        default=None,
+        help='Maximal download rate from a single server in KiB per second. Not limited by default.'
+    )
+    cliOptParser.add_option(
+        '--splitthreshold',
+        type="int",
+        default=None,
+        help='Minimal size in MB of a file to be downloaded in ranges by several connections at once, which helps with '
+             'big files from far away servers limited by the throughput of a single connection. The server has '
+             'to support range requests. Turned off by default.'
+    )
+    cliOptParser.add_option(
+        '--splitconnections',
+        type="int",
+        default=4,
+        help='Number of connections by which a file bigger than the split threshold is downloaded. Default is 4.'
+    )
+    cliOptParser.add_option(
+        '--hedge',
+        type="int",
+        default=None,
+        metavar='PERCENTILE',
+        help='Enables hedged lookups in sources with several repository URLs. When a repository does not answer '
+             'within the given percentile of its latencies, e.g. 95, the lookup is sent to the next repository '
+             'as well and the first one which finds the artifact wins. Lookups are done one by one by default.'
+    )
+    cliOptParser.add_option(
+        '--retries',
+        type="int",
+        default=3,
+        help='Maximal number of retries of a failed download. Default is 3.'
+    )
+    cliOptParser.add_option(
+        '--retrydelay',
+        type="float",
+        default=1.0,
+        help='Base delay in seconds before retrying a failed download. The delay doubles with each retry and it is '
+             'randomized. Default is 1.'
+    )
+    cliOptParser.add_option(
+        '--maxretrydelay',
+        type="float",
+        default=60.0,
+        help='Maximal delay in seconds before retrying a failed download. Default is 60.'
+    )
+    cliOptParser.add_option(
+        '--retrybudget',
+        type="float",
+        default=0.2,
+        help='Maximal number of retries in the whole build as a fraction of the number of requests, so an outage '
+             'does not multiply the load of a server. Default is 0.2.'
+    )
+    cliOptParser.add_option(
+        '--breakerthreshold',
+        type="int",
+        default=5,
+        help='Number of consecutive failed requests to a server after which downloads from it are paused, while '
+             'the other servers keep going. Default is 5.'
+    )
+    cliOptParser.add_option(
+        '--breakercooldown',
+        type="int",
+        default=30,
+        help='Number of seconds for which downloads from a failing server are paused. The pause doubles each time '
+             'the server fails again after it. Default is 30.'
+    )
+    cliOptParser.add_option(
+        '--writethreads',
+        type="int",
+        default=0,
+        help='Number of threads writing downloaded data to disk. Download threads then only hand the data over through '
+             'bounded queues, so a slow output volume does not keep network connections idle. By default the data '
+             'are written by the download threads.'
+    )
+    cliOptParser.add_option(
+        '--writebuffer',
+        type="int",
+        default=64,
+        help='Maximal number of MB of downloaded data waiting to be written by the write threads. Downloads wait when '
+             'it is full. Default is 64.'
+    )
+    cliOptParser.add_option(
+        '--minfreespace',
+        type="int",
+        default=0,
+        help='Number of MB which have to stay free in the file system of the output directory. A download starts only '
+             'when its size fits into the free space above this limit, otherwise it waits for the running downloads '
+             'to finish. Default is 0.'
+    )
+    cliOptParser.add_option(
+        '--storedir',
+        default=None,
+        help='Directory of a local artifact store shared by builds. Downloaded files are kept there under their SHA1 '
+             'checksum and later builds place them in the output repository as reflinks or copies instead of '
+             'downloading them again. No store is used by default.'
+    )
+    cliOptParser.add_option(
+        '--storelink',
+        default=LinkMode.reflink,
+        choices=(LinkMode.reflink, LinkMode.hardlink),
+        help='Way of placing files into and out of the artifact store. Possible choices are:                       '
+             'reflink - clone the files if the file system supports it, otherwise copy them (default)             '
+             'hardlink - like reflink, but hardlink the files when they cannot be cloned. Output repositories then '
+             'share the files with the store, so they must be treated as read-only, modifying one of them corrupts '
+             'the stored file for all builds. Evicted files still linked from an output repository free no space.'
+    )
+    cliOptParser.add_option(
+        '--storesize',
+        type="int",
+        default=None,
+        help='Maximal size of the artifact store in MB. The least recently used files are evicted when the store '
+             'grows bigger. No limit by default.'
+    )
+    cliOptParser.add_option(
+        '--materialize',
+        default=MaterializeMode.copy,
+        choices=(MaterializeMode.copy, MaterializeMode.reflink, MaterializeMode.link),
+        help='Way of placing artifacts from file:// repositories into the output repository. Possible choices are: '
+             'copy - copy the files and compute their checksums (default)                                          '
+             'reflink - clone the files if the file system supports it, otherwise copy them by the kernel '
+             '(sendfile)                                                                                           '
+             'link - like reflink, but hardlink the files when they cannot be cloned. The output repository then '
+             'shares the files with the source one, so they must not be modified.                                  '
+             'Checksum files of the source repository are handled as in the copy mode, the files are verified against '
+             'them in the check checksum mode.'
+    )
+    cliOptParser.add_option(
+        '--progress',
+        type="int",
+        default=0,
+        help='Number of seconds between reports of the download progress (files and bytes done, rates per server, '
+             'active connections, retries and ETA). Default is 0, which turns the reports off.'
+    )
+    cliOptParser.add_option(
+        '--statusfile',
+        default=None,
+        help='File into which the download progress is written in JSON format with each report.'
+    )
+    cliOptParser.add_option(
+        '--promfile',
+        default=None,
+        help='File into which the download progress is written in Prometheus text format with each report, e.g. '
+             'for the textfile collector of node exporter.'
+    )
+    cliOptParser.add_option(
+        '--statsfile',
+        default=None,
+        help='JSON file with download rates of the servers. Rates measured by the build are stored there, so --plan '
+             'given the same file can estimate the download time of next builds. The rates are not stored by default.'
+    )
+    cliOptParser.add_option(
+        '--incremental',
+        action='store_true',
+        default=False,
+        help='Refresh an existing output repository. Snapshot and metadata files already present there are '
+             'revalidated using stored ETag and Last-Modified values and downloaded again only if they changed.'
+    )
+    cliOptParser.add_option(
+        '--statedir',
+        default=os.path.expanduser('~/.cache/maven-repo-builder'),
+        help='Directory where persistent state of builds is kept, i.e. HTTP cache validators for the incremental '
+             'mode and the build journal for --journal. Defaults to ~/.cache/maven-repo-builder.'
+    )
+    cliOptParser.add_option(
+        '--journal',
+        action='store_true',
+        default=False,
+        help='Record the artifact list and each finished file in a build journal in the state directory, so an '
+             'interrupted build can be continued by --resume. The journal is removed when the build succeeds.'
+    )
+    cliOptParser.add_option(
+        '--resume',
+        action='store_true',
+        default=False,
+        help='Resume an interrupted build into the same output directory. The artifact list is taken from the build '
+             'journal written by a build run with --journal and files recorded there as finished are skipped. '
+             'Newly finished files are recorded in the journal too.'
+    )
+    cliOptParser.add_option(
+        '--plan',
+        action='store_true',
+        default=False,
+        help='Only plan the build without downloading anything. The artifact list is generated and filtered, sizes '
+             'of the files are requested from the servers and the number of files and bytes per server is reported '
+             'with the download time estimated from throughput of the servers measured by previous builds and '
+             'stored in --statsfile.'
     )
     cliOptParser.add_option(
         '-x', '--excludedtypes',
@@ -115,23 +440,98 @@ def main():
     )
 
     (options, args) = cliOptParser.parse_args()
+    if options.engine == DownloadEngine.queue:
+        maxThreads = DownloadScheduler.MAX_WORKERS
+    else:
+        maxThreads = 20
     if options.threadnum < 1:
         logging.warn("Thread number cannot be lower than 1. Using 1.")
         options.threadnum = 1
-    elif options.threadnum > 20:
-        logging.warn("Thread number cannot be higher than 20. Using 20.")
-        options.threadnum = 20
+    elif options.threadnum > maxThreads:
+        logging.warn("Thread number cannot be higher than %d. Using %d.", maxThreads, maxThreads)
+        options.threadnum = maxThreads
+    if options.copythreads is not None:
+        options.copythreads = min(max(options.copythreads, 1), maxThreads)
+    if options.maxhostthreads:
+        if options.engine != DownloadEngine.queue:
+            logging.warn("Adaptive number of threads per server is supported only by the queue engine.")
+            options.maxhostthreads = None
+        else:
+            options.maxhostthreads = min(max(options.maxhostthreads, options.threadnum), maxThreads)
 
     # Set the log level
     maven_repo_util.setLogLevel(options.loglevel, options.logfile)
 
-    # generate lists of artifacts from configuration and the fetch them each list from it's repo
-    artifactList = artifact_list_generator.generateArtifactList(options, args)
-    artifact_downloader.fetchArtifactLists(artifactList, options.output, options.checksummode, options.threadnum)
+    try:
+        maven_repo_util.setChecksumTypes([checksumType.strip().lower()
+                                          for checksumType in options.checksumtypes.split(',')
+                                          if checksumType.strip()])
+    except ValueError as err:
+        logging.error(str(err))
+        sys.exit(1)
+
+    # downloads from a server run at once with their checksum files and further ranges of big files, each of them
+    # needs its own connection
+    hostConnections = (options.maxhostthreads or options.threadnum) * (3 if options.splitthreshold else 2)
+    maven_repo_util.configureConnectionPool(options.poolsize or hostConnections, options.idletimeout, options.timeout)
+    maven_repo_util.configureBandwidthLimiter(options.maxrate and options.maxrate * 1024,
+                                              options.maxhostrate and options.maxhostrate * 1024)
+    maven_repo_util.configureHedging(options.hedge)
+    maven_repo_util.configureSplitDownloads(options.splitthreshold and options.splitthreshold * 1024 * 1024,
+                                            max(options.splitconnections, 1))
+    maven_repo_util.configureDiskSpaceGuard(options.output, options.minfreespace * 1024 * 1024)
+    maven_repo_util.configureWriteBehind(max(options.writethreads, 0), max(options.writebuffer, 1) * 1024 * 1024)
+    maven_repo_util.setMaterializeMode(options.materialize)
+    maven_repo_util.configureRetryPolicy(options.retries, options.retrydelay, options.maxretrydelay,
+                                         options.retrybudget, options.breakerthreshold, options.breakercooldown)
+    if options.storedir:
+        storeSize = options.storesize * 1024 * 1024 if options.storesize else None
+        maven_repo_util.configureArtifactStore(options.storedir, storeSize, options.storelink)
+    maven_repo_util.setStateBaseDir(options.statedir)
+    if options.incremental:
+        stateDir = maven_repo_util.getStateDir(options.output)
+        maven_repo_util.configureHttpCache(os.path.join(stateDir, 'http-validators.json'))
+
+    journal = None
+    journalFile = os.path.join(maven_repo_util.getStateDir(options.output), 'journal')
+    if options.resume:
+        journal = DownloadJournal.load(journalFile)
+        if journal is None:
+            logging.error('No journal of an interrupted build found in %s', journalFile)
+            sys.exit(1)
+        logging.info('Resuming build from journal %s', journalFile)
+        artifactList = journal.plan
+    else:
+        # generate lists of artifacts from configuration and the fetch them each list from it's repo
+        artifactList = artifact_list_generator.generateArtifactList(options, args)
+
+    if options.plan:
+        throughputStats = ThroughputStats(options.statsfile) if options.statsfile else None
+        plan = build_planner.planBuild(artifactList, options.output, options.threadnum, throughputStats)
+        build_planner.logPlan(plan, options.engine == DownloadEngine.queue)
+        maven_repo_util.cleanTempDir()
+        return
+
+    if options.journal and not options.resume:
+        try:
+            journal = DownloadJournal(journalFile)
+        except (IOError, OSError) as err:
+            logging.warning('Unable to create journal %s, the build will not be resumable: %s', journalFile, err)
+            journal = None
+    errorCount = artifact_downloader.fetchArtifactLists(artifactList, options.output, options.checksummode,
+                                                        options.threadnum, options.engine, options.maxthreads,
+                                                        journal, options.maxhostthreads, options.copythreads,
+                                                        options.progress, options.statusfile, options.promfile,
+                                                        options.order, options.statsfile)
 
     logging.info('Generating missing checksums...')
-    generateChecksums(options.output)
+    generateChecksums(options.output, options.checksumthreads)
     logging.info('Repository created in directory: %s', options.output)
+    if journal is not None:
+        if errorCount:
+            logging.info('Journal kept in %s, use --resume to fetch the failed files', journalFile)
+        else:
+            journal.remove()
 
     #cleanup
     maven_repo_util.cleanTempDir()
@@ -1,6 +1,7 @@
 
 """maven_repo_util.py: Common functions for dealing with a maven repository"""
 
+import errno
 import hashlib
 import httplib
 import logging
@@ -9,14 +10,96 @@ import shutil
 import urllib2
 import urlparse
 import re
+import socket
 import sys
+import threading
+from multiprocessing import Lock
+from multiprocessing.pool import ThreadPool
 from subprocess import Popen
 from subprocess import PIPE
 from xml.etree.ElementTree import ElementTree
 
+from artifact_store import ArtifactStore
+from bandwidth_limiter import BandwidthLimiter
+from connection_pool import ConnectionPool
+from disk_space import DiskSpaceGuard
+from download_scheduler import DownloadScheduler
+from file_util import LinkMode
+from hedged_lookup import LatencyTracker
+from http_cache import HttpCache
+from retry_policy import CircuitBreaker
+from retry_policy import RetryPolicy
+from single_flight import SingleFlight
+from write_behind import WriteBehind
+import file_util
+
 
 _regexGATCVS = None
 
+# suffix of files being downloaded, which are renamed to the final name only when they are complete
+PART_SUFFIX = ".part"
+
+# maximal number of resumptions of a single interrupted download
+MAX_RESUMES = 5
+
+# default types of checksums computed while files are downloaded and stored in checksum files along with them
+CHECKSUM_TYPES = ("md5", "sha1")
+
+# lengths of hex digests of all supported checksum types
+CHECKSUM_LENGTHS = {"md5": 32, "sha1": 40, "sha256": 64, "sha512": 128}
+
+# size of blocks in which files are copied
+BUFFER_SIZE = 64 * 1024
+
+# number of threads looking up artifacts of a dependency list in repositories
+MAX_THREADS = 20
+
+# minimal size of a range of a file downloaded by several connections at once
+MIN_SPLIT_SEGMENT = 8 * 1024 * 1024
+
+_connectionPool = ConnectionPool()
+
+_artifactStore = None
+
+_httpCache = None
+
+_retryPolicy = RetryPolicy()
+
+_bandwidthLimiter = None
+
+_diskSpaceGuard = None
+
+_writeBehind = None
+
+# threads downloading checksum files along with the downloaded files
+_checksumScheduler = DownloadScheduler(8)
+
+# threads downloading further ranges of files downloaded by several connections at once
+_rangeScheduler = DownloadScheduler(8)
+
+# files of at least this size are downloaded by _splitConnections connections at once, None to turn it off
+_splitThreshold = None
+_splitConnections = 4
+
+_checksumTypes = CHECKSUM_TYPES
+
+_progressReporter = None
+
+# fetches of files running at the moment keyed by the target path
+_fetches = SingleFlight()
+
+# snapshot version suffixes read from metadata { (repoUrl, GAV): suffix or None }
+_snapshotSuffixes = {}
+_snapshotSuffixLock = Lock()
+
+_latencyTracker = None
+
+# files found by repository listings { url: (size or None, set([checksum type])) }
+_listedFiles = {}
+_listedFilesLock = Lock()
+
+_stateBaseDir = os.path.expanduser("~/.cache/maven-repo-builder")
+
 
 class ChecksumMode:
     generate = 'generate'
@@ -24,7 +107,366 @@ class ChecksumMode:
     check = 'check'
 
 
-def _downloadChecksum(url, filePath, checksumType, expectedSize, retries=3):
+class MaterializeMode:
+    """Ways of placing files from file:// repositories into the output repository."""
+    copy = 'copy'
+    reflink = 'reflink'
+    link = 'link'
+
+
+_materializeMode = MaterializeMode.copy
+
+# modes of placing files tried in the given order for each materialization mode except copy
+_MATERIALIZE_LINK_MODES = {
+    MaterializeMode.reflink: (LinkMode.reflink, LinkMode.sendfile, LinkMode.copy),
+    MaterializeMode.link: (LinkMode.reflink, LinkMode.hardlink, LinkMode.sendfile, LinkMode.copy),
+}
+
+
+def getConnectionPool():
+    """Returns the HTTP connection pool shared by all downloads."""
+    return _connectionPool
+
+
+def configureConnectionPool(maxSize, idleTimeout, timeout=None):
+    """
+    Sets limits of the shared HTTP connection pool.
+
+    :param maxSize: maximal number of idle connections kept open per host
+    :param idleTimeout: number of seconds after which an idle connection is not reused any more
+    :param timeout: socket timeout in seconds after which a stalled download is considered interrupted
+    """
+    _connectionPool.maxSize = maxSize
+    _connectionPool.idleTimeout = idleTimeout
+    _connectionPool.timeout = timeout
+
+
+def getRetryPolicy():
+    """Returns the policy deciding about retries of failed downloads."""
+    return _retryPolicy
+
+
+def configureRetryPolicy(retries, delay, maxDelay, budget, breakerThreshold, breakerCooldown):
+    """
+    Sets retries of failed downloads.
+
+    :param retries: maximal number of retries of a single download
+    :param delay: base delay in seconds between retries, it grows exponentially with each retry
+    :param maxDelay: maximal delay in seconds between retries
+    :param budget: maximal number of retries as a fraction of the number of requests
+    :param breakerThreshold: number of consecutive failures of a server after which it is paused
+    :param breakerCooldown: number of seconds for which a failing server is paused
+    """
+    global _retryPolicy
+    _retryPolicy = RetryPolicy(retries, delay, maxDelay, budget, CircuitBreaker(breakerThreshold, breakerCooldown))
+
+
+def configureBandwidthLimiter(globalRate=None, hostRate=None):
+    """
+    Sets limits of the download rate.
+
+    :param globalRate: maximal number of bytes per second downloaded from all servers, None for no limit
+    :param hostRate: maximal number of bytes per second downloaded from a single server, None for no limit
+    """
+    global _bandwidthLimiter
+    if globalRate or hostRate:
+        _bandwidthLimiter = BandwidthLimiter(globalRate, hostRate)
+    else:
+        _bandwidthLimiter = None
+
+
+def configureSplitDownloads(threshold, connections):
+    """
+    Sets downloading of big files in ranges by several connections at once.
+
+    :param threshold: minimal size of a file in bytes to be downloaded in ranges, None to turn it off
+    :param connections: number of connections used to download a single file
+    """
+    global _splitThreshold, _splitConnections
+    _splitThreshold = threshold
+    _splitConnections = connections
+
+
+def getWriteBehind():
+    """Returns the pool of disk writers or None if downloaded data are written by the download threads."""
+    return _writeBehind
+
+
+def configureWriteBehind(writers, queueSize):
+    """
+    Makes downloaded data written to disk by a separate pool of writer threads.
+
+    :param writers: number of writer threads, 0 to write in the download threads
+    :param queueSize: maximal number of bytes waiting to be written
+    """
+    global _writeBehind
+    if writers:
+        _writeBehind = WriteBehind(writers, queueSize // BUFFER_SIZE)
+    else:
+        _writeBehind = None
+
+
+def configureChecksumDownloads(workers):
+    """
+    Sets the number of threads downloading checksum files of all downloads together. It should match the number
+    of download threads, so each running download can fetch about one checksum file at a time.
+
+    :param workers: number of threads
+    """
+    global _checksumScheduler
+    _checksumScheduler.close()
+    _checksumScheduler = DownloadScheduler(max(workers, 1))
+
+
+def configureRangeDownloads(workers, hostWorkers):
+    """
+    Sets the number of threads downloading further ranges of big files of all downloads together. The first range of
+    each file is downloaded by the thread of the download itself.
+
+    :param workers: number of threads
+    :param hostWorkers: maximal number of ranges downloaded from a single server at once
+    """
+    global _rangeScheduler
+    _rangeScheduler.close()
+    _rangeScheduler = DownloadScheduler(max(workers, 1), max(hostWorkers, 1))
+
+
+def getDiskSpaceGuard():
+    """Returns the guard of free space in the output file system or None if downloads are not guarded."""
+    return _diskSpaceGuard
+
+
+def configureDiskSpaceGuard(path, headroom=0):
+    """
+    Makes downloads wait for free space in the file system of the given path before they start.
+
+    :param path: the output directory
+    :param headroom: number of bytes which have to stay free
+    """
+    global _diskSpaceGuard
+    _diskSpaceGuard = DiskSpaceGuard(path, headroom)
+
+
+def getLatencyTracker():
+    """Returns tracker of request latencies used for hedged lookups or None if the lookups are not hedged."""
+    return _latencyTracker
+
+
+def configureHedging(percentile):
+    """
+    Turns on hedged lookups in sources with several repository URLs. A lookup is sent to the next URL when
+    the previous one did not answer within the given percentile of its latencies.
+
+    :param percentile: percentile of latencies after which a lookup is hedged, None to turn the hedging off
+    """
+    global _latencyTracker
+    if _latencyTracker is not None:
+        _connectionPool.removeListener(_latencyTracker.responseReceived)
+        _latencyTracker = None
+    if percentile:
+        _latencyTracker = LatencyTracker(percentile)
+        _connectionPool.addListener(_latencyTracker.responseReceived)
+
+
+def setMaterializeMode(mode):
+    """
+    Sets how files from file:// repositories are placed into the output repository. In the copy mode the files are
+    copied and their checksums are computed on the way. In the reflink mode they are cloned if the file system
+    supports it and in the link mode they can be also hardlinked, otherwise they are copied by the kernel. In both
+    link modes a file is not read at all only in the download checksum mode, when checksum files of all types are
+    found next to the source file. The default generate mode and the check mode still read every linked file to
+    compute its checksums, so does the download mode for files missing a checksum file of some type.
+
+    :param mode: one of MaterializeMode values
+    """
+    global _materializeMode
+    _materializeMode = mode
+
+
+def getProgressReporter():
+    """Returns the reporter of the build progress or None if the progress is not reported."""
+    return _progressReporter
+
+
+def setProgressReporter(reporter):
+    """Sets the reporter counting downloaded bytes, None to stop counting."""
+    global _progressReporter
+    _progressReporter = reporter
+
+
+def getChecksumTypes():
+    """Returns types of checksums, which are generated, downloaded and checked for fetched files."""
+    return _checksumTypes
+
+
+def setChecksumTypes(checksumTypes):
+    """
+    Sets types of checksums, which are generated, downloaded and checked for fetched files.
+
+    :param checksumTypes: sequence of checksum types, i.e. keys of CHECKSUM_LENGTHS
+    """
+    global _checksumTypes
+    for checksumType in checksumTypes:
+        if checksumType not in CHECKSUM_LENGTHS:
+            raise ValueError("Unsupported checksum type %s" % checksumType)
+    _checksumTypes = tuple(checksumTypes)
+
+
+def getArtifactStore():
+    """Returns the artifact store used by downloads or None if no store is used."""
+    return _artifactStore
+
+
+def configureArtifactStore(rootDir, maxSize=None, linkMode=LinkMode.reflink):
+    """
+    Sets the content-addressable store checked before downloading files.
+
+    :param rootDir: directory of the store, None to not use any store
+    :param maxSize: maximal size of the store in bytes, None for no limit
+    :param linkMode: LinkMode.hardlink to hardlink files into and out of the store, LinkMode.reflink to never do it
+    """
+    global _artifactStore
+    if rootDir:
+        _artifactStore = ArtifactStore(rootDir, maxSize, linkMode)
+    else:
+        _artifactStore = None
+
+
+def getHttpCache():
+    """Returns the store of HTTP cache validators used in incremental mode or None if the mode is off."""
+    return _httpCache
+
+
+def configureHttpCache(filename):
+    """
+    Turns on the incremental mode, in which snapshots and metadata already present in the output repository are
+    revalidated by conditional requests and downloaded again only if they changed.
+
+    :param filename: path of the json file, where the validators are stored, None to turn the mode off
+    """
+    global _httpCache
+    if filename:
+        _httpCache = HttpCache(filename)
+    else:
+        _httpCache = None
+
+
+def setStateBaseDir(baseDir):
+    """Sets the directory under which persistent state of builds is kept."""
+    global _stateBaseDir
+    _stateBaseDir = baseDir
+
+
+def getStateDir(outputDir):
+    """
+    Returns directory for persistent state of builds into the given output repository, e.g. HTTP cache validators. It
+    is kept out of the output directory, so it does not end up in the built repository.
+
+    :param outputDir: the output repository directory
+    :returns: path of the state directory ending with a slash
+    """
+    outputKey = hashlib.sha1(os.path.abspath(outputDir)).hexdigest()[:16]
+    return os.path.join(_stateBaseDir, outputKey) + "/"
+
+
+def addListedFiles(repoUrl, artifacts):
+    """
+    Records files of the given artifacts found by a listing of the repository, so their sizes are known without asking
+    the server and only their checksum files, which exist, are downloaded. It has to be called after snapshot version
+    suffixes of the artifacts are resolved.
+
+    :param repoUrl: URL of the repository
+    :param artifacts: list of MavenArtifact instances, those without listedFiles are skipped
+    """
+    repoUrl = slashAtTheEnd(repoUrl)
+    _listedFilesLock.acquire()
+    try:
+        for artifact in artifacts:
+            if artifact.listedFiles:
+                listedFile = artifact.listedFiles.get(artifact.getArtifactFilename())
+                if listedFile is not None:
+                    _listedFiles[repoUrl + artifact.getArtifactFilepath()] = listedFile
+    finally:
+        _listedFilesLock.release()
+
+
+def _getListedFile(url):
+    """
+    Returns tuple (size or None, set([checksum type])) of the file found by a listing or None if it was not listed.
+    """
+    _listedFilesLock.acquire()
+    try:
+        return _listedFiles.get(url)
+    finally:
+        _listedFilesLock.release()
+
+
+def _getListedChecksumTypes(url, checksumTypes):
+    """Leaves out checksum types, whose files were not found by the listing of the repository with the file."""
+    listedFile = _getListedFile(url)
+    if listedFile is None:
+        return checksumTypes
+    missing = [checksumType for checksumType in checksumTypes if checksumType not in listedFile[1]]
+    if missing:
+        logging.debug("Skipping %s checksums of %s not found by the repository listing", ", ".join(missing), url)
+    return [checksumType for checksumType in checksumTypes if checksumType in listedFile[1]]
+
+
+def isMutableFile(filePath):
+    """Checks if the file can change on the server under the same name, i.e. it is a snapshot or metadata file."""
+    filename = os.path.basename(filePath)
+    return "-SNAPSHOT" in filename or filename.startswith("maven-metadata")
+
+
+def _needsRevalidation(url, filePath):
+    """Checks if an already downloaded file should be revalidated against the server in the incremental mode."""
+    return _httpCache is not None and urlProtocol(url) in ('http', 'https') and isMutableFile(filePath)
+
+
+def _removeChecksumFiles(filePath):
+    for checksumType in CHECKSUM_LENGTHS:
+        if os.path.exists(filePath + "." + checksumType):
+            os.remove(filePath + "." + checksumType)
+
+
+def _replaceChecksumFiles(partPath, filePath):
+    """
+    Replaces checksum files of a revalidated file, which changed on the server, by the ones downloaded next to its
+    partial file. Old checksum files without a downloaded replacement are removed, they do not apply any more.
+    """
+    for checksumType in CHECKSUM_LENGTHS:
+        if os.path.exists(partPath + "." + checksumType):
+            os.rename(partPath + "." + checksumType, filePath + "." + checksumType)
+        elif os.path.exists(filePath + "." + checksumType):
+            os.remove(filePath + "." + checksumType)
+
+
+def _openUrl(url, headers=None):
+    """
+    Opens the given http(s) URL using a connection from the shared pool. It behaves like urllib2.urlopen, i.e. it
+    raises urllib2.HTTPError for error response codes and urllib2.URLError when the server cannot be contacted.
+
+    :param url: the URL to open
+    :param headers: dictionary with additional request headers
+    :returns: PooledResponse instance
+    """
+    host = urlparse.urlsplit(url)[1]
+    try:
+        response = _connectionPool.request("GET", url, headers)
+    except socket.error as err:
+        _retryPolicy.recordResult(host, None)
+        raise urllib2.URLError(err)
+    except httplib.HTTPException:
+        _retryPolicy.recordResult(host, None)
+        raise
+    _retryPolicy.recordResult(host, response.code)
+    if response.code >= 400:
+        response.close()
+        raise urllib2.HTTPError(response.url, response.code, response.msg, response.info(), None)
+    return response
+
+
+def _downloadChecksum(url, filePath, checksumType, expectedSize):
     """
     Download specified checksum from given url to filepath. Both these inputs include filename of the original file
     to which the checksum belongs.
@@ -33,22 +475,29 @@ def _downloadChecksum(url, filePath, checksumType, expectedSize, retries=3):
     :param filePath: local filepath where the original file is stored
     :param checksumType: the type of downloaded checksum, e.g. md5 or sha1
     :param expectedSize: expected filesize of the downloaded file
-    :param retries: number of retries when a strange error occurs or filesize doesn't match the expected one'
     """
     csDownloaded = False
-    while retries > 0 and not csDownloaded:
-        retries -= 1
+    attempt = 0
+    retryAfter = None
+    while not csDownloaded:
+        if attempt:
+            if not _retryPolicy.acquireRetry(attempt):
+                break
+            _retryPolicy.waitBeforeRetry(urlparse.urlsplit(url)[1], attempt, retryAfter)
+        attempt += 1
+        retryAfter = None
         csUrl = url + "." + checksumType.lower()
         logging.debug('Downloading %s checksum from %s', checksumType.upper(), csUrl)
         try:
-            csHttpResponse = urllib2.urlopen(urllib2.Request(csUrl))
+            csHttpResponse = _openUrl(csUrl)
             csFilePath = filePath + "." + checksumType.lower()
             with open(csFilePath, 'wb') as localfile:
-                shutil.copyfileobj(csHttpResponse, localfile)
+                # checksum files count in the bandwidth limits like the files they belong to
+                _copyAndDigest(csHttpResponse, localfile, {}, urlparse.urlsplit(csUrl)[1])
             if (csHttpResponse.code != 200):
                 logging.warning('Unable to download checksum from %s, error code: %s', csUrl, csHttpResponse.code)
-                if csHttpResponse.code / 100 != 5:  # if other than 5xx error occurs do not try again
-                    retries = 0
+                if not _retryPolicy.isRetryable(csHttpResponse.code):
+                    break
             elif not readChecksumFromFile(csFilePath, expectedSize):
                 logging.warning('Downloaded %s checksum from %s is in invalid format',
                                 checksumType.upper(), csUrl)
@@ -56,25 +505,416 @@ def _downloadChecksum(url, filePath, checksumType, expectedSize, retries=3):
             else:
                 csDownloaded = True
         except urllib2.HTTPError as err:
-                logging.warning('Unable to download checksum from %s, error code: %s', csUrl, err.code)
-                if err.code / 100 != 5:  # if other than 5xx error occurs do not try again
-                    retries = 0
+            logging.warning('Unable to download checksum from %s, error code: %s', csUrl, err.code)
+            if not _retryPolicy.isRetryable(err.code):
+                break
+            retryAfter = err.info().getheader("Retry-After")
         except urllib2.URLError as err:
             logging.warning('Unknown error while downloading checksum from %s: %s', csUrl, str(err))
     return csDownloaded
 
 
+def _startChecksumDownloads(url, filePath, checksumTypes):
+    """
+    Starts downloads of checksum files of the given types in the shared pool of checksum threads, so they run
+    concurrently with each other and with the body of the same file if it is fetched before the returned function
+    is called. The callers wait for the checksums before they return, so the checksum downloads never overlap with
+    fetching of other files by the same thread.
+
+    :returns: function which waits for the downloads to finish and returns True if all checksums were downloaded
+    """
+    results = {}
+    events = []
+    for checksumType in checksumTypes:
+        event = threading.Event()
+
+        def downloadChecksum(checksumType=checksumType, event=event):
+            try:
+                results[checksumType] = _downloadChecksum(url, filePath, checksumType,
+                                                          CHECKSUM_LENGTHS[checksumType])
+            finally:
+                event.set()
+        _checksumScheduler.apply_async(downloadChecksum, host=urlparse.urlsplit(url)[1])
+        events.append(event)
+
+    def wait():
+        for event in events:
+            event.wait()
+        return all(results.get(checksumType) for checksumType in checksumTypes)
+    return wait
+
+
+def _getExpectedSize(httpResponse, offset=0):
+    """Returns expected total size of the file downloaded by the given response or None if it is not known."""
+    contentRange = httpResponse.getheader("Content-Range")
+    if contentRange:
+        total = contentRange.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    contentLength = httpResponse.getheader("Content-Length")
+    if contentLength and contentLength.isdigit():
+        return offset + int(contentLength)
+    return None
+
+
+def _newDigests():
+    """
+    Returns dictionary with a new hash object for each of the configured checksum types. SHA1 is always included,
+    because the artifact store is keyed by it.
+    """
+    return dict((checksumType, hashlib.new(checksumType)) for checksumType in set(_checksumTypes) | set(["sha1"]))
+
+
+def _copyAndDigest(source, target, digests, host=None):
+    """
+    Copies all data from source file object to target one updating the given hash objects with them. If the data are
+    downloaded from a host, the copying is slowed down to the configured bandwidth limits and counted in the progress.
+    """
+    while True:
+        data = source.read(BUFFER_SIZE)
+        if not data:
+            break
+        if host is not None and _bandwidthLimiter is not None:
+            _bandwidthLimiter.consume(host, len(data))
+        if host is not None and _progressReporter is not None:
+            _progressReporter.addBytes(host, len(data))
+        target.write(data)
+        for digest in digests.itervalues():
+            digest.update(data)
+
+
+def _hexDigests(digests):
+    return dict((checksumType, digest.hexdigest()) for (checksumType, digest) in digests.iteritems())
+
+
+def _checkDigests(checksumBasePath, digests):
+    """
+    Checks checksums computed while fetching a file against the ones saved in corresponding checksum files if they
+    are available.
+
+    :param checksumBasePath: path to which the checksum file extensions are appended
+    :param digests: dictionary with checksum type as key and hex digest as value
+    :returns: False if a checksum does not match, True otherwise
+    """
+    for (checksumType, hexdigest) in digests.iteritems():
+        checksumFilepath = checksumBasePath + '.' + checksumType
+        if os.path.exists(checksumFilepath):
+            if readChecksumFromFile(checksumFilepath, len(hexdigest)) != hexdigest:
+                logging.debug("%s checksum of %s does not match.", checksumType.upper(), checksumBasePath)
+                return False
+            logging.debug("%s checksum of %s OK.", checksumType.upper(), checksumBasePath)
+    return True
+
+
+def _writeChecksumFiles(filePath, digests):
+    """Writes checksum files, which do not exist yet, with checksums computed while fetching the file."""
+    for (checksumType, hexdigest) in digests.iteritems():
+        if checksumType not in _checksumTypes:
+            continue
+        checksumFilepath = filePath + '.' + checksumType
+        if not os.path.exists(checksumFilepath):
+            with open(checksumFilepath, 'w') as checksumFile:
+                checksumFile.write(hexdigest)
+
+
+def _openForWriting(filePath, mode):
+    """Opens file for writing downloaded data, which are written by the disk writers if they are configured."""
+    localfile = open(filePath, mode)
+    if _writeBehind is None:
+        return localfile
+    return _writeBehind.open(localfile)
+
+
+def _fetchBody(url, httpResponse, partPath, reservation=None):
+    """
+    Streams body of the given response into a partial file computing its checksums on the way. When the connection
+    breaks or the body ends before its announced length, the download is resumed by a range request from
+    the already written size.
+
+    :param url: url of the downloaded file
+    :param httpResponse: opened response with status 200
+    :param partPath: path of the partial file
+    :param reservation: Reservation of the disk space for the file or None
+    :returns: dictionary with checksum type as key and hex digest of the body as value
+    """
+    validator = httpResponse.getheader("ETag") or httpResponse.getheader("Last-Modified")
+    expectedSize = _getExpectedSize(httpResponse)
+    connections = _getSplitConnections(httpResponse, expectedSize)
+    if connections > 1:
+        return _fetchBodySplit(url, httpResponse, partPath, expectedSize, connections, validator, reservation)
+
+    digests = _newDigests()
+    resumes = 0
+    with _openForWriting(partPath, 'wb') as localfile:
+        if expectedSize:
+            _preallocate(localfile, expectedSize, reservation)
+        while True:
+            try:
+                _copyAndDigest(httpResponse, localfile, digests, urlparse.urlsplit(url)[1])
+                httpResponse.close()
+                if expectedSize is not None and localfile.tell() < expectedSize:
+                    raise httplib.HTTPException("body ended after %d of %d bytes" % (localfile.tell(), expectedSize))
+                return _hexDigests(digests)
+            except (socket.error, httplib.HTTPException) as err:
+                httpResponse.close()
+                resumes += 1
+                if resumes > MAX_RESUMES:
+                    _raiseAsUrlError(err)
+                localfile.flush()
+                offset = localfile.tell()
+                logging.warning("Download of %s interrupted after %d bytes (%s), resuming...", url, offset,
+                                str(err) or repr(err))
+                _retryPolicy.waitBeforeRetry(urlparse.urlsplit(url)[1], resumes)
+                headers = {"Range": "bytes=%d-" % offset}
+                if validator:
+                    headers["If-Range"] = validator
+                httpResponse = _openUrl(url, headers)
+                contentRange = httpResponse.getheader("Content-Range") or ""
+                if httpResponse.code != 206 or not contentRange.startswith("bytes %d-" % offset):
+                    # the server sent the whole file again
+                    logging.debug("Server does not support resuming of %s, starting from the beginning", url)
+                    offset = 0
+                    localfile.seek(0)
+                    localfile.truncate()
+                    digests = _newDigests()
+                expectedSize = _getExpectedSize(httpResponse, offset)
+                if not offset and expectedSize:
+                    # truncating freed the preallocated space, which is not reserved by the guard any more
+                    _preallocate(localfile, expectedSize, reservation)
+
+
+def _raiseAsUrlError(err):
+    """
+    Raises the error of a broken connection as urllib2.URLError like _openUrl does, so download retries it. Other
+    errors are raised as they are. Must be called from an except block handling the error.
+    """
+    if isinstance(err, socket.error):
+        raise urllib2.URLError(err)
+    raise
+
+
+def _getSplitConnections(httpResponse, expectedSize):
+    """Returns number of connections by which the body of the given response should be downloaded."""
+    if (not _splitThreshold or expectedSize is None or expectedSize < _splitThreshold
+            or (httpResponse.getheader("Accept-Ranges") or "").lower() != "bytes"):
+        return 1
+    return max(1, min(_splitConnections, expectedSize // MIN_SPLIT_SEGMENT))
+
+
+def _fetchBodySplit(url, httpResponse, partPath, expectedSize, connections, validator, reservation=None):
+    """
+    Downloads body of the given response in ranges by several connections at once, so a big file is not limited
+    by the throughput of a single TCP stream. The first range is read from the given response, the others are
+    requested by range requests through the shared connection pool in the shared pool of range threads. Each range is written at its offset into
+    the partial file and resumed separately when its connection breaks. The checksums are computed by reading
+    the complete file.
+
+    :param url: url of the downloaded file
+    :param httpResponse: opened response with status 200
+    :param partPath: path of the partial file
+    :param expectedSize: size of the file
+    :param connections: number of ranges downloaded at once
+    :param validator: ETag or Last-Modified value of the response making sure all ranges come from the same file
+    :param reservation: Reservation of the disk space for the file or None
+    :returns: dictionary with checksum type as key and hex digest of the body as value
+    """
+    logging.debug("Downloading %s in %d ranges", url, connections)
+    with open(partPath, 'wb') as localfile:
+        _preallocate(localfile, expectedSize, reservation)
+        localfile.truncate(expectedSize)
+
+    segmentSize = (expectedSize + connections - 1) // connections
+    errors = []
+    events = []
+    for start in range(segmentSize, expectedSize, segmentSize):
+        event = threading.Event()
+
+        def fetchRange(start=start, event=event):
+            try:
+                _fetchRange(url, None, partPath, start, min(start + segmentSize, expectedSize), validator, errors)
+            finally:
+                event.set()
+        _rangeScheduler.apply_async(fetchRange, host=urlparse.urlsplit(url)[1])
+        events.append(event)
+    _fetchRange(url, httpResponse, partPath, 0, segmentSize, validator, errors)
+    for event in events:
+        event.wait()
+    if errors:
+        raise errors[0]
+    return _hexDigests(_digestFile(partPath))
+
+
+def _fetchRange(url, httpResponse, partPath, start, end, validator, errors):
+    """
+    Downloads a range of a file into its place in the partial file. Errors are put into the errors list.
+
+    :param httpResponse: response with the body starting at the range start or None to request the range
+    :param start: offset of the first byte of the range
+    :param end: offset after the last byte of the range
+    """
+    host = urlparse.urlsplit(url)[1]
+    offset = start
+    resumes = 0
+    try:
+        with _openForWriting(partPath, 'r+b') as localfile:
+            while offset < end:
+                if httpResponse is None:
+                    headers = {"Range": "bytes=%d-%d" % (offset, end - 1)}
+                    if validator:
+                        headers["If-Range"] = validator
+                    httpResponse = _openUrl(url, headers)
+                    contentRange = httpResponse.getheader("Content-Range") or ""
+                    if httpResponse.code != 206 or not contentRange.startswith("bytes %d-" % offset):
+                        # the file changed on the server or it does not support ranges, the whole download is retried
+                        raise httplib.HTTPException("server did not send range %d-%d" % (offset, end - 1))
+                localfile.seek(offset)
+                reader = _RangeReader(httpResponse, end - offset)
+                try:
+                    _copyAndDigest(reader, localfile, {}, host)
+                    httpResponse.close()
+                    httpResponse = None
+                    if reader.count < end - offset:
+                        raise httplib.HTTPException("range ended after %d of %d bytes" % (reader.count, end - offset))
+                    offset = end
+                except (socket.error, httplib.HTTPException) as err:
+                    if httpResponse is not None:
+                        httpResponse.close()
+                        httpResponse = None
+                    offset += reader.count
+                    resumes += 1
+                    if resumes > MAX_RESUMES:
+                        _raiseAsUrlError(err)
+                    logging.warning("Download of range %d-%d of %s interrupted at %d (%s), resuming...", start, end - 1,
+                                    url, offset, str(err) or repr(err))
+                    _retryPolicy.waitBeforeRetry(host, resumes)
+    except BaseException as err:
+        if httpResponse is not None:
+            httpResponse.close()
+        errors.append(err)
+
+
+class _RangeReader:
+    """File-like object reading at most the given number of bytes from a response and counting them."""
+
+    def __init__(self, source, limit):
+        self.source = source
+        self.remaining = limit
+        self.count = 0
+
+    def read(self, amt):
+        if self.remaining <= 0:
+            return ""
+        data = self.source.read(min(amt, self.remaining))
+        self.remaining -= len(data)
+        self.count += len(data)
+        return data
+
+
+def _digestFile(filePath):
+    """Returns hash objects of the configured checksum types (and SHA1) updated with contents of the file."""
+    digests = _newDigests()
+    with open(filePath, 'rb') as localFile:
+        while True:
+            data = localFile.read(BUFFER_SIZE)
+            if not data:
+                break
+            for digest in digests.itervalues():
+                digest.update(data)
+    return digests
+
+
+def _reserveSpace(size):
+    """
+    Waits for free space for a file of the given size if the disk space guard is configured. It must not be called
+    while a connection is open, the wait can take longer than the server keeps the connection.
+
+    :param size: size of the file or None if it is not known
+    :returns: Reservation of the space, which has to be passed to _releaseSpace, or None without the guard
+    """
+    if _diskSpaceGuard is None:
+        return None
+    return _diskSpaceGuard.reserve(size or 0)
+
+
+def _extendReservation(reservation, size):
+    """
+    Reserves the rest of the space for a file, which turned out bigger than its reservation, without waiting.
+
+    :returns: False if the space is not free right now, True otherwise
+    """
+    if reservation is None or size is None or size <= reservation.size:
+        return True
+    return reservation.extend(size - reservation.size)
+
+
+def _releaseSpace(reservation):
+    if reservation is not None:
+        reservation.release()
+
+
+def _preallocate(fileobj, size, reservation):
+    """Preallocates space for the file and gives the allocated bytes of the reservation back to the guard."""
+    if file_util.preallocate(fileobj, size) and reservation is not None:
+        reservation.allocated(size)
+
+
+def _fetchFromStore(url, filePath):
+    """
+    Tries to place the file from the artifact store instead of downloading it. The SHA1 checksum of the remote file
+    is downloaded next to the partial file to find the file in the store, so the store is used only in the checksum
+    modes downloading checksums. It is placed next to the file only with the file, on a miss it is left for
+    the download of the file. The other checksums are downloaded as well.
+
+    :returns: True if the file was found in the store, False otherwise
+    """
+    partPath = filePath + PART_SUFFIX
+    # checksums left by an interrupted build do not belong to the file on the server any more
+    _removeChecksumFiles(partPath)
+    if not _getListedChecksumTypes(url, ["sha1"]):
+        return False
+    if not _downloadChecksum(url, partPath, "sha1", 40):
+        _removeChecksumFiles(partPath)
+        return False
+    sha1 = readChecksumFromFile(partPath + ".sha1", 40)
+    if not _artifactStore.materialize(sha1, partPath):
+        return False
+    os.rename(partPath, filePath)
+    os.rename(partPath + ".sha1", filePath + ".sha1")
+    otherTypes = _getListedChecksumTypes(url, [checksumType for checksumType in _checksumTypes
+                                               if checksumType != "sha1"])
+    if not _startChecksumDownloads(url, filePath, otherTypes)():
+        logging.warning('No chance to download checksums to %s correctly.', filePath)
+    logging.debug('File %s taken from artifact store', filePath)
+    return True
+
+
 def download(url, filePath=None, checksumMode=ChecksumMode.check):
-    """Download the given url to a local file"""
+    """
+    Download the given url to a local file. The file is downloaded into a partial file first, which is renamed to
+    the target path only after the whole body is fetched and the checksums are verified. In the incremental mode
+    an existing snapshot or metadata file is revalidated and 304 is returned when it did not change.
+    """
     logging.debug('Attempting download: %s', url)
 
+    conditionalHeaders = None
+    partPath = None
     if filePath:
         if os.path.exists(filePath):
-            logging.debug('Local file already exists, skipping: %s', filePath)
-            return
+            if not _needsRevalidation(url, filePath):
+                logging.debug('Local file already exists, skipping: %s', filePath)
+                return
+            conditionalHeaders = _httpCache.getConditionalHeaders(url, filePath)
         localdir = os.path.dirname(filePath)
         if not os.path.exists(localdir):
             os.makedirs(localdir)
+        if (conditionalHeaders is None and _artifactStore is not None and not isMutableFile(filePath)
+                and checksumMode in (ChecksumMode.download, ChecksumMode.check)):
+            if _fetchFromStore(url, filePath):
+                return 200
+            # the SHA1 checksum downloaded for the lookup is removed with the partial file if the download fails
+            partPath = filePath + PART_SUFFIX
+        else:
+            # checksums left next to the partial file by an interrupted build do not apply any more
+            _removeChecksumFiles(filePath + PART_SUFFIX)
 
     def getFileName(url, openUrl):
         if 'Content-Disposition' in openUrl.info():
@@ -89,69 +929,128 @@ def download(url, filePath=None, checksumMode=ChecksumMode.check):
         # if no filename was found above, parse it out of the final URL.
         return os.path.basename(urlparse.urlsplit(openUrl.url)[2])
 
+    replacing = conditionalHeaders is not None
+    host = urlparse.urlsplit(url)[1]
+    listedFile = _getListedFile(url)
+    expectedSize = listedFile[0] if listedFile is not None else None
     try:
-        retries = 3
+        attempt = 0
+        retryAfter = None
         checksumsOk = False
-        while retries > 0 and not checksumsOk:
-            retries -= 1
+        repeatForSpace = False
+        while not checksumsOk:
+            if repeatForSpace:
+                # the request is only repeated with a bigger reservation
+                repeatForSpace = False
+            else:
+                if attempt:
+                    _retryPolicy.waitBeforeRetry(host, attempt, retryAfter)
+                else:
+                    _retryPolicy.waitForHost(host)
+                attempt += 1
+            retryAfter = None
+            reservation = None
             try:
-                httpResponse = urllib2.urlopen(urllib2.Request(url))
+                # the download waits for free space before its request is sent, so it holds no connection meanwhile
+                reservation = _reserveSpace(expectedSize)
+                httpResponse = _openUrl(url, conditionalHeaders)
+                if httpResponse.code == 304:
+                    httpResponse.close()
+                    logging.debug('File %s not modified, keeping %s', url, filePath)
+                    _httpCache.markNotModified(url)
+                    return httpResponse.code
                 if (httpResponse.code == 200):
                     filePath = filePath or getFileName(url, httpResponse)
-                    with open(filePath, 'wb') as localfile:
-                        shutil.copyfileobj(httpResponse, localfile)
-                    httpResponse.close()
-
+                    partPath = filePath + PART_SUFFIX
+                    # checksums are fetched next to the partial file and placed next to the file only with it, so
+                    # a failed download leaves no checksum files and a changed file keeps the old ones until it is
+                    # replaced
+                    checksumBasePath = partPath
+                    if not _extendReservation(reservation, _getExpectedSize(httpResponse)):
+                        # the file is bigger than expected, its space is waited for without the connection
+                        httpResponse.close()
+                        expectedSize = _getExpectedSize(httpResponse)
+                        repeatForSpace = True
+                        continue
+                    conditionalHeaders = None
+                    waitForChecksums = None
                     if checksumMode in (ChecksumMode.download, ChecksumMode.check):
-                        md5Downloaded = _downloadChecksum(url, filePath, "md5", 32)
-                        sha1Downloaded = _downloadChecksum(url, filePath, "sha1", 40)
-                        if not md5Downloaded or not sha1Downloaded:
-                            logging.warning('No chance to download checksums to %s correctly.', filePath)
+                        # the SHA1 checksum can be already downloaded to look up the artifact store
+                        checksumTypes = _getListedChecksumTypes(url, [
+                            checksumType for checksumType in _checksumTypes
+                            if checksumType != "sha1" or not os.path.exists(checksumBasePath + ".sha1")])
+                        waitForChecksums = _startChecksumDownloads(url, checksumBasePath, checksumTypes)
+                    try:
+                        digests = _fetchBody(url, httpResponse, partPath, reservation)
+                    finally:
+                        checksumsDownloaded = waitForChecksums is None or waitForChecksums()
+                        _releaseSpace(reservation)
+                    if not checksumsDownloaded:
+                        logging.warning('No chance to download checksums to %s correctly.', filePath)
 
                     if checksumMode == ChecksumMode.check:
-                        if checkChecksum(filePath):
+                        if _checkDigests(checksumBasePath, digests):
                             checksumsOk = True
                     else:
                         checksumsOk = True
 
                     if checksumsOk:
+                        os.rename(partPath, filePath)
+                        _replaceChecksumFiles(partPath, filePath)
+                        _writeChecksumFiles(filePath, digests)
+                        if _artifactStore is not None:
+                            _artifactStore.add(filePath, digests["sha1"])
+                        if _httpCache is not None:
+                            _httpCache.update(url, httpResponse, replacing)
                         logging.debug('Download of %s complete', filePath)
                         return httpResponse.code
-                    elif retries > 0:
+                    elif _retryPolicy.acquireRetry(attempt):
                         logging.warning('Checksum problem with %s, trying again...', url)
-                        os.remove(filePath)
-                        if os.path.exists(filePath + ".md5"):
-                            os.remove(filePath + ".md5")
-                        if os.path.exists(filePath + ".sha1"):
-                            os.remove(filePath + ".sha1")
+                        os.remove(partPath)
+                        _removeChecksumFiles(checksumBasePath)
                     else:
                         logging.error('Checksum problem with %s. No chance to download the file correctly. Exiting',
                                       url)
                         sys.exit(1)
                 else:
                     httpResponse.close()
-                    if retries:
+                    if _retryPolicy.acquireRetry(attempt):
                         logging.warning('Unable to download, HTTP Response code: %s. Trying again...',
                                         httpResponse.code)
                     else:
                         logging.warning('Unable to download, HTTP Response code: %s. Exiting', httpResponse.code)
                         sys.exit(1)
             except urllib2.HTTPError as err:
-                if retries > 0:
-                    if err.code / 100 == 5:
-                        logging.debug('Unable to download, HTTP Response code = %s, trying again...', err.code)
-                    else:
-                        logging.debug('Unable to download, HTTP Response code = %s.', err.code)
-                        return err.code
+                if not _retryPolicy.isRetryable(err.code):
+                    logging.debug('Unable to download, HTTP Response code = %s.', err.code)
+                    return err.code
+                elif _retryPolicy.acquireRetry(attempt):
+                    logging.debug('Unable to download, HTTP Response code = %s, trying again...', err.code)
+                    retryAfter = err.info().getheader("Retry-After")
                 else:
                     logging.debug('Unable to download, HTTP Response code = %s, giving up...', err.code)
                     return err.code
+            except (urllib2.URLError, httplib.HTTPException) as err:
+                if not _retryPolicy.acquireRetry(attempt):
+                    raise
+                logging.warning('Unable to download %s (%s), trying again...', url, str(err) or repr(err))
+            finally:
+                _releaseSpace(reservation)
     except urllib2.URLError as e:
         logging.error('Unable to download %s, URLError: %s', url, e.reason)
+    except IOError as e:
+        if e.errno != errno.ENOSPC:
+            raise
+        logging.error('Unable to download %s: %s', url, e.strerror)
     except httplib.HTTPException as e:
         logging.exception('Unable to download %s, HTTPException: %s', url, e.message)
     except ValueError as e:
         logging.error('ValueError: %s', e.message)
+    finally:
+        if partPath and os.path.exists(partPath):
+            os.remove(partPath)
+        if partPath:
+            _removeChecksumFiles(partPath)
 
 
 def _downloadFile(url, filePath, checksumMode=ChecksumMode.check, warnOnError=True):
@@ -165,7 +1064,7 @@ def _downloadFile(url, filePath, checksumMode=ChecksumMode.check, warnOnError=Tr
             elif (returnCode >= 400):
                 if warnOnError:
                     logging.warning("Error code %d returned while downloading %s", returnCode, url)
-        fetched = (returnCode == 200)
+        fetched = (returnCode in (200, 304))
     except SystemExit:
         fetched = False
     return fetched
@@ -180,73 +1079,109 @@ def _copyFile(filePath, fileLocalPath, checksumMode=ChecksumMode.check):
     if not os.path.exists(dirname):
         os.makedirs(dirname)
 
-    if os.path.exists(filePath):
-        shutil.copyfile(filePath, fileLocalPath)
+    if os.path.exists(filePath) and _materializeMode != MaterializeMode.copy:
+        _linkFile(filePath, fileLocalPath, checksumMode)
+    elif os.path.exists(filePath):
+        partPath = fileLocalPath + PART_SUFFIX
+        digests = _newDigests()
+        size = os.path.getsize(filePath)
+        reservation = _reserveSpace(size)
+        try:
+            with open(filePath, 'rb') as sourceFile:
+                with open(partPath, 'wb') as localFile:
+                    if size:
+                        _preallocate(localFile, size, reservation)
+                    _copyAndDigest(sourceFile, localFile, digests)
+        except (IOError, OSError):
+            if os.path.exists(partPath):
+                os.remove(partPath)
+            raise
+        finally:
+            _releaseSpace(reservation)
+        digests = _hexDigests(digests)
         if checksumMode in (ChecksumMode.download, ChecksumMode.check):
-            if os.path.exists(filePath + ".md5"):
-                shutil.copyfile(filePath + ".md5", fileLocalPath + ".md5")
-            if os.path.exists(filePath + ".sha1"):
-                shutil.copyfile(filePath + ".sha1", fileLocalPath + ".sha1")
+            for checksumType in _checksumTypes:
+                if os.path.exists(filePath + "." + checksumType):
+                    shutil.copyfile(filePath + "." + checksumType, fileLocalPath + "." + checksumType)
 
         if checksumMode == ChecksumMode.check:
-            if not checkChecksum(filePath):
+            if not _checkDigests(filePath, digests):
+                os.remove(partPath)
                 logging.error('Checksum problem with copy of %s. Exiting', filePath)
                 sys.exit(1)
+        os.rename(partPath, fileLocalPath)
+        _writeChecksumFiles(fileLocalPath, digests)
     else:
         logging.warning("Source file not found: %s", filePath)
         fetched = False
     return fetched
 
 
-def fetchFile(url, filePath, checksumMode=ChecksumMode.check, warnOnError=True, exitOnError=False,
-              filesetLock=None, fileset=None):
+def _linkFile(filePath, fileLocalPath, checksumMode=ChecksumMode.check):
     """
-    Fetch file from the given URL (remote or local), to local path if the path does not exist yet. When using this
-    method in multiple threads, it is needed to pass filesetLock and fileset arguments to ensure it is thread-safe.
-    filesetLock is a threading.Lock instance, which should be shared in all fetchFile calls. fileset is a set in which
-    is stored set of files which are actually downloaded. It has to be shared too.
+    Places the file from the given path to local path without copying its data where possible. Checksum files next to
+    the source file are handled as by the copy: they are placed along with the file in the download and check modes
+    and the file is verified against them in the check mode. Checksums are computed only if they are needed.
     """
-    fetched = False
-    if filesetLock is not None:
-        filesetLock.acquire()
-
-    if os.path.exists(filePath):
-        logging.debug("File already fetched: %s", url)
-        if filesetLock is not None:
-            filesetLock.release()
-        fetched = True
-    else:
-        if filesetLock is not None:
-            if filePath in fileset:
-                logging.debug("File is already being downloaded by another thread: %s", url)
-                filesetLock.release()
-                fetched = True
-            else:
-                fileset.add(filePath)
-                filesetLock.release()
-
-        if not fetched:
-            protocol = urlProtocol(url)
-            if protocol == 'http' or protocol == 'https':
-                fetched = _downloadFile(url, filePath, checksumMode, warnOnError)
-            elif protocol == 'file':
-                fetched = _copyFile(url[7:], filePath, checksumMode)
-            elif protocol == '':
-                fetched = _copyFile(url, filePath, checksumMode)
-            else:
-                logging.warning("Unknown protocol %s. URL: '%s'", protocol, url)
-                fetched = False
-
-            if filesetLock is not None:
-                filesetLock.acquire()
-                fileset.remove(filePath)
-                filesetLock.release()
+    partPath = fileLocalPath + PART_SUFFIX
+    if os.path.exists(partPath):
+        os.remove(partPath)
+    try:
+        mode = file_util.placeFile(filePath, partPath, _MATERIALIZE_LINK_MODES[_materializeMode])
+        logging.debug("Placed %s as %s", fileLocalPath, mode)
 
+        if checksumMode in (ChecksumMode.download, ChecksumMode.check):
+            sourceTypes = [checksumType for checksumType in _checksumTypes
+                           if os.path.exists(filePath + "." + checksumType)]
+        else:
+            sourceTypes = []
+        digests = None
+        if checksumMode == ChecksumMode.check or len(sourceTypes) < len(_checksumTypes):
+            digests = _hexDigests(_digestFile(partPath))
+        if checksumMode == ChecksumMode.check and not _checkDigests(filePath, digests):
+            os.remove(partPath)
+            logging.error('Checksum problem with copy of %s. Exiting', filePath)
+            sys.exit(1)
+        for checksumType in sourceTypes:
+            shutil.copyfile(filePath + "." + checksumType, fileLocalPath + "." + checksumType)
+    except (IOError, OSError):
+        if os.path.exists(partPath):
+            os.remove(partPath)
+        raise
+    os.rename(partPath, fileLocalPath)
+    if digests is not None:
+        _writeChecksumFiles(fileLocalPath, digests)
+
+
+def fetchFile(url, filePath, checksumMode=ChecksumMode.check, warnOnError=True, exitOnError=False):
+    """
+    Fetch file from the given URL (remote or local), to local path if the path does not exist yet. It is thread-safe,
+    when another thread is already fetching the same path, the call waits for it and returns its outcome.
+    """
+    fetched = _fetches.do(os.path.abspath(filePath), _fetchFile, url, filePath, checksumMode, warnOnError)
     if exitOnError and not fetched:
         sys.exit(1)
     return fetched
 
 
+def _fetchFile(url, filePath, checksumMode, warnOnError):
+    if os.path.exists(filePath) and not _needsRevalidation(url, filePath):
+        logging.debug("File already fetched: %s", url)
+        return True
+
+    protocol = urlProtocol(url)
+    if protocol == 'http' or protocol == 'https':
+        fetched = _downloadFile(url, filePath, checksumMode, warnOnError)
+    elif protocol == 'file':
+        fetched = _copyFile(url[7:], filePath, checksumMode)
+    elif protocol == '':
+        fetched = _copyFile(url, filePath, checksumMode)
+    else:
+        logging.warning("Unknown protocol %s. URL: '%s'", protocol, url)
+        fetched = False
+    return fetched
+
+
 def setLogLevel(level, logfile=None):
     """Sets the desired log level."""
     logLevel = getattr(logging, level.upper(), None)
@@ -304,8 +1239,14 @@ def readChecksumFromFile(checksumFilepath, expectedLength):
 
 
 def checkChecksum(filepath):
-    """Checks if SHA1 and MD5 checksums equals to the ones saved in corresponding files if they are available."""
-    return _checkChecksum(filepath, hashlib.md5()) and _checkChecksum(filepath, hashlib.sha1())
+    """
+    Checks if checksums of the configured types (MD5 and SHA1 by default) equal to the ones saved in corresponding
+    files if they are available.
+    """
+    for checksumType in _checksumTypes:
+        if not _checkChecksum(filepath, hashlib.new(checksumType)):
+            return False
+    return True
 
 
 def _checkChecksum(filepath, sum_constr):
@@ -350,32 +1291,45 @@ def gavExists(repoUrl, artifact):
     """Checks if GAV of the given artifact exists in repository with the given root URL."""
     logging.debug("Checking if %s exists in repository %s", str(artifact), repoUrl)
 
-    repoUrl = slashAtTheEnd(repoUrl)
-
-    gavUrl = repoUrl + artifact.getDirPath()
+    gavUrl = slashAtTheEnd(repoUrl) + artifact.getDirPath()
     result = urlExists(gavUrl)
 
     if not result:
         logging.debug("URL %s does not exist, trying to find the version in artifact metadata", gavUrl)
-        metadataUrl = repoUrl + artifact.getArtifactDirPath() + "maven-metadata.xml"
-        gaPath = getTempDir(artifact.getArtifactDirPath())
-        metadataFilePath = gaPath + 'maven-metadata.xml'
-        if os.path.exists(metadataFilePath):
-            fetched = True
-        else:
-            fetched = fetchFile(metadataUrl, metadataFilePath, warnOnError=False)
-        if fetched:
-            metadataDoc = ElementTree(file=metadataFilePath)
-            root = metadataDoc.getroot()
-            for versionTag in root.findall("versioning/versions/version"):
-                if versionTag.text == artifact.version:
-                    result = True
-                    break
-        else:
-            # we want to try pom file only when there are no metadata present
-            pomUrl = repoUrl + artifact.getPomFilepath()
-            logging.debug("URL %s does not exist. Trying pom file at %s", metadataUrl, pomUrl)
-            result = urlExists(pomUrl)
+        result = gavExistsInMetadata(repoUrl, artifact)
+    else:
+        logging.debug("Artifact %s found at %s", str(artifact), repoUrl)
+
+    return result
+
+
+def gavExistsInMetadata(repoUrl, artifact):
+    """
+    Checks if version of the given artifact is listed in maven-metadata.xml of its GA in repository with the given
+    root URL. Only when there are no metadata, the pom file of the artifact is checked. It is the part of gavExists
+    done when the GAV directory does not exist.
+    """
+    repoUrl = slashAtTheEnd(repoUrl)
+    result = False
+    metadataUrl = repoUrl + artifact.getArtifactDirPath() + "maven-metadata.xml"
+    gaPath = getTempDir(artifact.getArtifactDirPath())
+    metadataFilePath = gaPath + 'maven-metadata.xml'
+    if os.path.exists(metadataFilePath):
+        fetched = True
+    else:
+        fetched = fetchFile(metadataUrl, metadataFilePath, warnOnError=False)
+    if fetched:
+        metadataDoc = ElementTree(file=metadataFilePath)
+        root = metadataDoc.getroot()
+        for versionTag in root.findall("versioning/versions/version"):
+            if versionTag.text == artifact.version:
+                result = True
+                break
+    else:
+        # we want to try pom file only when there are no metadata present
+        pomUrl = repoUrl + artifact.getPomFilepath()
+        logging.debug("URL %s does not exist. Trying pom file at %s", metadataUrl, pomUrl)
+        result = urlExists(pomUrl)
 
     logging.debug("Artifact %s %sfound at %s", str(artifact), ("" if result else "not "), repoUrl)
 
@@ -386,12 +1340,7 @@ def urlExists(url):
     parsedUrl = urlparse.urlparse(url)
     protocol = parsedUrl[0]
     if protocol == 'http' or protocol == 'https':
-        if protocol == 'http':
-            connection = httplib.HTTPConnection(parsedUrl[1])
-        else:
-            connection = httplib.HTTPSConnection(parsedUrl[1])
-        connection.request('HEAD', parsedUrl[2], headers={"User-Agent": "Python-Maven Repository Builder"})
-        response = connection.getresponse()
+        response = _connectionPool.request('HEAD', url, followRedirects=False)
         return response.status in [200, 302]
     else:
         if protocol == 'file':
@@ -399,6 +1348,56 @@ def urlExists(url):
         return os.path.exists(url)
 
 
+def getFileSize(url):
+    """
+    Finds out size of the file at the given URL without downloading it. The size found by a repository listing is used
+    if it is known, otherwise a HEAD request is sent for http(s) URLs.
+
+    :param url: URL of the file, a local path or a file:// URL
+    :returns: size of the file in bytes or None if the file does not exist or its size is unknown
+    """
+    listedFile = _getListedFile(url)
+    if listedFile is not None and listedFile[0] is not None:
+        return listedFile[0]
+    protocol = urlProtocol(url)
+    if protocol == 'http' or protocol == 'https':
+        response = _connectionPool.request('HEAD', url)
+        length = response.getheader("Content-Length")
+        if response.status != 200 or length is None:
+            return None
+        return int(length)
+    else:
+        if protocol == 'file':
+            url = url[7:]
+        return os.path.getsize(url) if os.path.isfile(url) else None
+
+
+def getFileSizes(urls, threadnum):
+    """
+    Finds out sizes of files at the given URLs in threadnum threads. Failed requests are only logged.
+
+    :param urls: list of URLs of the files
+    :param threadnum: number of threads sending the requests
+    :returns: list of sizes in the order of the URLs, None for files with unknown size
+    """
+    if not urls:
+        return []
+    pool = ThreadPool(min(threadnum, len(urls)))
+    try:
+        return pool.map(_getFileSizeOrNone, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _getFileSizeOrNone(url):
+    try:
+        return getFileSize(url)
+    except (httplib.HTTPException, socket.error, IOError) as err:
+        logging.warning("Unable to find out size of %s: %s", url, str(err))
+        return None
+
+
 def urlProtocol(url):
     """Determines the protocol in the url, can be empty if there is none in the url."""
     parsedUrl = urlparse.urlparse(url)
@@ -457,33 +1456,102 @@ def updateSnapshotVersionSuffix(artifact, repoUrl):
     Updates snapshotVersionSuffix in given artifact if the artifact is snapshot and pom
     file with '-SNAPSHOT' in filename does not exist. It reads maven-metadata.xml in
     artifact's directory and reads from there timastamp and builn number of the last
-    snapshot build.
+    snapshot build. The result is cached per GAV and repository.
     """
     if not artifact.isSnapshot():
         return
 
+    suffix = _getSnapshotVersionSuffix(artifact, repoUrl)
+    if suffix:
+        artifact.snapshotVersionSuffix = suffix
+        logging.debug("Version suffix for %s set to %s", artifact.getGATCV(), artifact.snapshotVersionSuffix)
+
+
+def updateSnapshotVersionSuffixes(artifacts, repoUrl, threadnum):
+    """
+    Updates snapshotVersionSuffix in all snapshot artifacts from the given list like updateSnapshotVersionSuffix.
+    Metadata of each GAV are read only once and the GAVs are resolved in parallel.
+
+    :param artifacts: list of MavenArtifact instances
+    :param repoUrl: URL of the repository containing the artifacts
+    :param threadnum: number of threads resolving the GAVs
+    """
+    gavToArtifacts = {}
+    for artifact in artifacts:
+        if artifact.isSnapshot():
+            gavToArtifacts.setdefault(artifact.getGAV(), []).append(artifact)
+    if not gavToArtifacts:
+        return
+
+    logging.info("Resolving %d snapshot versions in repository %s", len(gavToArtifacts), repoUrl)
+    pool = ThreadPool(min(threadnum, len(gavToArtifacts)))
+    results = [pool.apply_async(_getSnapshotVersionSuffixInPool, [gavArtifacts[0], repoUrl])
+               for gavArtifacts in gavToArtifacts.values()]
+    pool.close()
+    pool.join()
+    for (gavArtifacts, result) in zip(gavToArtifacts.values(), results):
+        try:
+            suffix = result.get()
+        except Exception as ex:
+            logging.warning("Unable to resolve snapshot version of %s: %s", gavArtifacts[0].getGAV(), str(ex))
+            continue
+        if suffix:
+            for artifact in gavArtifacts:
+                artifact.snapshotVersionSuffix = suffix
+
+
+def _getSnapshotVersionSuffixInPool(artifact, repoUrl):
+    """
+    Calls _getSnapshotVersionSuffix in a ThreadPool worker. Fetching of the metadata can end by sys.exit, which
+    the worker does not handle, so it would die without setting the result and the pool would never finish. The exit
+    is turned into an error of the resolution instead.
+    """
+    try:
+        return _getSnapshotVersionSuffix(artifact, repoUrl)
+    except Exception:
+        raise
+    except BaseException as ex:
+        raise RuntimeError("resolution aborted by %s" % repr(ex))
+
+
+def _getSnapshotVersionSuffix(artifact, repoUrl):
+    """
+    Returns version suffix of the last snapshot build of the artifact's GAV or None if the pom file with '-SNAPSHOT'
+    in filename exists or the suffix cannot be read.
+    """
+    key = (slashAtTheEnd(repoUrl), artifact.getGAV())
+    _snapshotSuffixLock.acquire()
+    try:
+        if key in _snapshotSuffixes:
+            return _snapshotSuffixes[key]
+    finally:
+        _snapshotSuffixLock.release()
+
     logging.debug("Adding snapshot version suffix for %s:%s:%s:%s", artifact.groupId,
                   artifact.artifactId, artifact.artifactType, artifact.version)
+    suffix = None
     pomUrl = slashAtTheEnd(repoUrl) + artifact.getPomFilepath()
-    if urlExists(pomUrl):
-        logging.debug("Not adding, because pom file %s exists", pomUrl)
-        return
-
     metadataUrl = slashAtTheEnd(repoUrl) + artifact.getDirPath() + 'maven-metadata.xml'
     gavPath = getTempDir(artifact.getDirPath())
     metadataFilePath = gavPath + 'maven-metadata.xml'
-    if not os.path.exists(metadataFilePath) and not fetchFile(metadataUrl, metadataFilePath):
+    if urlExists(pomUrl):
+        logging.debug("Not adding, because pom file %s exists", pomUrl)
+    elif not os.path.exists(metadataFilePath) and not fetchFile(metadataUrl, metadataFilePath):
         logging.debug("Unable to read metadata from %s", metadataUrl)
-        return
-
-    metadataDoc = ElementTree(file=metadataFilePath)
-    root = metadataDoc.getroot()
-    timestamp = root.findtext("versioning/snapshot/timestamp")
-    buildNumber = root.findtext("versioning/snapshot/buildNumber")
-
-    if timestamp and buildNumber:
-        artifact.snapshotVersionSuffix = '-' + timestamp + '-' + buildNumber
-        logging.debug("Version suffix for %s set to %s", artifact.getGATCV(), artifact.snapshotVersionSuffix)
+    else:
+        metadataDoc = ElementTree(file=metadataFilePath)
+        root = metadataDoc.getroot()
+        timestamp = root.findtext("versioning/snapshot/timestamp")
+        buildNumber = root.findtext("versioning/snapshot/buildNumber")
+        if timestamp and buildNumber:
+            suffix = '-' + timestamp + '-' + buildNumber
+
+    _snapshotSuffixLock.acquire()
+    try:
+        _snapshotSuffixes[key] = suffix
+    finally:
+        _snapshotSuffixLock.release()
+    return suffix
 
 
 def somethingMatch(regexs, string):
@@ -0,0 +1,206 @@
+"""progress_reporter.py: Periodic reporting of download progress to the log, a status file and Prometheus"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class ProgressReporter:
+    """
+    Counts fetched files and downloaded bytes and periodically reports the progress: files and bytes done and
+    remaining, download rate and limit of concurrent downloads per host, active connections, retries and
+    the estimated time to finish. The report is logged and optionally written into a JSON status file and
+    a Prometheus textfile (for the textfile collector of node exporter). Both files are replaced atomically.
+    """
+
+    METRIC_PREFIX = "maven_repo_builder_"
+
+    def __init__(self, totalFiles, interval=30, statusFile=None, prometheusFile=None, statsFunc=None):
+        """
+        Constructor.
+
+        :param totalFiles: number of files to fetch
+        :param interval: number of seconds between reports
+        :param statusFile: path of the JSON status file or None
+        :param prometheusFile: path of the Prometheus textfile or None
+        :param statsFunc: function returning a dictionary with "activeConnections" and "retries" counters and
+                          optionally "hostLimits" with the current limit of concurrent downloads of each host
+        """
+        self.totalFiles = totalFiles
+        self.interval = interval
+        self.statusFile = statusFile
+        self.prometheusFile = prometheusFile
+        self.statsFunc = statsFunc
+        self.doneFiles = 0
+        self.failedFiles = 0
+        self.skippedFiles = 0
+        self._hostBytes = {}      # { host: bytes downloaded }
+        self._lastHostBytes = {}  # { host: bytes downloaded at the time of the last report }
+        self._hostTimes = {}      # { host: [time of the first bytes, time of the last bytes] }
+        self._startTime = time.time()
+        self._lastReport = self._startTime
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts reporting in a background thread."""
+        self._thread = threading.Thread(target=self._run, name="Progress")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops reporting and writes the final report."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report()
+
+    def addBytes(self, host, amount):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._hostBytes[host] = self._hostBytes.get(host, 0) + amount
+            self._hostTimes.setdefault(host, [now, now])[1] = now
+        finally:
+            self._lock.release()
+
+    def fileDone(self, success=True):
+        self._lock.acquire()
+        try:
+            if success:
+                self.doneFiles += 1
+            else:
+                self.failedFiles += 1
+        finally:
+            self._lock.release()
+
+    def fileSkipped(self):
+        """Counts a file, which was fetched by a previous build."""
+        self._lock.acquire()
+        try:
+            self.skippedFiles += 1
+        finally:
+            self._lock.release()
+
+    def getHostRates(self, minBytes=1000000, minTime=1.0):
+        """
+        Returns average download rate of each host between its first and last downloaded bytes. Hosts with too few
+        data to measure are left out.
+
+        :param minBytes: minimal number of bytes downloaded from a host
+        :param minTime: minimal number of seconds between the first and last bytes of a host
+        :returns: dictionary { host: bytes per second }
+        """
+        rates = {}
+        self._lock.acquire()
+        try:
+            for (host, (first, last)) in self._hostTimes.items():
+                if self._hostBytes[host] >= minBytes and last - first >= minTime:
+                    rates[host] = self._hostBytes[host] / (last - first)
+        finally:
+            self._lock.release()
+        return rates
+
+    def getStatus(self):
+        """
+        Returns the current progress. Remaining bytes are estimated from the average size of the files done so far.
+
+        :returns: dictionary with the progress counters
+        """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            elapsed = max(now - self._startTime, 0.001)
+            sinceLast = max(now - self._lastReport, 0.001)
+            hosts = {}
+            for (host, hostBytes) in self._hostBytes.items():
+                hosts[host] = {"bytes": hostBytes,
+                               "rate": (hostBytes - self._lastHostBytes.get(host, 0)) / sinceLast}
+            self._lastHostBytes = dict(self._hostBytes)
+            self._lastReport = now
+            finished = self.doneFiles + self.failedFiles
+            remainingFiles = max(self.totalFiles - finished - self.skippedFiles, 0)
+            bytesDone = sum(self._hostBytes.values())
+        finally:
+            self._lock.release()
+
+        status = {
+            "elapsed": elapsed,
+            "files": {"total": self.totalFiles, "done": self.doneFiles, "failed": self.failedFiles,
+                      "skipped": self.skippedFiles, "remaining": remainingFiles},
+            "bytes": {"done": bytesDone,
+                      "remaining": bytesDone / finished * remainingFiles if finished else None},
+            "rate": bytesDone / elapsed,
+            "hosts": hosts,
+            "eta": elapsed / finished * remainingFiles if finished else None,
+        }
+        if self.statsFunc is not None:
+            status.update(self.statsFunc())
+        return status
+
+    def report(self):
+        """Logs the current progress and writes the status files."""
+        status = self.getStatus()
+        files = status["files"]
+        eta = "%d s" % status["eta"] if status["eta"] is not None else "unknown"
+        hostRates = ", ".join("%s %.2f MB/s" % (host, hostStatus["rate"] / 1000000.0)
+                              for (host, hostStatus) in sorted(status["hosts"].items()))
+        logging.info("Progress: %d/%d files (%d failed, %d skipped), %.1f MB at %.2f MB/s, %s connections active, "
+                     "%s retries, ETA %s%s", files["done"], files["total"], files["failed"], files["skipped"],
+                     status["bytes"]["done"] / 1000000.0, status["rate"] / 1000000.0,
+                     status.get("activeConnections", "?"), status.get("retries", "?"), eta,
+                     " [" + hostRates + "]" if hostRates else "")
+        try:
+            if self.statusFile:
+                self._writeAtomically(self.statusFile, json.dumps(status, indent=2, sort_keys=True))
+            if self.prometheusFile:
+                self._writeAtomically(self.prometheusFile, self._formatPrometheus(status))
+        except (IOError, OSError) as err:
+            logging.warning("Unable to write progress status: %s", str(err))
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.report()
+
+    def _formatPrometheus(self, status):
+        lines = []
+
+        def metric(name, metricType, help, samples):
+            name = self.METRIC_PREFIX + name
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, metricType))
+            for (labels, value) in samples:
+                labelText = ",".join('%s="%s"' % (key, labels[key]) for key in sorted(labels))
+                lines.append("%s%s %s" % (name, "{%s}" % labelText if labelText else "", value))
+
+        files = status["files"]
+        metric("files", "gauge", "Number of files of the build by state.",
+               [({"state": state}, files[state]) for state in ("total", "done", "failed", "skipped", "remaining")])
+        metric("downloaded_bytes_total", "counter", "Number of bytes downloaded per host.",
+               [({"host": host}, hostStatus["bytes"]) for (host, hostStatus) in sorted(status["hosts"].items())])
+        metric("download_rate_bytes", "gauge", "Download rate in bytes per second per host since the last report.",
+               [({"host": host}, hostStatus["rate"]) for (host, hostStatus) in sorted(status["hosts"].items())])
+        if "activeConnections" in status:
+            metric("active_connections", "gauge", "Number of HTTP connections in use.",
+                   [({}, status["activeConnections"])])
+        if "retries" in status:
+            metric("retries_total", "counter", "Number of retried requests.", [({}, status["retries"])])
+        if "hostLimits" in status:
+            metric("host_concurrency_limit", "gauge", "Current limit of concurrent downloads per host.",
+                   [({"host": host}, limit) for (host, limit) in sorted(status["hostLimits"].items())])
+        if status["eta"] is not None:
+            metric("eta_seconds", "gauge", "Estimated number of seconds until the build finishes.",
+                   [({}, status["eta"])])
+        return "\n".join(lines) + "\n"
+
+    def _writeAtomically(self, filename, content):
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmpFilename = filename + ".tmp"
+        with open(tmpFilename, "w") as statusFile:
+            statusFile.write(content)
+        os.rename(tmpFilename, filename)
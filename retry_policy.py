@@ -0,0 +1,195 @@
+"""retry_policy.py: Delays between download retries, global retry budget and per-host circuit breaker"""
+
+import logging
+import random
+import time
+from multiprocessing import Lock
+
+
+class CircuitBreaker:
+    """
+    Per-host circuit breaker. After a number of consecutive failed requests to a host the circuit opens and the host
+    is paused for a cooldown period. Then a single trial request is let through; if it succeeds the circuit closes,
+    otherwise it opens again for twice as long (up to maxCooldown).
+    """
+
+    def __init__(self, threshold=5, cooldown=30, maxCooldown=600):
+        """
+        Constructor.
+
+        :param threshold: number of consecutive failures which opens the circuit
+        :param cooldown: seconds for which a host is paused after the circuit opened for the first time
+        :param maxCooldown: maximal seconds for which a host is paused
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.maxCooldown = maxCooldown
+        self.trips = 0
+        self._lock = Lock()
+        self._hosts = {}  # { host: {"failures", "openUntil", "cooldown", "trialStarted"} }
+
+    def getPause(self, host):
+        """
+        Returns number of seconds for which requests to the host should wait, 0 if a request can be sent now.
+        When the cooldown is over, the first caller gets 0 and it is expected to send the trial request.
+        """
+        self._lock.acquire()
+        try:
+            state = self._hosts.get(host)
+            if state is None or not state["openUntil"]:
+                return 0
+            now = time.time()
+            if now < state["openUntil"]:
+                return state["openUntil"] - now
+            if state["trialStarted"] and now - state["trialStarted"] < state["cooldown"]:
+                # a trial request is in progress, wait for its result
+                return 1.0
+            state["trialStarted"] = now
+            return 0
+        finally:
+            self._lock.release()
+
+    def isOpen(self, host):
+        """Checks if the host is paused without starting a trial request."""
+        self._lock.acquire()
+        try:
+            state = self._hosts.get(host)
+            return state is not None and state["openUntil"] > time.time()
+        finally:
+            self._lock.release()
+
+    def recordSuccess(self, host):
+        self._lock.acquire()
+        try:
+            state = self._hosts.get(host)
+            if state is None:
+                return
+            if state["openUntil"]:
+                logging.info("Circuit to %s closed, resuming downloads", host)
+            del self._hosts[host]
+        finally:
+            self._lock.release()
+
+    def recordFailure(self, host):
+        self._lock.acquire()
+        try:
+            state = self._hosts.setdefault(host, {"failures": 0, "openUntil": 0, "cooldown": 0, "trialStarted": 0})
+            state["failures"] += 1
+            if state["trialStarted"]:
+                cooldown = min(state["cooldown"] * 2, self.maxCooldown)
+            elif not state["openUntil"] and state["failures"] >= self.threshold:
+                cooldown = self.cooldown
+            else:
+                return
+            state["cooldown"] = cooldown
+            state["openUntil"] = time.time() + cooldown
+            state["trialStarted"] = 0
+            self.trips += 1
+        finally:
+            self._lock.release()
+        logging.warning("Circuit to %s opened after %d failures, pausing downloads for %d seconds", host,
+                        state["failures"], cooldown)
+
+
+class RetryPolicy:
+    """
+    Decides whether a failed request is retried and how long to wait before that. Delays grow exponentially with
+    the attempt number and are randomized over the whole interval (full jitter), so threads which failed at the same
+    time do not retry at the same time. Retries of the whole build are limited by a budget proportional to the number
+    of requests, so a server outage does not multiply the load. Requests to hosts paused by the circuit breaker wait
+    until the breaker lets them through.
+    """
+
+    # status codes worth retrying
+    RETRY_CODES = (408, 429, 500, 502, 503, 504)
+
+    # number of retries always allowed by the budget
+    MIN_BUDGET = 10
+
+    def __init__(self, retries=3, delay=1.0, maxDelay=60.0, budget=0.2, breaker=None):
+        """
+        Constructor.
+
+        :param retries: maximal number of retries of a single request
+        :param delay: base delay in seconds, delay before n-th retry is random between 0 and delay * 2^(n-1)
+        :param maxDelay: maximal delay in seconds
+        :param budget: maximal number of retries as a fraction of the number of requests
+        :param breaker: CircuitBreaker instance, a default one is created if None
+        """
+        self.retries = retries
+        self.delay = delay
+        self.maxDelay = maxDelay
+        self.budget = budget
+        self.breaker = breaker or CircuitBreaker()
+        self.requests = 0
+        self.retried = 0
+        self._budgetExhausted = False
+        self._lock = Lock()
+
+    def isRetryable(self, status):
+        """Checks if a request which ended with the given status (None for a connection failure) is worth retrying."""
+        return status is None or status in self.RETRY_CODES
+
+    def recordResult(self, host, status):
+        """
+        Records the result of a request to the host.
+
+        :param host: host (with port) the request was sent to
+        :param status: HTTP status code, None if no response was received
+        """
+        self._lock.acquire()
+        try:
+            self.requests += 1
+        finally:
+            self._lock.release()
+        if self.isRetryable(status):
+            self.breaker.recordFailure(host)
+        else:
+            self.breaker.recordSuccess(host)
+
+    def acquireRetry(self, attempt):
+        """
+        Checks if a request can be retried after the given number of attempts and takes a retry from the budget.
+
+        :param attempt: number of attempts done so far
+        :returns: True if the request can be retried
+        """
+        if attempt > self.retries:
+            return False
+        self._lock.acquire()
+        try:
+            if self.retried >= self.MIN_BUDGET + self.budget * self.requests:
+                if not self._budgetExhausted:
+                    logging.warning("Retry budget exhausted after %d retries of %d requests, failing fast",
+                                    self.retried, self.requests)
+                self._budgetExhausted = True
+                return False
+            self._budgetExhausted = False
+            self.retried += 1
+            return True
+        finally:
+            self._lock.release()
+
+    def getDelay(self, attempt, retryAfter=None):
+        """
+        Returns number of seconds to wait before the next attempt.
+
+        :param attempt: number of attempts done so far
+        :param retryAfter: value of Retry-After header of the last response if any
+        """
+        delay = random.uniform(0, min(self.maxDelay, self.delay * 2 ** (attempt - 1)))
+        if retryAfter and retryAfter.strip().isdigit():
+            delay = max(delay, min(self.maxDelay, int(retryAfter)))
+        return delay
+
+    def waitBeforeRetry(self, host, attempt, retryAfter=None):
+        """Sleeps for the backoff delay and then while the host is paused."""
+        time.sleep(self.getDelay(attempt, retryAfter))
+        self.waitForHost(host)
+
+    def waitForHost(self, host):
+        """Sleeps while the circuit breaker pauses requests to the host."""
+        pause = self.breaker.getPause(host)
+        while pause > 0:
+            time.sleep(min(pause, 1.0))
+            pause = self.breaker.getPause(host)
@@ -0,0 +1,64 @@
+"""single_flight.py: Coalescing of concurrent calls doing the same work"""
+
+import sys
+import threading
+
+
+class SingleFlight:
+    """
+    Runs a function at most once at a time per key. Callers coming while the function runs for their key wait for it
+    to finish and get the same result, or the same exception is raised to them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}  # { key: _Call }
+        self.coalesced = 0
+
+    def do(self, key, func, *args):
+        """
+        Calls func(*args) unless a call for the same key is already running, in which case its outcome is returned.
+
+        :param key: key identifying the work, e.g. a target path
+        :param func: function doing the work
+        :returns: result of the function
+        """
+        leader = False
+        self._lock.acquire()
+        try:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+        finally:
+            self._lock.release()
+
+        if not leader:
+            call.done.wait()
+            if call.excInfo is not None:
+                raise call.excInfo[0], call.excInfo[1], call.excInfo[2]
+            return call.result
+
+        try:
+            call.result = func(*args)
+        except BaseException:
+            call.excInfo = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+        return call.result
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.excInfo = None
@@ -2,15 +2,44 @@
 
 """ tests.py: Unit tests for maven repo builder and related tools"""
 
+import BaseHTTPServer
+import SocketServer
+import hashlib
 import logging
 import os
+import shutil
+import socket
+import sys
 import tempfile
+import threading
+import time
 import unittest
+import urllib2
 import copy
+from subprocess import Popen
 
+import artifact_downloader
 import artifact_list_builder
+import build_planner
 import configuration
+import file_util
+import maven_repo_builder
 import maven_repo_util
+from artifact_store import ArtifactStore
+from bandwidth_limiter import TokenBucket
+from disk_space import DiskSpaceGuard
+from file_util import LinkMode
+from download_journal import DownloadJournal
+from download_scheduler import DownloadScheduler
+from hedged_lookup import LatencyTracker
+from http_cache import HttpCache
+from host_limiter import AdaptiveHostLimiter
+import hedged_lookup
+from progress_reporter import ProgressReporter
+from retry_policy import CircuitBreaker, RetryPolicy
+from single_flight import SingleFlight
+from write_behind import WriteBehind
+from throughput_stats import ThroughputStats
 from indy_apis import IndyApi
 from artifact_list_builder import ArtifactListBuilder, ArtifactSpec, ArtifactType
 from maven_repo_util import ChecksumMode
@@ -19,6 +48,49 @@ from configuration import Configuration
 from filter import Filter
 
 
+class FakeResponse:
+    """
+    Response of a faked HTTP request. Reading the body raises socket.error after failAfter bytes if it is given, like
+    a broken connection.
+    """
+
+    def __init__(self, code, headers, body="", failAfter=None):
+        self.code = code
+        self.headers = headers
+        self.body = body
+        self.failAfter = failAfter
+        self.position = 0
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt):
+        if self.failAfter is not None and self.position >= self.failAfter:
+            raise socket.error("connection reset")
+        end = len(self.body) if self.failAfter is None else self.failAfter
+        data = self.body[self.position:min(self.position + amt, end)]
+        self.position += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class KeepAliveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handler of a local HTTP server keeping connections alive between requests and not logging them."""
+
+    protocol_version = "HTTP/1.1"
+
+    def sendBody(self, body):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
 class Tests(unittest.TestCase):
 
     indyUrl = 'http://dev208.mw.lab.eng.bos.redhat.com:8080/'
@@ -46,6 +118,45 @@ class Tests(unittest.TestCase):
     def setUp(self):
         logging.basicConfig(format="%(levelname)s (%(threadName)s): %(message)s", level=logging.DEBUG)
 
+    def startHttpServer(self, handlerClass):
+        """
+        Starts a local HTTP server, which is stopped after the test together with the threads handling its
+        connections.
+
+        :returns: port of the server
+        """
+        handlerThreads = []
+
+        class Handler(handlerClass):
+            def setup(self):
+                handlerThreads.append(threading.current_thread())
+                handlerClass.setup(self)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        server = Server(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        def stop():
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            # handlers wait for next requests on the connections kept by the pool until they are closed
+            maven_repo_util.getConnectionPool().closeAll()
+            for handlerThread in handlerThreads:
+                handlerThread.join()
+        self.addCleanup(stop)
+        return server.server_address[1]
+
+    def mkdtemp(self):
+        """Creates a temporary directory, which is removed after the test."""
+        tempDir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempDir, True)
+        return tempDir
+
     def test_url_download(self):
         # make sure the shuffled sequence does not lose any elements
         url = "http://repo1.maven.org/maven2/org/jboss/jboss-parent/10/jboss-parent-10.pom"
@@ -62,6 +173,1003 @@ class Tests(unittest.TestCase):
             logging.debug('Removing temp local file: ' + localfilename)
             os.remove(localfilename)
 
+    def test_connection_reuse(self):
+        class Handler(KeepAliveHandler):
+            def do_GET(self):
+                self.sendBody("<project/>")
+
+        port = self.startHttpServer(Handler)
+        url = "http://127.0.0.1:%d/org/jboss/jboss-parent/10/jboss-parent-10.pom" % port
+        tempDownloadDir = self.mkdtemp()
+        pool = maven_repo_util.getConnectionPool()
+        reusedBefore = pool.getStats()["reused"]
+        maven_repo_util.download(url, os.path.join(tempDownloadDir, "first.pom"), ChecksumMode.generate)
+        maven_repo_util.download(url, os.path.join(tempDownloadDir, "second.pom"), ChecksumMode.generate)
+        self.assertTrue(os.path.exists(os.path.join(tempDownloadDir, "second.pom")), "File not downloaded")
+        self.assertTrue(pool.getStats()["reused"] > reusedBefore, "No pooled connection was reused")
+
+    def test_redirected_host_listener(self):
+        class Handler(KeepAliveHandler):
+            def do_GET(self):
+                if self.path.startswith("/mirror/"):
+                    self.send_response(302)
+                    self.send_header("Location", "http://localhost:%d/cdn/%s" % (self.server.server_address[1],
+                                                                                  self.path[8:]))
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.sendBody("<project/>")
+
+        port = self.startHttpServer(Handler)
+        hosts = []
+        listener = lambda host, status, latency: hosts.append((host, status))
+        pool = maven_repo_util.getConnectionPool()
+        pool.addListener(listener)
+        try:
+            response = pool.request("GET", "http://127.0.0.1:%d/mirror/foo.pom" % port)
+            self.assertEqual(response.read(), "<project/>")
+        finally:
+            pool.removeListener(listener)
+        # responses after the redirect are reported under the requested host, which the scheduler limits
+        self.assertEqual(hosts, [("127.0.0.1:%d" % port, 302), ("127.0.0.1:%d" % port, 200)])
+
+    def test_artifact_store(self):
+        tempDir = self.mkdtemp()
+        store = ArtifactStore(os.path.join(tempDir, "store"), 150)
+        files = []
+        for i in range(3):
+            filepath = os.path.join(tempDir, "file%d.jar" % i)
+            with open(filepath, "w") as fileobj:
+                fileobj.write(str(i) * 60)
+            sha1 = maven_repo_util.getSha1Checksum(filepath)
+            store.add(filepath, sha1)
+            os.utime(store.getPath(sha1) + ArtifactStore.USED_SUFFIX, (1000 + i, 1000 + i))
+            files.append(sha1)
+
+        # the least recently used file was evicted to keep the store under 150 bytes
+        self.assertFalse(store.materialize(files[0], os.path.join(tempDir, "copy0.jar")))
+        self.assertTrue(store.materialize(files[2], os.path.join(tempDir, "copy2.jar")))
+        self.assertEqual(maven_repo_util.getSha1Checksum(os.path.join(tempDir, "copy2.jar")), files[2])
+        self.assertEqual((store.hits, store.misses), (1, 1))
+        # neither added nor placed files share the inode with the store
+        storeStat = os.stat(store.getPath(files[2]))
+        self.assertEqual(storeStat.st_nlink, 1)
+        self.assertNotEqual(os.stat(os.path.join(tempDir, "copy2.jar")).st_ino, storeStat.st_ino)
+        self.assertTrue(os.path.getmtime(store.getPath(files[2]) + ArtifactStore.USED_SUFFIX) > 1002)
+
+        # the hardlink mode is opt-in
+        linkingStore = ArtifactStore(os.path.join(tempDir, "store"), linkMode=LinkMode.hardlink)
+        self.assertTrue(linkingStore.materialize(files[2], os.path.join(tempDir, "link2.jar")))
+        self.assertEqual(os.stat(os.path.join(tempDir, "link2.jar")).st_ino, storeStat.st_ino)
+
+    def test_artifact_store_modes(self):
+        lookups = []
+
+        def fetchFromStore(url, filePath):
+            lookups.append(os.path.basename(filePath))
+            return False
+
+        def openUrl(url, headers=None):
+            raise urllib2.HTTPError(url, 404, "Not Found", None, None)
+
+        tempDir = self.mkdtemp()
+        originalFetchFromStore = maven_repo_util._fetchFromStore
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._fetchFromStore = fetchFromStore
+        maven_repo_util._openUrl = openUrl
+        maven_repo_util.configureArtifactStore(os.path.join(tempDir, "store"))
+        try:
+            for (filename, checksumMode) in [("foo-1.0.jar", ChecksumMode.check),
+                                             ("foo-1.1.jar", ChecksumMode.download),
+                                             ("foo-1.2.jar", ChecksumMode.generate),
+                                             ("maven-metadata.xml", ChecksumMode.check),
+                                             ("foo-1.0-SNAPSHOT.jar", ChecksumMode.check)]:
+                self.assertEqual(maven_repo_util.download("http://repo1/" + filename, os.path.join(tempDir, filename),
+                                                          checksumMode), 404)
+            # the store is looked up by the downloaded SHA1 of files which cannot change on the server
+            self.assertEqual(lookups, ["foo-1.0.jar", "foo-1.1.jar"])
+        finally:
+            maven_repo_util._fetchFromStore = originalFetchFromStore
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util.configureArtifactStore(None)
+
+    def test_artifact_store_checksums(self):
+        tempDir = self.mkdtemp()
+        storedPath = os.path.join(tempDir, "stored.jar")
+        with open(storedPath, "w") as fileobj:
+            fileobj.write("stored")
+        storedSha1 = maven_repo_util.getSha1Checksum(storedPath)
+
+        def openUrl(url, headers=None):
+            if url.endswith(".sha1"):
+                return FakeResponse(200, {}, storedSha1 if "/stored" in url else "0" * 40)
+            raise urllib2.HTTPError(url, 404, "Not Found", None, None)
+
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._openUrl = openUrl
+        maven_repo_util.configureArtifactStore(os.path.join(tempDir, "store"))
+        try:
+            maven_repo_util.getArtifactStore().add(storedPath, storedSha1)
+            # the checksum of a file missing in the store is not left behind when the download fails
+            filePath = os.path.join(tempDir, "output", "missing.jar")
+            self.assertEqual(maven_repo_util.download("http://repo1/missing.jar", filePath, ChecksumMode.check), 404)
+            self.assertEqual(os.listdir(os.path.dirname(filePath)), [])
+
+            # a file found in the store is placed with its checksum
+            filePath = os.path.join(tempDir, "output", "stored.jar")
+            self.assertEqual(maven_repo_util.download("http://repo1/stored.jar", filePath, ChecksumMode.check), 200)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(filePath))), ["stored.jar", "stored.jar.sha1"])
+            self.assertEqual(maven_repo_util.readChecksumFromFile(filePath + ".sha1", 40), storedSha1)
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util.configureArtifactStore(None)
+
+    def test_copy_file_checksums(self):
+        tempDir = self.mkdtemp()
+        source = os.path.join(tempDir, "source.jar")
+        with open(source, "w") as fileobj:
+            fileobj.write("artifact content")
+        target = os.path.join(tempDir, "repo", "target.jar")
+        self.assertTrue(maven_repo_util.fetchFile(source, target, ChecksumMode.generate))
+        self.assertFalse(os.path.exists(target + maven_repo_util.PART_SUFFIX))
+        self.assertEqual(maven_repo_util.readChecksumFromFile(target + ".sha1", 40),
+                         maven_repo_util.getSha1Checksum(source))
+        self.assertTrue(maven_repo_util.checkChecksum(target))
+
+    def test_download_journal(self):
+        tempDir = self.mkdtemp()
+        journalFile = os.path.join(tempDir, "journal")
+        journal = DownloadJournal(journalFile)
+        journal.writePlan({"http://repo1.maven.org/maven2/": [MavenArtifact.createFromGAV("org.jboss:foo:jar:1.0")]})
+        filepath = os.path.join(tempDir, "foo-1.0.jar")
+        with open(filepath, "w") as fileobj:
+            fileobj.write("artifact content")
+        journal.SYNC_INTERVAL = 3600
+        journal.markDone("org/jboss/foo/1.0/foo-1.0.jar", filepath)
+        # the record is written only after the file is synced
+        self.assertFalse(DownloadJournal.load(journalFile).isDone("org/jboss/foo/1.0/foo-1.0.jar"))
+        journal.close()
+        # simulate a crash in the middle of writing a record
+        with open(journalFile, "a") as fileobj:
+            fileobj.write('{"done": "org/jb')
+
+        journal = DownloadJournal.load(journalFile)
+        self.assertEqual(journal.plan["http://repo1.maven.org/maven2/"][0].getGATCV(), "org.jboss:foo:jar:1.0")
+        self.assertTrue(journal.isDone("org/jboss/foo/1.0/foo-1.0.jar"))
+        self.assertEqual(len(journal.done), 1)
+        journal.remove()
+        self.assertEqual(DownloadJournal.load(journalFile), None)
+
+        # a resumed build keeps the recorded snapshot versions, even if a newer snapshot was deployed meanwhile
+        repoDir = os.path.join(tempDir, "repo")
+        artifact = MavenArtifact.createFromGAV("org.foo:bar:jar:1.0-SNAPSHOT")
+        metadataPath = os.path.join(repoDir, artifact.getDirPath(), "maven-metadata.xml")
+        os.makedirs(os.path.dirname(metadataPath))
+        with open(metadataPath, "w") as fileobj:
+            fileobj.write("<metadata><versioning><snapshot><timestamp>20170102.030405</timestamp>"
+                          "<buildNumber>8</buildNumber></snapshot></versioning></metadata>")
+        with open(os.path.join(repoDir, artifact.getDirPath(), "bar-1.0-20170102.030405-8.jar"), "w") as fileobj:
+            fileobj.write("newer")
+        artifact.snapshotVersionSuffix = "-20170102.030405-7"
+        journal = DownloadJournal(journalFile)
+        journal.writePlan({"file://" + repoDir: [artifact]})
+        journal.markDone(artifact.getArtifactFilepath(), filepath)
+        journal.close()
+
+        journal = DownloadJournal.load(journalFile)
+        outputDir = os.path.join(tempDir, "output")
+        try:
+            errorCount = artifact_downloader.fetchArtifactList("file://" + repoDir, outputDir,
+                                                               journal.plan["file://" + repoDir],
+                                                               ChecksumMode.generate, 1, journal=journal)
+        finally:
+            journal.close()
+            maven_repo_util.cleanTempDir()
+        self.assertEqual(errorCount, 0)
+        self.assertEqual(journal.plan["file://" + repoDir][0].snapshotVersionSuffix, "-20170102.030405-7")
+        self.assertEqual(os.listdir(outputDir), [])
+
+    def test_download_scheduler(self):
+        lock = threading.Lock()
+        running = {}
+        peaks = {}
+
+        def task(host):
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                peaks[host] = max(peaks.get(host, 0), running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+
+        # tasks of a host do not run over its limit, while other hosts use the remaining workers
+        scheduler = DownloadScheduler(4, 2)
+        for i in range(6):
+            scheduler.apply_async(task, ["repo1"], "repo1")
+        for i in range(2):
+            scheduler.apply_async(task, ["repo2"], "repo2")
+        scheduler.close()
+        scheduler.join()
+        self.assertEqual(peaks, {"repo1": 2, "repo2": 2})
+
+        # a single worker takes the hosts in turns and submitting to a full queue blocks
+        order = []
+        gate = threading.Event()
+        scheduler = DownloadScheduler(1, queueSize=2)
+        scheduler.apply_async(gate.wait, [], "gate")
+        for name in ("a1", "a2", "b1", "b2"):
+            scheduler.apply_async(order.append, [name], "repo" + name[0])
+        submitter = threading.Thread(target=scheduler.apply_async, args=[order.append, ["a3"], "repoa"])
+        submitter.start()
+        submitter.join(0.2)
+        self.assertTrue(submitter.is_alive())
+        gate.set()
+        submitter.join()
+        scheduler.close()
+        scheduler.join()
+        self.assertEqual(order, ["a1", "b1", "a2", "b2", "a3"])
+
+        # tasks submitted without a host run too
+        scheduler = DownloadScheduler(1)
+        scheduler.apply_async(order.append, ["none"])
+        scheduler.close()
+        scheduler.join()
+        self.assertEqual(order[-1], "none")
+
+        # waiting workers start the next task of a host as soon as its adaptive limit grows
+        limiter = AdaptiveHostLimiter(1, 2)
+        started = threading.Event()
+        gate = threading.Event()
+        scheduler = DownloadScheduler(2, limiter=limiter)
+        scheduler.apply_async(gate.wait, [], "repo1")
+        scheduler.apply_async(started.set, [], "repo1")
+        self.assertFalse(started.wait(0.2))
+        limiter.responseReceived("repo1", 200, 0.01)
+        self.assertTrue(started.wait(5))
+        gate.set()
+        scheduler.close()
+        scheduler.join()
+
+    def test_feeder_errors(self):
+        tempDir = self.mkdtemp()
+        repoDir = os.path.join(tempDir, "repo")
+        artifact = MavenArtifact.createFromGAV("org.foo:bar:jar:1.0")
+        path = os.path.join(repoDir, artifact.getArtifactFilepath())
+        os.makedirs(os.path.dirname(path))
+        with open(path, "w") as fileobj:
+            fileobj.write("bar")
+
+        # a repository with an unknown protocol is counted as an error, while the others are fetched
+        urlToMAList = {"file://" + repoDir: [artifact], "ftp://repo1/": [artifact]}
+        errorCount = artifact_downloader.fetchArtifactLists(urlToMAList, os.path.join(tempDir, "output"),
+                                                            ChecksumMode.generate, 2,
+                                                            artifact_downloader.DownloadEngine.queue)
+        self.assertEqual(errorCount, 1)
+        self.assertTrue(os.path.exists(os.path.join(tempDir, "output", artifact.getArtifactFilepath())))
+
+    def test_download_scheduler_workers(self):
+        self.assertEqual(DownloadScheduler(DownloadScheduler.MAX_WORKERS * 2).workers, DownloadScheduler.MAX_WORKERS)
+
+        stackSizes = []
+        originalStackSize = threading.stack_size
+
+        def stackSize(*args):
+            stackSizes.append(args)
+            return originalStackSize(*args)
+
+        threading.stack_size = stackSize
+        try:
+            scheduler = DownloadScheduler(2)
+            scheduler.apply_async(len, [[]])
+        finally:
+            threading.stack_size = originalStackSize
+        scheduler.close()
+        scheduler.join()
+        # workers are started with small stacks and the default stack size is restored afterwards
+        self.assertEqual(stackSizes, [(DownloadScheduler.WORKER_STACK_SIZE,), (originalStackSize(),)])
+        self.assertEqual(len(scheduler._threads), 2)
+
+    def test_adaptive_host_limiter(self):
+        limiter = AdaptiveHostLimiter(4, 6)
+        for i in range(40):
+            limiter.responseReceived("fast:80", 200, 0.01)
+        self.assertEqual(limiter.getLimit("fast:80"), 6)
+        self.assertEqual(limiter.getLimit("other:80"), 4)
+
+        limiter.responseReceived("fast:80", 503, 0.01)
+        self.assertEqual(limiter.getLimit("fast:80"), 3)
+        # failures of requests sent at once decrease the limit only once
+        limiter.responseReceived("fast:80", None, 0.01)
+        self.assertEqual(limiter.getLimit("fast:80"), 3)
+        # slow responses do not increase the limit
+        limiter.responseReceived("fast:80", 200, 5.0)
+        self.assertEqual(limiter.getLimit("fast:80"), 3)
+        self.assertEqual(limiter.getStats()["fast:80"], {"limit": 3, "peak": 6, "decreases": 1})
+
+    def test_retry_policy(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=60)
+        policy = RetryPolicy(retries=2, delay=1.0, maxDelay=3.0, budget=0.5, breaker=breaker)
+        self.assertTrue(policy.isRetryable(503))
+        self.assertFalse(policy.isRetryable(404))
+        for attempt in range(1, 5):
+            self.assertTrue(0 <= policy.getDelay(attempt) <= 3.0)
+        self.assertEqual(policy.getDelay(1, "10"), 3.0)
+        self.assertFalse(policy.acquireRetry(3))
+
+        # the budget allows MIN_BUDGET retries plus a half of the number of requests
+        for i in range(10):
+            policy.recordResult("ok:80", 200)
+        retried = 0
+        while policy.acquireRetry(1):
+            retried += 1
+        self.assertEqual(retried, RetryPolicy.MIN_BUDGET + 5)
+
+        policy.recordResult("down:80", 503)
+        self.assertFalse(breaker.isOpen("down:80"))
+        policy.recordResult("down:80", None)
+        self.assertTrue(breaker.isOpen("down:80"))
+        self.assertTrue(breaker.getPause("down:80") > 0)
+        self.assertFalse(breaker.isOpen("ok:80"))
+        self.assertEqual(breaker.getPause("ok:80"), 0)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(1000)
+        self.assertEqual(bucket.reserve(1000), 0)
+        # the bucket is empty, next 500 bytes are available in half a second
+        delay = bucket.reserve(500)
+        self.assertTrue(0.4 < delay <= 0.5)
+        delay = bucket.reserve(500)
+        self.assertTrue(0.9 < delay <= 1.0)
+
+        # checksum files are downloaded within the limits too
+        consumed = []
+
+        class RecordingLimiter:
+            def consume(self, host, amount):
+                consumed.append((host, amount))
+
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._openUrl = lambda url, headers=None: FakeResponse(200, {}, "a" * 40)
+        maven_repo_util._bandwidthLimiter = RecordingLimiter()
+        try:
+            filePath = os.path.join(self.mkdtemp(), "file.jar")
+            self.assertTrue(maven_repo_util._downloadChecksum("http://repo1/file.jar", filePath, "sha1", 40))
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util.configureBandwidthLimiter()
+        self.assertEqual(consumed, [("repo1", 40)])
+
+    def test_hedged_lookup(self):
+        tracker = LatencyTracker(95, defaultDelay=0.05)
+        for i in range(20):
+            tracker.responseReceived("fast:80", 200, 0.01 * i)
+        self.assertAlmostEqual(tracker.getDelay("fast:80"), 0.19)
+        self.assertEqual(tracker.getDelay("slow:80"), 0.05)
+
+        checked = []
+
+        def check(url):
+            checked.append(url)
+            if url == "http://slow/":
+                time.sleep(1)
+            return url != "http://missing/"
+
+        start = time.time()
+        url = hedged_lookup.findFirst(["http://slow/", "http://missing/", "http://mirror/"], check, tracker)
+        self.assertEqual(url, "http://mirror/")
+        self.assertTrue(time.time() - start < 0.5, "Lookup was not hedged")
+        self.assertEqual(hedged_lookup.findFirst(["http://missing/"], check, tracker), None)
+
+    def test_link_file(self):
+        tempDir = self.mkdtemp()
+        source = os.path.join(tempDir, "source.jar")
+        with open(source, "w") as fileobj:
+            fileobj.write("artifact content")
+        with open(source + ".sha1", "w") as fileobj:
+            fileobj.write("trusted sha1")
+        target = os.path.join(tempDir, "repo", "target.jar")
+        maven_repo_util.setMaterializeMode(maven_repo_util.MaterializeMode.link)
+        try:
+            self.assertTrue(maven_repo_util.fetchFile("file://" + source, target, ChecksumMode.download))
+            # the file is verified against the source checksum files in the check mode
+            checked = os.path.join(tempDir, "repo", "checked.jar")
+            self.assertRaises(SystemExit, maven_repo_util.fetchFile, "file://" + source, checked, ChecksumMode.check)
+            self.assertFalse(os.path.exists(checked) or os.path.exists(checked + maven_repo_util.PART_SUFFIX))
+            # source checksum files are ignored in the generate mode
+            generated = os.path.join(tempDir, "repo", "generated.jar")
+            self.assertTrue(maven_repo_util.fetchFile("file://" + source, generated, ChecksumMode.generate))
+        finally:
+            maven_repo_util.setMaterializeMode(maven_repo_util.MaterializeMode.copy)
+        with open(target) as fileobj:
+            self.assertEqual(fileobj.read(), "artifact content")
+        # the source checksum is placed along with the file, the missing one is computed
+        with open(target + ".sha1") as fileobj:
+            self.assertEqual(fileobj.read(), "trusted sha1")
+        self.assertEqual(maven_repo_util.readChecksumFromFile(target + ".md5", 32),
+                         maven_repo_util.getChecksum(source, hashlib.md5()))
+        self.assertTrue(maven_repo_util.checkChecksum(generated))
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        calls = []
+        results = []
+
+        def failingFetch():
+            calls.append(1)
+            time.sleep(0.2)
+            return False
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do("path", failingFetch)))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the followers waited for the only call and got its real outcome
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [False, False, False])
+        self.assertEqual(flight.coalesced, 2)
+
+        def raisingFetch():
+            raise SystemExit(1)
+        self.assertRaises(SystemExit, flight.do, "path", raisingFetch)
+        self.assertEqual(flight.do("path", lambda: True), True)
+
+    def test_progress_reporter(self):
+        tempDir = self.mkdtemp()
+        promFile = os.path.join(tempDir, "mrb.prom")
+        reporter = ProgressReporter(4, statusFile=os.path.join(tempDir, "status.json"), prometheusFile=promFile,
+                                    statsFunc=lambda: {"hostLimits": {"repo1:80": 6}})
+        reporter.addBytes("repo1:80", 1000)
+        reporter.fileDone()
+        reporter.fileDone(False)
+        reporter.fileSkipped()
+        status = reporter.getStatus()
+        self.assertEqual(status["files"], {"total": 4, "done": 1, "failed": 1, "skipped": 1, "remaining": 1})
+        self.assertEqual(status["bytes"], {"done": 1000, "remaining": 500})
+        self.assertEqual(status["hosts"]["repo1:80"]["bytes"], 1000)
+
+        reporter.report()
+        with open(promFile) as fileobj:
+            metrics = fileobj.read()
+        self.assertTrue('maven_repo_builder_files{state="failed"} 1' in metrics)
+        self.assertTrue('maven_repo_builder_downloaded_bytes_total{host="repo1:80"} 1000' in metrics)
+        self.assertTrue('maven_repo_builder_host_concurrency_limit{host="repo1:80"} 6' in metrics)
+
+    def test_checksum_types(self):
+        self.assertRaises(ValueError, maven_repo_util.setChecksumTypes, ["md5", "crc32"])
+        tempDir = self.mkdtemp()
+        source = os.path.join(tempDir, "source.jar")
+        with open(source, "w") as fileobj:
+            fileobj.write("artifact content")
+        target = os.path.join(tempDir, "repo", "target.jar")
+        maven_repo_util.setChecksumTypes(["sha1", "sha256"])
+        try:
+            self.assertTrue(maven_repo_util.fetchFile("file://" + source, target, ChecksumMode.generate))
+        finally:
+            maven_repo_util.setChecksumTypes(maven_repo_util.CHECKSUM_TYPES)
+        self.assertFalse(os.path.exists(target + ".md5"))
+        self.assertEqual(maven_repo_util.readChecksumFromFile(target + ".sha256", 64),
+                         maven_repo_util.getChecksum(source, hashlib.sha256()))
+
+    def test_checksum_downloads_pool(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def downloadChecksum(url, filePath, checksumType, length):
+            with lock:
+                running.append(checksumType)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(checksumType)
+            return checksumType != "sha512"
+
+        originalDownloadChecksum = maven_repo_util._downloadChecksum
+        maven_repo_util._downloadChecksum = downloadChecksum
+        maven_repo_util.configureChecksumDownloads(2)
+        try:
+            waits = [maven_repo_util._startChecksumDownloads("http://repo1/file%d.jar" % i, "file%d.jar" % i,
+                                                             ["md5", "sha1", "sha256"]) for i in range(4)]
+            self.assertEqual([wait() for wait in waits], [True] * 4)
+            self.assertFalse(maven_repo_util._startChecksumDownloads("http://repo1/file.jar", "file.jar",
+                                                                     ["sha1", "sha512"])())
+        finally:
+            maven_repo_util._downloadChecksum = originalDownloadChecksum
+            maven_repo_util.configureChecksumDownloads(8)
+        # sidecars of all downloads share the bounded pool of threads
+        self.assertEqual(max(peak), 2)
+
+    def test_build_planner(self):
+        tempDir = self.mkdtemp()
+        repoDir = os.path.join(tempDir, "repo")
+        outputDir = os.path.join(tempDir, "output")
+        artifacts = [MavenArtifact.createFromGAV("org.foo:bar:jar:1.0"),
+                     MavenArtifact.createFromGAV("org.foo:bar:jar:2.0"),
+                     MavenArtifact.createFromGAV("org.foo:bar:jar:3.0")]
+        for (artifact, directory) in ((artifacts[0], repoDir), (artifacts[1], repoDir), (artifacts[1], outputDir)):
+            path = os.path.join(directory, artifact.getArtifactFilepath())
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fileobj:
+                fileobj.write("x" * 1000)
+
+        stats = ThroughputStats(os.path.join(tempDir, "throughput.json"))
+        stats.update("file://", 100.0)
+        stats.update("file://", 300.0)
+        stats.save()
+        stats = ThroughputStats(os.path.join(tempDir, "throughput.json"))
+        self.assertEqual(stats.getRate("file://"), 200.0)
+        self.assertEqual(stats.getRate("repo1:80"), None)
+
+        plan = build_planner.planBuild({"file://" + repoDir: artifacts}, outputDir, 2, stats)
+        self.assertEqual(plan, {"file://": {"files": 2, "present": 1, "unknown": 1, "bytes": 1000, "rate": 200.0,
+                                            "duration": 5.0}})
+
+        # files of snapshot artifacts are sized after their versions are resolved
+        snapshot = MavenArtifact.createFromGAV("org.foo:baz:jar:1.0-SNAPSHOT")
+        metadataPath = os.path.join(repoDir, snapshot.getDirPath(), "maven-metadata.xml")
+        os.makedirs(os.path.dirname(metadataPath))
+        with open(metadataPath, "w") as fileobj:
+            fileobj.write("<metadata><versioning><snapshot><timestamp>20170102.030405</timestamp>"
+                          "<buildNumber>7</buildNumber></snapshot></versioning></metadata>")
+        with open(os.path.join(repoDir, snapshot.getDirPath(), "baz-1.0-20170102.030405-7.jar"), "w") as fileobj:
+            fileobj.write("x" * 500)
+        try:
+            plan = build_planner.planBuild({"file://" + repoDir: [snapshot]}, outputDir, 2)
+        finally:
+            maven_repo_util.cleanTempDir()
+        self.assertEqual(plan["file://"]["bytes"], 500)
+
+    def test_parallel_copy(self):
+        tempDir = self.mkdtemp()
+        repoDir = os.path.join(tempDir, "repo")
+        outputDir = os.path.join(tempDir, "output")
+        # artifacts share directories, so the copying threads create the same directories at once
+        artifacts = [MavenArtifact.createFromGAV("org.foo:bar%d:%s:1.0" % (i, artifactType))
+                     for i in range(4) for artifactType in ("jar", "pom", "war")]
+        for artifact in artifacts:
+            path = os.path.join(repoDir, artifact.getArtifactFilepath())
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fileobj:
+                fileobj.write(artifact.getArtifactFilename())
+        missing = MavenArtifact.createFromGAV("org.foo:missing:jar:1.0")
+
+        reporter = ProgressReporter(len(artifacts) + 1)
+        maven_repo_util.setProgressReporter(reporter)
+        self.addCleanup(maven_repo_util.setProgressReporter, None)
+        errorCount = artifact_downloader.fetchArtifactList("file://" + repoDir, outputDir, artifacts + [missing],
+                                                           ChecksumMode.generate, 1, copyThreads=4)
+        # the missing file is not counted as copied
+        self.assertEqual((reporter.doneFiles, reporter.failedFiles), (len(artifacts), 1))
+        for artifact in artifacts:
+            path = os.path.join(outputDir, artifact.getArtifactFilepath())
+            with open(path) as fileobj:
+                self.assertEqual(fileobj.read(), artifact.getArtifactFilename())
+            self.assertTrue(maven_repo_util.checkChecksum(path))
+        self.assertFalse(os.path.exists(os.path.join(outputDir, missing.getArtifactFilepath())))
+        # a file missing in the repository is not an error
+        self.assertEqual(errorCount, 0)
+
+        # without the errors queue an error is raised to the caller
+        os.remove(os.path.join(repoDir, artifacts[0].getArtifactFilepath()))
+        os.mkdir(os.path.join(repoDir, artifacts[0].getArtifactFilepath()))
+        self.assertRaises(IOError, artifact_downloader.copyArtifact, repoDir, os.path.join(tempDir, "other"),
+                          artifacts[0], ChecksumMode.generate)
+
+    def test_snapshot_version_suffixes(self):
+        tempDir = self.mkdtemp()
+        groupId = "org.snapshot" + os.path.basename(tempDir).lower()
+        artifacts = [MavenArtifact.createFromGAV("%s:bar:%s:1.0-SNAPSHOT" % (groupId, artifactType))
+                     for artifactType in ("jar", "pom")]
+        artifacts.append(MavenArtifact.createFromGAV("%s:bar:jar:1.0" % groupId))
+        metadataPath = os.path.join(tempDir, artifacts[0].getDirPath(), "maven-metadata.xml")
+        os.makedirs(os.path.dirname(metadataPath))
+        with open(metadataPath, "w") as fileobj:
+            fileobj.write("<metadata><versioning><snapshot><timestamp>20170102.030405</timestamp>"
+                          "<buildNumber>7</buildNumber></snapshot></versioning></metadata>")
+
+        try:
+            maven_repo_util.updateSnapshotVersionSuffixes(artifacts, "file://" + tempDir, 4)
+            self.assertEqual([artifact.snapshotVersionSuffix for artifact in artifacts],
+                             ["-20170102.030405-7", "-20170102.030405-7", None])
+            self.assertEqual(artifacts[0].getArtifactFilename(), "bar-1.0-20170102.030405-7.jar")
+
+            # the resolved suffix is cached for other artifacts of the GAV
+            os.remove(metadataPath)
+            maven_repo_util.cleanTempDir()
+            artifact = MavenArtifact.createFromGAV("%s:bar:war:1.0-SNAPSHOT" % groupId)
+            maven_repo_util.updateSnapshotVersionSuffixes([artifact], "file://" + tempDir, 4)
+            self.assertEqual(artifact.snapshotVersionSuffix, "-20170102.030405-7")
+        finally:
+            maven_repo_util.cleanTempDir()
+
+        # a fetch exiting the program leaves the artifact unresolved instead of hanging the resolution
+        originalGetSuffix = maven_repo_util._getSnapshotVersionSuffix
+        maven_repo_util._getSnapshotVersionSuffix = lambda artifact, repoUrl: sys.exit(1)
+        artifact = MavenArtifact.createFromGAV("%s:other:jar:1.0-SNAPSHOT" % groupId)
+        try:
+            resolver = threading.Thread(target=maven_repo_util.updateSnapshotVersionSuffixes,
+                                        args=[[artifact], "file://" + tempDir, 2])
+            resolver.daemon = True
+            resolver.start()
+            resolver.join(10)
+        finally:
+            maven_repo_util._getSnapshotVersionSuffix = originalGetSuffix
+        self.assertFalse(resolver.is_alive())
+        self.assertEqual(artifact.snapshotVersionSuffix, None)
+
+    def test_sort_by_size(self):
+        tempDir = self.mkdtemp()
+        repoDir = os.path.join(tempDir, "repo")
+        artifacts = [MavenArtifact.createFromGAV("org.foo:bar:jar:%d.0" % i) for i in range(4)]
+        for (artifact, size) in zip(artifacts[:3], (10, 3000, 200)):
+            path = os.path.join(repoDir, artifact.getArtifactFilepath())
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fileobj:
+                fileobj.write("x" * size)
+        ordered = artifact_downloader._sortBySize("file://" + repoDir, os.path.join(tempDir, "output"), artifacts, 2)
+        self.assertEqual([artifact.version for artifact in ordered], ["1.0", "2.0", "0.0", "3.0"])
+
+    def test_disk_space_guard(self):
+        tempDir = self.mkdtemp()
+        guard = DiskSpaceGuard(os.path.join(tempDir, "not", "created"))
+        free = guard.getFreeSpace()
+        self.assertTrue(free > 0)
+        # nothing else is running, so a file bigger than the free space fails right away
+        self.assertRaises(IOError, guard.reserve, free * 2)
+
+        reservation = guard.reserve(free / 2)
+        released = []
+        thread = threading.Thread(target=lambda: (time.sleep(0.2), released.append(1), reservation.release()))
+        thread.start()
+        # waits for the running download, then fails since the space was not freed
+        guard.CHECK_INTERVAL = 0.05
+        self.assertRaises(IOError, guard.reserve, free + free / 2)
+        thread.join()
+        self.assertEqual((released, guard.waited), ([1], 1))
+
+        filepath = os.path.join(tempDir, "preallocated.jar")
+        with open(filepath, "wb") as fileobj:
+            file_util.preallocate(fileobj, 100000)
+        self.assertEqual(os.path.getsize(filepath), 0)
+
+        # a preallocated file is already missing in the free space, so its reservation does not block other files
+        size = 10 * 1024 * 1024
+        guard = DiskSpaceGuard(tempDir, guard.getFreeSpace() - size - 2 * 1024 * 1024)
+        reservation = guard.reserve(size)
+        with open(filepath, "wb") as fileobj:
+            maven_repo_util._preallocate(fileobj, size, reservation)
+        if reservation.size == 0:
+            guard.reserve(1024).release()
+            self.assertEqual(guard.waited, 0)
+        reservation.release()
+        # a second release does not count the download as finished again
+        reservation.release()
+        self.assertEqual((guard._reserved, guard._running), (0, 0))
+
+        # a reservation is extended only by free space, without waiting
+        reservation = guard.reserve(0)
+        self.assertTrue(reservation.extend(1024))
+        self.assertFalse(reservation.extend(guard.getFreeSpace() * 2))
+        self.assertEqual(reservation.size, 1024)
+        reservation.release()
+
+    def test_download_disk_space(self):
+        tempDir = self.mkdtemp()
+        requests = []
+        free = DiskSpaceGuard(tempDir).getFreeSpace()
+
+        def openUrl(url, headers=None):
+            requests.append(url)
+            return FakeResponse(200, {"Content-Length": str(free * 2)}, "x")
+
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._openUrl = openUrl
+        try:
+            # no request is sent when the space is missing before the download
+            maven_repo_util.configureDiskSpaceGuard(tempDir, free * 2)
+            self.assertEqual(maven_repo_util.download("http://repo1/file.jar", os.path.join(tempDir, "file.jar"),
+                                                      ChecksumMode.generate), None)
+            self.assertEqual(requests, [])
+
+            # a file bigger than the free space fails without writing anything after its size is known
+            maven_repo_util.configureDiskSpaceGuard(tempDir)
+            self.assertEqual(maven_repo_util.download("http://repo1/file.jar", os.path.join(tempDir, "file.jar"),
+                                                      ChecksumMode.generate), None)
+            self.assertEqual(requests, ["http://repo1/file.jar"])
+            self.assertEqual(os.listdir(tempDir), [])
+            self.assertEqual(maven_repo_util.getDiskSpaceGuard()._running, 0)
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util._diskSpaceGuard = None
+
+    def test_resume_part_file(self):
+        requests = []
+        responses = []
+
+        def openUrl(url, headers=None):
+            requests.append(headers)
+            return responses.pop(0)
+
+        def fetch(first, *resumed):
+            del requests[:]
+            responses[:] = list(resumed)
+            partPath = os.path.join(self.mkdtemp(), "file.jar.part")
+            digests = maven_repo_util._fetchBody("http://repo1/file.jar", first, partPath)
+            with open(partPath, "rb") as fileobj:
+                return (fileobj.read(), digests["sha1"])
+
+        originalOpenUrl = maven_repo_util._openUrl
+        originalRetryPolicy = maven_repo_util.getRetryPolicy()
+        originalPreallocate = maven_repo_util._preallocate
+        maven_repo_util._openUrl = openUrl
+        maven_repo_util._retryPolicy = RetryPolicy(delay=0)
+        try:
+            headers = {"Content-Length": "10", "ETag": '"v1"'}
+            # the interrupted body is appended from the written size
+            (content, sha1) = fetch(FakeResponse(200, headers, "0123456789", 4),
+                                    FakeResponse(206, {"Content-Range": "bytes 4-9/10", "Content-Length": "6"},
+                                                 "456789"))
+            self.assertEqual(requests, [{"Range": "bytes=4-", "If-Range": '"v1"'}])
+            self.assertEqual((content, sha1), ("0123456789", hashlib.sha1("0123456789").hexdigest()))
+
+            # a server ignoring ranges sends the whole file again
+            (content, sha1) = fetch(FakeResponse(200, headers, "0123456789", 4),
+                                    FakeResponse(200, {"Content-Length": "10"}, "0123456789"))
+            self.assertEqual((content, sha1), ("0123456789", hashlib.sha1("0123456789").hexdigest()))
+
+            # the file changed on the server, so If-Range did not match and the written part is discarded, the space
+            # freed by the truncation is preallocated again
+            preallocated = []
+            maven_repo_util._preallocate = lambda fileobj, size, reservation: preallocated.append(size)
+            (content, sha1) = fetch(FakeResponse(200, headers, "0123456789", 4),
+                                    FakeResponse(200, {"Content-Length": "8", "ETag": '"v2"'}, "abcdefgh"))
+            maven_repo_util._preallocate = originalPreallocate
+            self.assertEqual((content, sha1), ("abcdefgh", hashlib.sha1("abcdefgh").hexdigest()))
+            self.assertEqual(preallocated, [10, 8])
+
+            # a connection breaking on each resume ends with URLError, which download retries
+            resets = [FakeResponse(206, {"Content-Range": "bytes 4-9/10", "Content-Length": "6"}, "456789", 0)
+                      for i in range(maven_repo_util.MAX_RESUMES)]
+            self.assertRaises(urllib2.URLError, fetch, FakeResponse(200, headers, "0123456789", 4), *resets)
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util._retryPolicy = originalRetryPolicy
+            maven_repo_util._preallocate = originalPreallocate
+
+    def test_http_cache(self):
+        tempDir = self.mkdtemp()
+        cacheFile = os.path.join(tempDir, "state", "validators.json")
+        filepath = os.path.join(tempDir, "repo", "maven-metadata.xml")
+        os.makedirs(os.path.dirname(filepath))
+        with open(filepath, "w") as fileobj:
+            fileobj.write("old")
+        os.utime(filepath, (0, 0))
+        url = "http://repo1/org/foo/maven-metadata.xml"
+
+        cache = HttpCache(cacheFile)
+        # without stored validators the modification time of the local file is used
+        self.assertEqual(cache.getConditionalHeaders(url, filepath),
+                         {"If-Modified-Since": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        cache.update(url, FakeResponse(200, {"ETag": '"v1"', "Last-Modified": "Mon, 02 Jan 2017 00:00:00 GMT"}))
+        cache.save()
+        self.assertEqual(HttpCache(cacheFile).getConditionalHeaders(url, filepath),
+                         {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 02 Jan 2017 00:00:00 GMT"})
+
+        requests = []
+        responses = []
+
+        def openUrl(url, headers=None):
+            requests.append(headers)
+            return responses.pop(0)
+
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._openUrl = openUrl
+        maven_repo_util.configureHttpCache(cacheFile)
+        try:
+            # not modified file is kept
+            responses.append(FakeResponse(304, {}))
+            self.assertEqual(maven_repo_util.download(url, filepath, ChecksumMode.generate), 304)
+            self.assertEqual(requests[0]["If-None-Match"], '"v1"')
+            with open(filepath) as fileobj:
+                self.assertEqual(fileobj.read(), "old")
+
+            # modified file is replaced together with its checksum files and its new validators are stored
+            for checksumType in ("md5", "sha1"):
+                with open(filepath + "." + checksumType, "w") as fileobj:
+                    fileobj.write(hashlib.new(checksumType, "old").hexdigest())
+            responses.append(FakeResponse(200, {"Content-Length": "3", "ETag": '"v2"'}, "new"))
+            self.assertEqual(maven_repo_util.download(url, filepath, ChecksumMode.generate), 200)
+            with open(filepath) as fileobj:
+                self.assertEqual(fileobj.read(), "new")
+            self.assertTrue(maven_repo_util.checkChecksum(filepath))
+            self.assertFalse(os.path.exists(filepath + maven_repo_util.PART_SUFFIX + ".sha1"))
+            cache = maven_repo_util._httpCache
+            self.assertEqual((cache.notModified, cache.modified), (1, 1))
+            self.assertEqual(cache.getConditionalHeaders(url, filepath), {"If-None-Match": '"v2"'})
+
+            # released files are not revalidated
+            releasePath = os.path.join(tempDir, "repo", "foo-1.0.jar")
+            with open(releasePath, "w") as fileobj:
+                fileobj.write("release")
+            self.assertEqual(maven_repo_util.download("http://repo1/foo-1.0.jar", releasePath), None)
+            self.assertEqual(len(requests), 2)
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util.configureHttpCache(None)
+
+    def test_split_connections(self):
+        size = 10 * maven_repo_util.MIN_SPLIT_SEGMENT
+        rangesResponse = FakeResponse(200, {"Accept-Ranges": "bytes"})
+        maven_repo_util.configureSplitDownloads(size, 4)
+        try:
+            self.assertEqual(maven_repo_util._getSplitConnections(rangesResponse, size), 4)
+            self.assertEqual(maven_repo_util._getSplitConnections(rangesResponse, size - 1), 1)
+            self.assertEqual(maven_repo_util._getSplitConnections(rangesResponse, None), 1)
+            self.assertEqual(maven_repo_util._getSplitConnections(FakeResponse(200, {}), size), 1)
+            # ranges are not smaller than the minimal segment
+            maven_repo_util.configureSplitDownloads(size, 20)
+            self.assertEqual(maven_repo_util._getSplitConnections(rangesResponse, size), 10)
+        finally:
+            maven_repo_util.configureSplitDownloads(None, 4)
+
+        # further ranges are downloaded by the shared bounded pool of range threads
+        body = "".join(chr(ord("a") + i) * maven_repo_util.MIN_SPLIT_SEGMENT for i in range(3))
+        rangeThreads = []
+
+        def openUrl(url, headers=None):
+            rangeThreads.append(threading.current_thread())
+            (start, end) = [int(value) for value in headers["Range"][6:].split("-")]
+            return FakeResponse(206, {"Content-Range": "bytes %d-%d/%d" % (start, end, len(body))},
+                                body[start:end + 1])
+
+        originalOpenUrl = maven_repo_util._openUrl
+        maven_repo_util._openUrl = openUrl
+        maven_repo_util.configureRangeDownloads(1, 1)
+        try:
+            partPath = os.path.join(self.mkdtemp(), "file.jar.part")
+            digests = maven_repo_util._fetchBodySplit("http://repo1/file.jar", FakeResponse(200, {}, body), partPath,
+                                                      len(body), 3, None)
+        finally:
+            maven_repo_util._openUrl = originalOpenUrl
+            maven_repo_util.configureRangeDownloads(8, 8)
+        self.assertEqual(digests["sha1"], hashlib.sha1(body).hexdigest())
+        self.assertEqual(set(thread.name for thread in rangeThreads), set(["Downloader-1"]))
+
+    def test_write_behind(self):
+        tempDir = self.mkdtemp()
+        writeBehind = WriteBehind(2, 4)
+        filepath = os.path.join(tempDir, "written.jar")
+        with writeBehind.open(open(filepath, "wb")) as fileobj:
+            for i in range(100):
+                fileobj.write(str(i % 10) * 100)
+            self.assertEqual(fileobj.tell(), 10000)
+        with open(filepath) as fileobj:
+            self.assertEqual(fileobj.read(), "".join(str(i % 10) * 100 for i in range(100)))
+        self.assertTrue(writeBehind.waits > 0)
+
+        # the error of the writer is raised in the thread handing over the data
+        fileobj = writeBehind.open(open(filepath, "rb"))
+        fileobj.write("data")
+        self.assertRaises(IOError, fileobj.flush)
+        self.assertRaises(IOError, fileobj.close)
+
+    def test_listed_files(self):
+        tempDir = self.mkdtemp()
+        artifact = MavenArtifact.createFromGAV("org.foo:bar:jar:1.0")
+        path = os.path.join(tempDir, artifact.getArtifactFilepath())
+        os.makedirs(os.path.dirname(path))
+        for (filename, content) in (("bar-1.0.jar", "x" * 1000), ("bar-1.0.jar.sha1", "0" * 40),
+                                    ("bar-1.0.pom", "<project/>")):
+            with open(os.path.join(os.path.dirname(path), filename), "w") as fileobj:
+                fileobj.write(content)
+        # size of a broken symlink is unknown
+        os.symlink(os.path.join(tempDir, "missing.jar"), os.path.join(os.path.dirname(path), "bar-1.0-sources.jar"))
+
+        builder = artifact_list_builder.ArtifactListBuilder(configuration.Configuration())
+        artSpecs = builder._listLocalRepository(tempDir + "/").values()
+        self.assertEqual([artSpec.listedFiles for artSpec in artSpecs], [{"bar-1.0.jar": (1000, set(["sha1"])),
+                                                                          "bar-1.0-sources.jar": (None, set()),
+                                                                          "bar-1.0.pom": (10, set())}])
+
+        artifact.listedFiles = artSpecs[0].listedFiles
+        maven_repo_util.addListedFiles("http://repo1/listed", [artifact])
+        url = "http://repo1/listed/" + artifact.getArtifactFilepath()
+        self.assertEqual(maven_repo_util._getListedChecksumTypes(url, ["md5", "sha1"]), ["sha1"])
+        self.assertEqual(maven_repo_util.getFileSize(url), 1000)
+        # files which were not listed keep all checksum types
+        self.assertEqual(maven_repo_util._getListedChecksumTypes("http://repo1/other.jar", ["md5"]), ["md5"])
+
+    def test_generate_checksums(self):
+        tempDir = self.mkdtemp()
+        for i in range(20):
+            path = os.path.join(tempDir, "org", "foo", "bar", "1.%d" % i, "bar-1.%d.jar" % i)
+            os.makedirs(os.path.dirname(path))
+            with open(path, "w") as fileobj:
+                fileobj.write(str(i) * 1000)
+        with open(path + ".md5", "w") as fileobj:
+            fileobj.write("kept")
+
+        maven_repo_builder.generateChecksums(tempDir, 4)
+        self.assertEqual(maven_repo_util.readChecksumFromFile(path + ".sha1", 40),
+                         maven_repo_util.getChecksum(path, hashlib.sha1()))
+        with open(path + ".md5") as fileobj:
+            self.assertEqual(fileobj.read(), "kept")
+        self.assertEqual(sum(len(filenames) for (_, _, filenames) in os.walk(tempDir)), 60)
+
+    def test_hedged_find_artifact(self):
+        tempDir = self.mkdtemp()
+        groupId = "org.hedged" + os.path.basename(tempDir).lower()
+        artifact = MavenArtifact.createFromGAV("%s:bar:jar:1.0" % groupId)
+        # the second mirror knows the version only from metadata
+        metadataPath = os.path.join(tempDir, "repo2", artifact.getArtifactDirPath(), "maven-metadata.xml")
+        os.makedirs(os.path.dirname(metadataPath))
+        with open(metadataPath, "w") as fileobj:
+            fileobj.write("<metadata><versioning><versions><version>1.0</version></versions></versioning></metadata>")
+        os.makedirs(os.path.join(tempDir, "repo1"))
+        urls = ["file://" + os.path.join(tempDir, "repo1"), "file://" + os.path.join(tempDir, "repo2")]
+
+        checkedUrls = []
+        originalUrlExists = maven_repo_util.urlExists
+
+        def urlExists(url):
+            checkedUrls.append(url)
+            return originalUrlExists(url)
+
+        maven_repo_util.urlExists = urlExists
+        maven_repo_util.configureHedging(95)
+        try:
+            builder = artifact_list_builder.ArtifactListBuilder(configuration.Configuration())
+            artifacts = builder._listArtifacts(urls, ["%s:bar:1.0" % groupId])
+        finally:
+            maven_repo_util.urlExists = originalUrlExists
+            maven_repo_util.configureHedging(None)
+            maven_repo_util.cleanTempDir()
+        self.assertEqual([artSpec.url for artSpec in artifacts.values()], [urls[1]])
+        # the GAV directories are checked only by the race, not again by the metadata fallback
+        self.assertEqual(sorted(url for url in checkedUrls if url.endswith("/1.0/")),
+                         [url + "/" + artifact.getDirPath() for url in urls])
+
+    def test_hedged_pom_fallback(self):
+        urls = ["http://repo1.example.com/maven2/", "http://repo2.example.com/maven2/"]
+        fetchedUrls = []
+        settingsContents = []
+
+        class FailingMaven:
+            returncode = 1
+
+            def __init__(self, args, stdout=None):
+                with open(args[args.index("-s") + 1]) as settings:
+                    settingsContents.append(settings.read())
+
+            def communicate(self):
+                return ("", None)
+
+        def fetchFile(url, path, *args):
+            fetchedUrls.append(url)
+            return url.startswith(urls[1])
+
+        # the mirrors reject HEAD requests, so the race finds no winner, but the pom is still fetched by GET
+        originalUrlExists = maven_repo_util.urlExists
+        originalFetchFile = maven_repo_util.fetchFile
+        maven_repo_util.urlExists = lambda url: False
+        maven_repo_util.fetchFile = fetchFile
+        artifact_list_builder.Popen = FailingMaven
+        maven_repo_util.configureHedging(95)
+        try:
+            builder = artifact_list_builder.ArtifactListBuilder(configuration.Configuration())
+            builder._listDependencies(urls, ["org.foo:bar:1.0"], False, None, False)
+        finally:
+            maven_repo_util.urlExists = originalUrlExists
+            maven_repo_util.fetchFile = originalFetchFile
+            artifact_list_builder.Popen = Popen
+            maven_repo_util.configureHedging(None)
+            maven_repo_util.cleanTempDir()
+        self.assertEqual(fetchedUrls, [url + "org/foo/bar/1.0/bar-1.0.pom" for url in urls])
+        self.assertTrue(urls[1] in settingsContents[0])
+
     def test_bad_urls(self):
         url = "junk://repo1.maven.org/maven2/org/jboss/jboss-parent/10/jboss-parent-10.p"
         maven_repo_util.download(url, None, ChecksumMode.generate)
@@ -0,0 +1,72 @@
+"""throughput_stats.py: Persistent download throughput per server measured by previous builds"""
+
+import json
+import logging
+import os
+from multiprocessing import Lock
+
+
+class ThroughputStats:
+    """
+    Store of download rates per host in bytes per second. Each build blends its measured rates into the stored ones,
+    so a single unusually fast or slow build does not override the history. The rates are loaded from and saved to
+    a json file and they are used to estimate the duration of next builds.
+    """
+
+    # weight of a new measurement in the stored rate
+    WEIGHT = 0.5
+
+    def __init__(self, filename):
+        """
+        Constructor.
+
+        :param filename: path of the json file with rates, it does not need to exist
+        """
+        self.filename = filename
+        self._lock = Lock()
+        self._rates = {}  # { host: bytes per second }
+        if os.path.exists(filename):
+            try:
+                with open(filename, "r") as statsFile:
+                    self._rates = json.load(statsFile)
+            except ValueError as err:
+                logging.warning("Unable to read throughput statistics from %s: %s", filename, str(err))
+
+    def getRate(self, host):
+        """Returns the download rate of the host in bytes per second or None if it was not measured yet."""
+        self._lock.acquire()
+        try:
+            return self._rates.get(host)
+        finally:
+            self._lock.release()
+
+    def update(self, host, rate):
+        """
+        Blends a newly measured rate of the host into the stored one.
+
+        :param host: host (with port) the data were downloaded from
+        :param rate: measured rate in bytes per second
+        """
+        self._lock.acquire()
+        try:
+            oldRate = self._rates.get(host)
+            if oldRate is None:
+                self._rates[host] = rate
+            else:
+                self._rates[host] = oldRate + self.WEIGHT * (rate - oldRate)
+        finally:
+            self._lock.release()
+
+    def save(self):
+        """Saves the rates to the json file. The file is replaced atomically."""
+        self._lock.acquire()
+        try:
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            tmpFilename = self.filename + ".tmp"
+            with open(tmpFilename, "w") as statsFile:
+                json.dump(self._rates, statsFile)
+            os.rename(tmpFilename, self.filename)
+        finally:
+            self._lock.release()
@@ -0,0 +1,154 @@
+"""write_behind.py: Writing of downloaded data to disk by separate threads"""
+
+import sys
+import threading
+from Queue import Full
+from Queue import Queue
+
+
+class WriteBehind:
+    """
+    Pool of disk writer threads. Download threads hand blocks of data to the writers through bounded queues instead
+    of writing them, so a stalled disk does not keep network connections idle until the queues fill up, and
+    the number of download and writer threads can be set separately. All blocks of a file are written by a single
+    writer in the order they were handed over.
+    """
+
+    def __init__(self, writers, queueSize):
+        """
+        Constructor.
+
+        :param writers: number of writer threads
+        :param queueSize: maximal number of blocks waiting to be written by all writers together
+        """
+        self.waits = 0
+        self._queues = []
+        self._nextQueue = 0
+        self._lock = threading.Lock()
+        for i in range(writers):
+            queue = Queue(max(1, queueSize // writers))
+            thread = threading.Thread(target=self._run, args=[queue], name="Writer-%d" % (i + 1))
+            thread.daemon = True
+            thread.start()
+            self._queues.append(queue)
+
+    def open(self, fileobj):
+        """
+        Returns file object writing into the given open file by the writers.
+
+        :param fileobj: file opened for writing, it is closed along with the returned object
+        :returns: WriteBehindFile instance
+        """
+        self._lock.acquire()
+        try:
+            queue = self._queues[self._nextQueue]
+            self._nextQueue = (self._nextQueue + 1) % len(self._queues)
+        finally:
+            self._lock.release()
+        return WriteBehindFile(fileobj, queue, self)
+
+    def _put(self, queue, item):
+        try:
+            queue.put_nowait(item)
+        except Full:
+            self._lock.acquire()
+            try:
+                self.waits += 1
+            finally:
+                self._lock.release()
+            queue.put(item)
+
+    def _run(self, queue):
+        while True:
+            (writeBehindFile, data) = queue.get()
+            writeBehindFile._write(data)
+
+
+class WriteBehindFile:
+    """
+    File object whose writes are done by a writer thread of WriteBehind. Other operations wait until the data handed
+    over so far are written. An error of a write is raised by each next operation and no more data are written.
+    """
+
+    def __init__(self, fileobj, queue, writeBehind):
+        self.name = fileobj.name
+        self._file = fileobj
+        self._queue = queue
+        self._writeBehind = writeBehind
+        self._pending = 0
+        self._excInfo = None
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        self._raiseError()
+        self._condition.acquire()
+        try:
+            self._pending += 1
+        finally:
+            self._condition.release()
+        self._writeBehind._put(self._queue, (self, data))
+
+    def flush(self):
+        self._waitForWrites()
+        self._raiseError()
+        self._file.flush()
+
+    def tell(self):
+        self.flush()
+        return self._file.tell()
+
+    def seek(self, offset, whence=0):
+        self.flush()
+        self._file.seek(offset, whence)
+
+    def truncate(self, size=None):
+        self.flush()
+        if size is None:
+            self._file.truncate()
+        else:
+            self._file.truncate(size)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._waitForWrites()
+        self._file.close()
+        self._raiseError()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._waitForWrites()
+        self._file.close()
+        if excType is None:
+            self._raiseError()
+
+    def _write(self, data):
+        """Writes the data in the writer thread."""
+        try:
+            if self._excInfo is None:
+                self._file.write(data)
+        except BaseException:
+            self._excInfo = sys.exc_info()
+        finally:
+            self._condition.acquire()
+            try:
+                self._pending -= 1
+                if not self._pending:
+                    self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+    def _waitForWrites(self):
+        self._condition.acquire()
+        try:
+            while self._pending:
+                self._condition.wait()
+        finally:
+            self._condition.release()
+
+    def _raiseError(self):
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]